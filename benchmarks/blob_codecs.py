@@ -0,0 +1,70 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Compare the blob codecs: storage/network savings against CPU cost.
+
+Usage: python benchmarks/blob_codecs.py [FILE...]
+(with farnsworth installed and its environment set, see README)
+
+Without files, runs on synthetic samples shaped like tests, polls and
+pickled traffic. Network time assumes the given bandwidth between workers
+and the database.
+"""
+
+from __future__ import absolute_import, unicode_literals, print_function
+
+import os
+import pickle
+import random
+import sys
+import timeit
+
+from farnsworth.peewee_extensions import CODECS
+
+BANDWIDTH = 1e9 / 8     # bytes per second, 1 Gbit/s
+
+
+def samples():
+    rand = random.Random(0)
+    test = b"".join(rand.choice([b"A" * 64, b"\x00" * 32, os.urandom(8), b"GET / HTTP/1.0\n"])
+                    for _ in range(20000))
+    poll = b"<pov><cb_id>1</cb_id>" + b"".join(
+        b"<write><data>{}</data></write><read><match><data>ok</data></match></read>".format(i)
+        for i in range(5000)) + b"</pov>"
+    traffic = pickle.dumps([{'src': rand.randint(0, 7), 'dst': rand.randint(0, 7),
+                             'payload': test[i:i + 512]} for i in range(0, len(test), 512)], 2)
+    return [("test", test), ("poll", poll), ("traffic", traffic), ("random", os.urandom(1 << 20))]
+
+
+def bench(name, data):
+    print("{} ({} bytes)".format(name, len(data)))
+    print("  {:6} {:>8} {:>14} {:>14} {:>12}".format(
+        "codec", "ratio", "compress MB/s", "decomp. MB/s", "net. saved"))
+    for codec_name, codec in sorted(CODECS.items()):
+        compressed = codec.compress(data)
+        number = 5
+        compress_time = timeit.timeit(lambda: codec.compress(data), number=number) / number
+        decompress_time = timeit.timeit(lambda: codec.decompress(compressed),
+                                        number=number) / number
+        # a read transfers the compressed blob, then decompresses it
+        saved = (len(data) - len(compressed)) / BANDWIDTH - decompress_time
+        print("  {:6} {:8.2f} {:14.1f} {:14.1f} {:10.1f}ms".format(
+            codec_name, float(len(data)) / len(compressed),
+            len(data) / compress_time / 1e6 if compress_time else float('inf'),
+            len(data) / decompress_time / 1e6 if decompress_time else float('inf'),
+            saved * 1e3))
+
+
+def main(args):
+    if args:
+        for path in args:
+            with open(path, 'rb') as fp:
+                bench(path, fp.read())
+    else:
+        for name, data in samples():
+            bench(name, data)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
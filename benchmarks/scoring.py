@@ -0,0 +1,75 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Compare scoring PatchScore and PollFeedback rows one object at a time,
+through CBScoreMixin, against the vectorised farnsworth.scoring.
+
+Usage: python benchmarks/scoring.py [ROWS]
+(with farnsworth installed, NumPy and its environment set, see README)
+
+Rows are created in a transaction rolled back at the end, the database is
+left untouched.
+"""
+
+from __future__ import absolute_import, unicode_literals, print_function
+
+import random
+import sys
+import timeit
+
+from farnsworth import scoring
+from farnsworth.config import master_db
+from farnsworth.models import (ChallengeBinaryNode, ChallengeSet, ChallengeSetFielding,
+                               PatchScore, PatchType, PollFeedback, Round, Team)
+
+
+def populate(rows):
+    rand = random.Random(0)
+    team = Team.get_or_create(name=Team.OUR_NAME)[0]
+    cs = ChallengeSet.create(name="benchmark")
+    patch_type = PatchType.create(name="benchmark", functionality_risk=0.1, exploitability=0.2)
+    for i in range(rows):
+        round_ = Round.create(num=i)
+        perf_score = {'score': {side: {'task_clock': rand.randint(1, 100),
+                                       'rss': rand.randint(1, 100),
+                                       'flt': rand.randint(1, 100),
+                                       'file_size': rand.randint(1, 100)}
+                                for side in ['rep', 'ref']}}
+        PatchScore.create(cs=cs, round=round_, num_polls=1, perf_score=perf_score,
+                          patch_type=patch_type, has_failed_polls=rand.random() < 0.1)
+        cbn = ChallengeBinaryNode.create(name="benchmark", cs=cs, sha256=str(i),
+                                         blob=b"x" * rand.randint(100, 200),
+                                         patch_type=patch_type if i else None)
+        feedback = PollFeedback.create(cs=cs, round=round_, success=rand.random(), timeout=0,
+                                       connect=0, function=0, time_overhead=rand.random(),
+                                       memory_overhead=rand.random())
+        ChallengeSetFielding.create(cs=cs, team=team, cbns=[cbn], available_round=round_,
+                                    poll_feedback=feedback)
+    return cs
+
+
+def bench(name, model, vectorised, cs):
+    def per_object():
+        return [o.cb_score for o in model.select().where(model.cs == cs).order_by(model.id)]
+
+    assert per_object() == list(vectorised(cs=cs)['cb_score'])
+    number = 3
+    object_time = timeit.timeit(per_object, number=number) / number
+    vectorised_time = timeit.timeit(lambda: vectorised(cs=cs), number=number) / number
+    print("{:14} per object {:8.3f}s  vectorised {:8.3f}s  speedup {:6.1f}x".format(
+        name, object_time, vectorised_time, object_time / vectorised_time))
+
+
+def main(args):
+    rows = int(args[0]) if args else 1000
+    with master_db.atomic() as transaction:
+        cs = populate(rows)
+        print("{} rows".format(rows))
+        bench("PatchScore", PatchScore, scoring.patch_scores, cs)
+        bench("PollFeedback", PollFeedback, scoring.poll_feedbacks, cs)
+        transaction.rollback()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
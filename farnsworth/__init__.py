@@ -11,6 +11,7 @@ from .log import LOG
 
 def tables():
     from farnsworth.models import (Bitmap,
+                                   Blob,
                                    CBPollPerformance,
                                    CSSubmissionCable,
                                    ChallengeBinaryNode,
@@ -43,6 +44,7 @@ def tables():
                                    TracerCache,
                                    ValidPoll)
     models = [Bitmap,
+              Blob,
               CBPollPerformance,
               ChallengeBinaryNode,
               ChallengeSet,
@@ -79,35 +81,113 @@ def tables():
                       CSSubmissionCable.cbns]
     return models + [tm.get_through_model() for tm in through_models]
 
+def _create_index(model, fields, unique=False):
+    """master_db.create_index(), unless the index exists already"""
+    fields = [model._meta.fields[name] for name in fields]
+    sql, params = master_db.compiler().create_index(model, fields, unique)
+    master_db.execute_sql(sql.replace(" INDEX ", " INDEX IF NOT EXISTS ", 1), params)
+
 def create_tables():
     LOG.debug("Creating tables...")
     master_db.create_tables(tables(), safe=True)
+    migrate()
+
+    LOG.debug("Creating patch types...")
+    from farnsworth.models import PatcherexJob, PatchType
+    existing = {pt.name for pt in PatchType.select(PatchType.name)}
+    for name, (func_risk, exploitability) in PatcherexJob.PATCH_TYPES.items():
+        if name not in existing:
+            PatchType.create(name=name, functionality_risk=func_risk, exploitability=exploitability)
 
+def migrate():
+    """
+    Bring the tables of an older version up to date: add the columns, indexes
+    and database objects introduced since, and fill them. It can run any
+    number of times, create_tables() runs it on new tables too.
+    """
+    LOG.debug("Migrating tables...")
     from farnsworth.models import (ChallengeBinaryNode,
+                                   ChallengeSet,
                                    ChallengeSetFielding,
                                    Crash,
                                    ExploitSubmissionCable,
                                    IDSRule,
                                    IDSRuleFielding,
+                                   Job,
                                    Test)
-    master_db.create_index(ChallengeBinaryNode, ['cs', 'name', 'sha256'], unique=True)
-    master_db.create_index(ChallengeSetFielding, ['cs', 'team', 'submission_round'], unique=True)
-    master_db.create_index(ChallengeSetFielding, ['cs', 'team', 'available_round'], unique=True)
-    master_db.create_index(Crash, ['cs', 'sha256'], unique=True)
-    master_db.create_index(Test, ['cs', 'sha256'], unique=True)
-    master_db.create_index(ChallengeSetFielding, ['sha256'])
-    master_db.create_index(ChallengeBinaryNode, ['sha256'])
-    master_db.create_index(Crash, ['sha256'])
-    master_db.create_index(IDSRule, ['sha256'])
-    master_db.create_index(IDSRuleFielding, ['sha256'])
-    master_db.create_index(Test, ['sha256'])
-    master_db.create_index(ExploitSubmissionCable, ['round', 'cs', 'team'], unique=True)
+    from farnsworth.models.job import PRIORITY_AGING
 
-    LOG.debug("Creating patch types...")
-    from farnsworth.models import PatcherexJob, PatchType
-    for name, (func_risk, exploitability) in PatcherexJob.PATCH_TYPES.items():
-        PatchType.create(name=name, functionality_risk=func_risk, exploitability=exploitability)
+    # Blobs used to be kept in bytea columns, see blobstore.migrate_blob_columns()
+    from .blobstore import migrate_blob_columns
+    migrate_blob_columns(tables())
+
+    # De-duplication of Job.bulk_enqueue()
+    master_db.execute_sql("ALTER TABLE jobs ADD COLUMN IF NOT EXISTS payload_hash CHAR(64)")
+    # Job leases, see Job.reap_expired()
+    master_db.execute_sql("ALTER TABLE jobs ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP")
+
+    _create_index(ChallengeBinaryNode, ['cs', 'name', 'sha256'], unique=True)
+    _create_index(ChallengeSetFielding, ['cs', 'team', 'submission_round'], unique=True)
+    _create_index(ChallengeSetFielding, ['cs', 'team', 'available_round'], unique=True)
+    _create_index(Crash, ['cs', 'sha256'], unique=True)
+    _create_index(Test, ['cs', 'sha256'], unique=True)
+    _create_index(ChallengeSetFielding, ['sha256'])
+    _create_index(ChallengeBinaryNode, ['sha256'])
+    _create_index(Crash, ['sha256'])
+    _create_index(IDSRule, ['sha256'])
+    _create_index(IDSRuleFielding, ['sha256'])
+    _create_index(Test, ['sha256'])
+    _create_index(ExploitSubmissionCable, ['round', 'cs', 'team'], unique=True)
+    _create_index(Job, ['worker', 'payload_hash'], unique=True)
+
+    # Blobs stored before compression was introduced are raw, see blobstore.compress_blobs()
+    master_db.execute_sql("ALTER TABLE blobs "
+                          "ADD COLUMN IF NOT EXISTS codec VARCHAR(8) NOT NULL DEFAULT 'raw'")
+    # Uncompressed (by postgres) out-of-line storage, so that substring() reads only fetch the chunks needed
+    master_db.execute_sql("ALTER TABLE blobs ALTER COLUMN data SET STORAGE EXTERNAL")
+
+    # Original CBNs are flagged when fieldings change, see ChallengeSet.flag_originals()
+    master_db.execute_sql("ALTER TABLE challenge_binary_nodes "
+                          "ADD COLUMN IF NOT EXISTS is_original BOOLEAN NOT NULL DEFAULT FALSE")
+    master_db.execute_sql("CREATE INDEX IF NOT EXISTS challenge_binary_nodes_original_cs_id "
+                          "ON challenge_binary_nodes (cs_id) WHERE is_original")
+    ChallengeSet.flag_originals()
+
+    # Commit order of test cases, see Test.since()
+    master_db.execute_sql("DROP INDEX IF EXISTS tests_cs_id_id")
+    Test.create_commit_seq()
+
+    # Per-CS lookups in feedback JSON, see ChallengeSet._feedback()
+    for column in ['polls', 'cbs', 'povs']:
+        master_db.execute_sql("CREATE INDEX IF NOT EXISTS feedbacks_{0} "
+                              "ON feedbacks USING GIN ({0} jsonb_path_ops)".format(column))
+
+    # Partial indexes for the job queue, peewee cannot express the WHERE clause
+    master_db.execute_sql("CREATE INDEX IF NOT EXISTS jobs_unstarted_worker_priority "
+                          "ON jobs (worker, priority DESC, id) WHERE started_at IS NULL")
+    master_db.execute_sql("CREATE INDEX IF NOT EXISTS jobs_unstarted_worker_aged_priority "
+                          "ON jobs (worker, (priority - date_part('epoch', created_at) / {}) DESC, id) "
+                          "WHERE started_at IS NULL".format(PRIORITY_AGING))
+    master_db.execute_sql("CREATE INDEX IF NOT EXISTS jobs_unstarted_worker_cs_id "
+                          "ON jobs (worker, cs_id) WHERE started_at IS NULL")
+    master_db.execute_sql("CREATE INDEX IF NOT EXISTS jobs_uncompleted_worker_cs_id "
+                          "ON jobs (worker, cs_id) WHERE completed_at IS NULL")
+    master_db.execute_sql("CREATE INDEX IF NOT EXISTS jobs_uncompleted_lease_expires_at "
+                          "ON jobs (lease_expires_at) WHERE completed_at IS NULL")
+
+    from .notify import create_trigger
+    create_trigger()
+
+    from . import metrics
+    metrics.create_objects()
+
+    from . import scoring
+    scoring.create_objects()
 
 def drop_tables():
     LOG.debug("Dropping tables...")
+    from . import metrics
+    metrics.drop_objects()
+    from . import scoring
+    scoring.drop_objects()
     master_db.drop_tables(tables(), safe=True, cascade=True)
@@ -11,7 +11,7 @@ import farnsworth.log
 LOG = farnsworth.log.LOG.getChild('main')
 
 import farnsworth.config
-from . import create_tables, drop_tables
+from . import create_tables, drop_tables, migrate, tables
 
 
 def main(args=None):
@@ -24,10 +24,31 @@ def main(args=None):
             LOG.debug("Setting up database tables")
             create_tables()
             return 0
+        elif args[1] == 'migrate':
+            LOG.debug("Migrating database tables")
+            migrate()
+            return 0
         elif args[1] == 'drop':
             LOG.debug("Dropping database tables")
             drop_tables()
             return 0
+        elif args[1] == 'repair-sha256':
+            from .models.crash import Crash
+            from .models.test import Test
+            for model in (Test, Crash):
+                fixed, merged = model.repair_sha256()
+                LOG.info("%s: fixed %d sha256, merged %d duplicates",
+                         model.__name__, fixed, merged)
+            return 0
+        elif args[1] == 'compress-blobs':
+            from .blobstore import compress_blobs
+            codec = args[2] if args[2:] else None
+            LOG.info("Compressed %d blobs", compress_blobs(codec))
+            return 0
+        elif args[1] == 'gc':
+            from .blobstore import collect_garbage
+            LOG.info("Deleted %d unreferenced blobs", collect_garbage(tables()))
+            return 0
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,269 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+On-disk cache of blobs, shared by all processes of a node.
+
+Each blob is written once under blobs/<sha256>, atomically and under a file
+lock, and exposed under a readable name with a hard link in named/. Cached
+files are read-only, since every name shares the same inode; writable copies
+are made in copies/, outside of the size bound. Least recently used blobs are
+evicted when the cache grows over its maximum size, unless in use: blobs are
+used under a shared flock of their file, evicted under an exclusive one.
+
+FARNSWORTH_CACHE_PATH sets the cache directory (~/.farnsworth-cache by default,
+AFL does not like /tmp), FARNSWORTH_CACHE_MAX_SIZE its maximum size in bytes.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+from contextlib import contextmanager
+import errno
+import fcntl
+import os
+import shutil
+import tempfile
+
+import farnsworth.log
+
+LOG = farnsworth.log.LOG.getChild('binary_cache')
+
+DEFAULT_MAX_SIZE = 10 * (1 << 30)
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+
+
+@contextmanager
+def _locked(path):
+    """Hold an exclusive lock on path, across processes"""
+    with open(path, 'a') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+class BinaryCache(object):
+    """Size-bounded LRU cache of blobs materialised on disk."""
+
+    def __init__(self, root, max_size=DEFAULT_MAX_SIZE):
+        self.root = root
+        self.max_size = max_size
+        self.blobs_dir = os.path.join(root, 'blobs')
+        self.named_dir = os.path.join(root, 'named')
+        self.copies_dir = os.path.join(root, 'copies')
+
+    def blob_path(self, sha256):
+        """Return the path a blob is cached at"""
+        return os.path.join(self.blobs_dir, sha256[:2], sha256)
+
+    def named_path(self, name):
+        """Return the path a blob is exposed at under name"""
+        return os.path.join(self.named_dir, name)
+
+    def path(self, sha256, opener, name=None, mode=0o444):
+        """
+        Materialise a blob in the cache, unless already there, and return its path.
+
+        :param sha256: sha256 of the blob.
+        :param opener: callable returning a file object over the blob, only
+                       called on cache miss.
+        :param name: expose the blob under this file name, with a hard link.
+        :param mode: permissions of the cached file, it must stay read-only.
+        :return: path to the cached blob.
+        """
+        with self._shared(sha256, opener, mode):
+            blob_path = self.blob_path(sha256)
+            if name is None:
+                return blob_path
+            named_path = self.named_path(name)
+            try:
+                linked = os.stat(named_path).st_ino == os.stat(blob_path).st_ino
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+                linked = False
+            if not linked:
+                _makedirs(self.named_dir)
+                tmp_path = os.path.join(self.named_dir, ".{}.{}".format(name, os.getpid()))
+                if os.path.lexists(tmp_path):
+                    os.remove(tmp_path)
+                os.link(blob_path, tmp_path)
+                os.rename(tmp_path, named_path)
+            return named_path
+
+    def copy(self, sha256, opener, name, mode=0o755):
+        """
+        Return the path of a fresh, writable copy of a blob, not linked to the
+        cache. The copy replaces any previous one under the same name.
+
+        :param sha256: sha256 of the blob.
+        :param opener: callable returning a file object over the blob, only
+                       called on cache miss.
+        :param name: file name of the copy.
+        :param mode: permissions of the copy.
+        :return: path to the copy.
+        """
+        _makedirs(self.copies_dir)
+        copy_path = os.path.join(self.copies_dir, name)
+        fd, tmp_path = tempfile.mkstemp(dir=self.copies_dir, prefix='.')
+        try:
+            with os.fdopen(fd, 'wb') as fp, self._shared(sha256, opener, 0o444) as blob_fp:
+                shutil.copyfileobj(blob_fp, fp)
+            os.chmod(tmp_path, mode)
+            os.rename(tmp_path, copy_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return copy_path
+
+    @contextmanager
+    def _shared(self, sha256, opener, mode):
+        """
+        Open a blob, materialised first on cache miss, and hold a shared lock
+        on it: evict() leaves it alone meanwhile.
+
+        :return: the cached file, opened for reading.
+        """
+        blob_path = self.blob_path(sha256)
+        while True:
+            try:
+                fp = open(blob_path, 'rb')
+            except IOError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+                self._materialise(blob_path, opener, mode)
+                continue
+            with fp:
+                fcntl.flock(fp, fcntl.LOCK_SH)
+                if os.fstat(fp.fileno()).st_nlink > 0:  # else evicted before we got the lock
+                    os.utime(blob_path, None)   # most recently used
+                    yield fp
+                    return
+
+    def _materialise(self, blob_path, opener, mode):
+        blob_dir = os.path.dirname(blob_path)
+        _makedirs(blob_dir)
+        with _locked(os.path.join(blob_dir, '.lock')):
+            if os.path.isfile(blob_path):   # written by another process meanwhile
+                return
+            fd, tmp_path = tempfile.mkstemp(dir=blob_dir, prefix='.')
+            try:
+                with os.fdopen(fd, 'wb') as fp, opener() as blob_fp:
+                    shutil.copyfileobj(blob_fp, fp)
+                os.chmod(tmp_path, mode)
+                os.rename(tmp_path, blob_path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+        if self.max_size is not None:
+            self.evict(keep=blob_path)
+
+    def remove_name(self, name):
+        """Remove the name of a blob, the blob itself stays cached"""
+        try:
+            os.remove(self.named_path(name))
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+
+    def evict(self, max_size=None, keep=None):
+        """
+        Remove least recently used blobs, and their names, until the cache
+        fits in max_size.
+
+        :param max_size: size in bytes, the cache max_size by default.
+        :param keep: path of a blob never to evict, e.g. the one just cached.
+        """
+        max_size = self.max_size if max_size is None else max_size
+        _makedirs(self.root)
+        with _locked(os.path.join(self.root, '.evict.lock')):
+            blobs = []
+            for dirpath, _, filenames in os.walk(self.blobs_dir):
+                for filename in filenames:
+                    if filename.startswith('.'):  # locks and files being written
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    blobs.append((stat.st_mtime, stat.st_size, stat.st_ino, path))
+            size = sum(blob[1] for blob in blobs)
+            if size <= max_size:
+                return
+
+            names = {}
+            if os.path.isdir(self.named_dir):
+                for filename in os.listdir(self.named_dir):
+                    if filename.startswith('.'):  # links being made, count as in use
+                        continue
+                    path = os.path.join(self.named_dir, filename)
+                    try:
+                        names.setdefault(os.stat(path).st_ino, []).append(path)
+                    except OSError:
+                        continue
+
+            for _, blob_size, inode, path in sorted(blobs):
+                if size <= max_size:
+                    break
+                if path != keep and self._evict_blob(path, names.get(inode, [])):
+                    size -= blob_size
+
+    @staticmethod
+    def _evict_blob(path, names):
+        """
+        Remove a blob and its names, unless in use.
+
+        :return: True if the blob was removed.
+        """
+        try:
+            fp = open(path, 'rb')
+        except IOError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            return False
+        with fp:
+            try:
+                fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as error:
+                if error.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return False
+            if os.fstat(fp.fileno()).st_nlink > 1 + len(names):    # linked elsewhere
+                return False
+            LOG.debug("Evicting %s", path)
+            for evicted_path in [path] + names:
+                try:
+                    os.remove(evicted_path)
+                except OSError as error:
+                    if error.errno != errno.ENOENT:
+                        raise
+            return True
+
+
+_CACHE = None
+
+
+def get_cache():
+    """Return the binary cache of this node"""
+    global _CACHE   # pylint:disable=global-statement
+    if _CACHE is None:
+        root = os.environ.get('FARNSWORTH_CACHE_PATH',
+                              os.path.join(os.path.expanduser("~"), '.farnsworth-cache'))
+        max_size = int(os.environ.get('FARNSWORTH_CACHE_MAX_SIZE', DEFAULT_MAX_SIZE))
+        _CACHE = BinaryCache(root, max_size)
+    return _CACHE
+
+
+def set_cache(cache):
+    """Replace the binary cache, e.g. to move it elsewhere"""
+    global _CACHE   # pylint:disable=global-statement
+    _CACHE = cache
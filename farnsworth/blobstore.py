@@ -0,0 +1,482 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Content-addressed blob store.
+
+Blobs are stored once, keyed by the sha256 of their content. Models refer to
+them with a BlobRefField, see farnsworth.peewee_extensions.
+
+The store is the blobs table by default. Set FARNSWORTH_BLOBSTORE_PATH to keep
+blobs on a (shared) filesystem instead.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+from datetime import timedelta
+import errno
+import hashlib
+import io
+import os
+import tempfile
+import time
+
+import psycopg2
+
+CHUNK_SIZE = 1 << 20    # bytes read or written at once when streaming
+GC_GRACE = timedelta(days=1)        # unreferenced blobs stored (or put again) since are kept
+TOUCH_INTERVAL = timedelta(hours=1) # putting a blob again refreshes its age at most this often
+
+
+def to_bytes(data):
+    """Return data as bytes, unicode is taken as latin-1 like for peewee BlobFields"""
+    if isinstance(data, unicode):
+        return data.encode('raw_unicode_escape')
+    return bytes(data)
+
+
+def sha256sum(data):
+    """Return the key of data in the store"""
+    return hashlib.sha256(to_bytes(data)).hexdigest()
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+
+
+class BlobStore(object):
+    """Interface of blob store backends."""
+
+    def put(self, data, sha256=None):
+        """
+        Store data, unless already stored.
+
+        :param sha256: sha256 of data, when already known.
+        :return: sha256 of data.
+        """
+        raise NotImplementedError()
+
+    def put_many(self, datas, sha256s=None):
+        """
+        Store many blobs, skipping the ones already stored.
+
+        :param sha256s: sha256 of each data, when already known.
+        :return: list of sha256, one per data.
+        """
+        sha256s = sha256s or [None] * len(datas)
+        return [self.put(data, sha256) for data, sha256 in zip(datas, sha256s)]
+
+    def get(self, sha256):
+        """
+        Return the data stored under sha256.
+
+        :raise KeyError: if there is no such blob.
+        """
+        raise NotImplementedError()
+
+    def get_many(self, sha256s):
+        """Return a dict sha256 => data of the blobs found"""
+        blobs = {}
+        for sha256 in set(sha256s):
+            try:
+                blobs[sha256] = self.get(sha256)
+            except KeyError:
+                pass
+        return blobs
+
+    def exists(self, sha256):
+        """Check if a blob is stored under sha256"""
+        raise NotImplementedError()
+
+    def open(self, sha256):
+        """
+        Return a read-only binary file object over the blob stored under sha256.
+
+        :raise KeyError: if there is no such blob.
+        """
+        return io.BytesIO(self.get(sha256))
+
+    def put_file(self, fp):
+        """
+        Store the content of a file object, unless already stored.
+
+        :return: sha256 of the content.
+        """
+        return self.put(fp.read())
+
+    def collect_garbage(self, columns, grace=GC_GRACE):
+        """
+        Delete the blobs referenced by none of columns, and neither stored
+        nor put again within grace.
+
+        :param columns: list of (table, column) holding sha256s.
+        :return: number of blobs deleted.
+        """
+        raise NotImplementedError()
+
+
+class PostgresBlobStore(BlobStore):
+    """Keep blobs in the blobs table of the master database."""
+
+    @staticmethod
+    def _stored(sha256s):
+        """
+        Return the sha256s already stored, refreshing the age of the ones
+        not touched for TOUCH_INTERVAL, so that collect_garbage() keeps them.
+        """
+        from .models.blob import Blob
+        cursor = Blob._meta.database.execute_sql("""
+            WITH stored AS (SELECT sha256, updated_at FROM {0} WHERE sha256 = ANY(%s::bpchar[])),
+                 touched AS (UPDATE {0} SET updated_at = now() FROM stored
+                             WHERE {0}.sha256 = stored.sha256
+                               AND stored.updated_at < now() - %s)
+            SELECT sha256 FROM stored""".format(Blob._meta.db_table),
+            (list(set(sha256s)), TOUCH_INTERVAL))
+        return set(sha256 for sha256, in cursor.fetchall())
+
+    def put(self, data, sha256=None):
+        from .models.blob import Blob
+        sha256 = sha256 or sha256sum(data)
+        if sha256 not in self._stored([sha256]):
+            codec, stored = Blob.data.compress(data)
+            Blob._meta.database.execute_sql(
+                "INSERT INTO {} (created_at, updated_at, sha256, size, codec, data) "
+                "VALUES (now(), now(), %s, %s, %s, %s) "
+                "ON CONFLICT (sha256) DO NOTHING".format(Blob._meta.db_table),
+                (sha256, len(data), codec, psycopg2.Binary(stored)))
+        return sha256
+
+    def put_many(self, datas, sha256s=None):
+        from .models.blob import Blob
+        sha256s = sha256s or [sha256sum(data) for data in datas]
+        if not sha256s:
+            return []
+        stored = self._stored(sha256s)
+        rows = {}
+        for data, sha256 in zip(datas, sha256s):
+            if sha256 not in stored and sha256 not in rows:
+                codec, compressed = Blob.data.compress(data)
+                rows[sha256] = (sha256, len(data), codec, psycopg2.Binary(compressed))
+        if rows:
+            Blob._meta.database.execute_sql(
+                "INSERT INTO {} (created_at, updated_at, sha256, size, codec, data) "
+                "VALUES {} ON CONFLICT (sha256) DO NOTHING".format(
+                    Blob._meta.db_table,
+                    ", ".join(["(now(), now(), %s, %s, %s, %s)"] * len(rows))),
+                [param for row in rows.values() for param in row])
+        return sha256s
+
+    def get(self, sha256):
+        try:
+            return self.get_many([sha256])[sha256]
+        except KeyError:
+            raise KeyError("No blob {}".format(sha256))
+
+    def get_many(self, sha256s):
+        from peewee import SelectQuery
+        from .models.blob import Blob
+        sha256s = list(set(sha256s))
+        if not sha256s:
+            return {}
+        # always on master, a slave may not have received the blob yet
+        query = SelectQuery(Blob, Blob.sha256, Blob.codec, Blob.data) \
+                    .where(Blob.sha256 << sha256s).tuples()
+        return {sha256: Blob.data.decompress(codec, data) for sha256, codec, data in query}
+
+    def exists(self, sha256):
+        from peewee import SelectQuery
+        from .models.blob import Blob
+        return SelectQuery(Blob, Blob.sha256).where(Blob.sha256 == sha256).exists()
+
+    def open(self, sha256):
+        from peewee import SelectQuery, fn
+        from .models.blob import Blob
+        from .peewee_extensions import CODECS
+        row = SelectQuery(Blob, Blob.codec, fn.octet_length(Blob.data).coerce(False)) \
+                  .where(Blob.sha256 == sha256).tuples().first()
+        if row is None:
+            raise KeyError("No blob {}".format(sha256))
+        codec, stored_size = row
+        stored_fp = io.BufferedReader(_PostgresBlobReader(sha256, stored_size), CHUNK_SIZE)
+        if codec == 'raw':
+            return stored_fp
+        return io.BufferedReader(_DecompressingReader(stored_fp, CODECS[codec]), CHUNK_SIZE)
+
+    def collect_garbage(self, columns, grace=GC_GRACE):
+        from .models.blob import Blob
+        cursor = Blob._meta.database.execute_sql(
+            "DELETE FROM {} AS b WHERE updated_at < now() - %s {}".format(
+                Blob._meta.db_table,
+                "".join(" AND NOT EXISTS (SELECT 1 FROM {} WHERE {} = b.sha256)".format(table, column)
+                        for table, column in columns)),
+            (grace,))
+        return cursor.rowcount
+
+
+class _PostgresBlobReader(io.RawIOBase):
+    """Read a blob of the blobs table with ranged substring() queries"""
+
+    def __init__(self, sha256, size):
+        super(_PostgresBlobReader, self).__init__()
+        self.sha256 = sha256
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def readinto(self, buf):
+        from .models.blob import Blob
+        length = min(len(buf), self.size - self.position)
+        if length <= 0:
+            return 0
+        cursor = Blob._meta.database.execute_sql(
+            "SELECT substring(data FROM %s FOR %s) FROM {} WHERE sha256 = %s".format(
+                Blob._meta.db_table),
+            (self.position + 1, length, self.sha256), require_commit=False)
+        data = cursor.fetchone()[0]
+        buf[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+class _DecompressingReader(io.RawIOBase):
+    """Decompress a file object on the fly"""
+
+    def __init__(self, fp, codec):
+        super(_DecompressingReader, self).__init__()
+        self.fp = fp
+        self.decompressor = codec.decompressobj()
+        self.pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while not self.pending:
+            chunk = self.fp.read(CHUNK_SIZE)
+            if not chunk:
+                self.pending = getattr(self.decompressor, 'flush', lambda: b"")()
+                break
+            self.pending = self.decompressor.decompress(chunk)
+        length = min(len(buf), len(self.pending))
+        buf[:length] = self.pending[:length]
+        self.pending = self.pending[length:]
+        return length
+
+
+def compress_blobs(codec=None, batch_size=100):
+    """
+    Compress the blobs stored raw in the blobs table, e.g. the ones stored
+    before compression was introduced, or stored with another codec.
+
+    :param codec: codec to compress with, the Blob.data codec by default.
+    :param batch_size: number of blobs compressed per transaction.
+    :return: number of blobs compressed.
+    """
+    from peewee import SelectQuery
+    from .models.blob import Blob
+    codec = codec or Blob.data.codec
+    compressed, last_sha256 = 0, ""
+    while True:
+        with Blob._meta.database.atomic():
+            rows = list(SelectQuery(Blob, Blob.sha256, Blob.codec, Blob.data)
+                        .where((Blob.codec != codec) & (Blob.sha256 > last_sha256))
+                        .order_by(Blob.sha256).limit(batch_size).for_update().tuples())
+            for sha256, stored_codec, data in rows:
+                new_codec, stored = Blob.data.compress(Blob.data.decompress(stored_codec, data),
+                                                       codec)
+                if new_codec != stored_codec:
+                    Blob.update(codec=new_codec, data=stored).where(Blob.sha256 == sha256).execute()
+                    compressed += 1
+        if len(rows) < batch_size:
+            return compressed
+        last_sha256 = rows[-1][0]
+
+
+def migrate_blob_columns(models, batch_size=100):
+    """
+    Move the blobs of the bytea columns of older versions, named after their
+    BlobRefField, to the store, and replace the columns with the references.
+
+    :param models: models to migrate, e.g. farnsworth.tables().
+    :param batch_size: number of rows migrated per transaction.
+    :return: number of rows migrated.
+    """
+    from .config import master_db
+    from .peewee_extensions import BlobRefField
+    migrated = 0
+    for model in models:
+        table = model._meta.db_table
+        for name, field in model._meta.fields.items():
+            if not isinstance(field, BlobRefField) or field.db_column == name:
+                continue
+            cursor = master_db.execute_sql(
+                "SELECT 1 FROM information_schema.columns "
+                "WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s "
+                "AND data_type = 'bytea'", (table, name))
+            if cursor.fetchone() is None:
+                continue
+            master_db.execute_sql("ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} CHAR(64)"
+                                  .format(table, field.db_column))
+            last_id = 0
+            while True:
+                with master_db.atomic():
+                    rows = master_db.execute_sql(
+                        "SELECT id, {0} FROM {1} WHERE id > %s AND {0} IS NOT NULL "
+                        "ORDER BY id LIMIT %s".format(name, table),
+                        (last_id, batch_size)).fetchall()
+                    datas = [to_bytes(data) for _, data in rows]
+                    sha256s = get_store().put_many(datas)
+                    for (id_, _), sha256 in zip(rows, sha256s):
+                        master_db.execute_sql("UPDATE {} SET {} = %s WHERE id = %s"
+                                              .format(table, field.db_column), (sha256, id_))
+                migrated += len(rows)
+                if len(rows) < batch_size:
+                    break
+                last_id = rows[-1][0]
+            master_db.execute_sql("ALTER TABLE {} DROP COLUMN {}".format(table, name))
+            if not field.null:
+                master_db.execute_sql("ALTER TABLE {} ALTER COLUMN {} SET NOT NULL"
+                                      .format(table, field.db_column))
+    return migrated
+
+
+def collect_garbage(models, grace=GC_GRACE):
+    """
+    Delete the blobs of the store referenced by no row: mark and sweep over
+    the BlobRefFields of models. Blobs stored or put again within grace are
+    kept, their rows may not be inserted yet.
+
+    :param models: models referencing blobs, e.g. farnsworth.tables().
+    :param grace: timedelta.
+    :return: number of blobs deleted.
+    """
+    from .peewee_extensions import BlobRefField
+    columns = [(model._meta.db_table, field.db_column)
+               for model in models for field in model._meta.fields.values()
+               if isinstance(field, BlobRefField)]
+    return get_store().collect_garbage(columns, grace)
+
+
+class FilesystemBlobStore(BlobStore):
+    """Keep blobs as files named after their sha256 under root."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, sha256):
+        """Return the path of the file holding a blob"""
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def put(self, data, sha256=None):
+        if sha256 is not None and self.exists(sha256):
+            self._touch(sha256)
+            return sha256
+        return self.put_file(io.BytesIO(data))
+
+    def _touch(self, sha256):
+        """Refresh the age of a blob put again, so that collect_garbage() keeps it"""
+        try:
+            os.utime(self.path(sha256), None)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+
+    def put_file(self, fp):
+        # write aside while hashing, then rename: readers never see a partial blob
+        _makedirs(self.root)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root)
+        try:
+            digest = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as tmp_fp:
+                for chunk in iter(lambda: fp.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    tmp_fp.write(chunk)
+            sha256 = digest.hexdigest()
+            path = self.path(sha256)
+            _makedirs(os.path.dirname(path))
+            if os.path.isfile(path):
+                os.remove(tmp_path)
+                self._touch(sha256)
+            else:
+                os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return sha256
+
+    def get(self, sha256):
+        with self.open(sha256) as fp:
+            return fp.read()
+
+    def open(self, sha256):
+        try:
+            return open(self.path(sha256), 'rb')
+        except IOError as error:
+            if error.errno == errno.ENOENT:
+                raise KeyError("No blob {}".format(sha256))
+            raise
+
+    def exists(self, sha256):
+        return os.path.isfile(self.path(sha256))
+
+    def collect_garbage(self, columns, grace=GC_GRACE):
+        from .config import master_db
+        referenced = set()
+        for table, column in columns:
+            cursor = master_db.execute_sql("SELECT DISTINCT {0} FROM {1} WHERE {0} IS NOT NULL"
+                                           .format(column, table))
+            referenced.update(sha256.strip() for sha256, in cursor.fetchall())
+        deleted, horizon = 0, time.time() - grace.total_seconds()
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                if len(name) != 64 or name in referenced or os.path.getmtime(path) >= horizon:
+                    continue    # in use, recent, or a put_file() in progress
+                try:
+                    os.remove(path)
+                    deleted += 1
+                except OSError as error:
+                    if error.errno != errno.ENOENT:
+                        raise
+        return deleted
+
+
+_STORE = None
+
+
+def get_store():
+    """Return the configured blob store"""
+    global _STORE   # pylint:disable=global-statement
+    if _STORE is None:
+        if os.environ.get('FARNSWORTH_BLOBSTORE_PATH'):
+            _STORE = FilesystemBlobStore(os.environ['FARNSWORTH_BLOBSTORE_PATH'])
+        else:
+            _STORE = PostgresBlobStore()
+    return _STORE
+
+
+def set_store(store):
+    """Replace the blob store, e.g. with a custom backend"""
+    global _STORE   # pylint:disable=global-statement
+    _STORE = store
@@ -0,0 +1,67 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Minimal reader of ELF section headers, enough to locate sections in a
+binary without copying it.
+
+CGC binaries are ELF32 files with a \\x7fCGC magic, they are read the same way.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+from collections import namedtuple
+import struct
+
+MAGICS = (b"\x7fELF", b"\x7fCGC")
+SHT_NOBITS = 8
+
+Section = namedtuple('Section', ['name', 'type', 'addr', 'offset', 'size'])
+
+# EI_CLASS => (ELF header size, offset and format of e_shoff, offset of e_shentsize,
+#              section header format)
+_LAYOUTS = {
+    1: (0x34, 0x20, 'I', 0x2e, 'IIIIII'),
+    2: (0x40, 0x28, 'Q', 0x3a, 'IIQQQQ'),
+}
+
+
+def sections(data):
+    """
+    Return the sections of an ELF or CGC binary.
+
+    :param data: the binary, a string or a memory map.
+    :return: list of Section, in section header table order.
+    """
+    if len(data) < 16 or data[:4] not in MAGICS:   # e_ident
+        raise ValueError("Not an ELF binary")
+    ei_class, ei_data = struct.unpack_from('BB', data, 4)
+    if ei_class not in _LAYOUTS or ei_data not in (1, 2):
+        raise ValueError("Unsupported ELF class {} or data encoding {}".format(ei_class, ei_data))
+    ehsize, shoff_offset, shoff_format, shentsize_offset, header_format = _LAYOUTS[ei_class]
+    if len(data) < ehsize:
+        raise ValueError("Truncated ELF header")
+    endian = '<' if ei_data == 1 else '>'
+
+    shoff, = struct.unpack_from(endian + shoff_format, data, shoff_offset)
+    shentsize, shnum, shstrndx = struct.unpack_from(endian + 'HHH', data, shentsize_offset)
+    if shoff == 0 or shnum == 0:
+        return []
+    if shentsize < struct.calcsize(endian + header_format):
+        raise ValueError("Invalid section header size {}".format(shentsize))
+    if shoff + shnum * shentsize > len(data):
+        raise ValueError("Truncated section header table")
+
+    headers = [struct.unpack_from(endian + header_format, data, shoff + i * shentsize)
+               for i in range(shnum)]
+    strtab_offset = headers[shstrndx][4] if shstrndx < shnum else None
+
+    result = []
+    for sh_name, sh_type, _, sh_addr, sh_offset, sh_size in headers:
+        name = ""
+        if strtab_offset is not None and strtab_offset + sh_name < len(data):
+            start = strtab_offset + sh_name
+            end = data.find(b"\x00", start)
+            name = data[start:end if end != -1 else len(data)].decode('ascii', 'replace')
+        result.append(Section(name, sh_type, sh_addr, sh_offset, sh_size))
+    return result
@@ -0,0 +1,201 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Fast ingest with COPY FROM STDIN, in binary format.
+
+Meant for the bursts of RawRoundTraffic, RawRoundPoll and ValidPoll rows at
+every round, e.g.:
+
+    from farnsworth.ingest import copy_insert
+    ids = copy_insert(RawRoundTraffic, ({'round': round_, 'pickled_data': data}
+                                        for data in captures))
+
+Rows are read from the iterable and sent in batches, so memory stays bounded
+by the batch size whatever the number of rows.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+from datetime import datetime
+import io
+import itertools
+import struct
+
+from .blobstore import PostgresBlobStore, get_store, sha256sum, to_bytes
+from .peewee_extensions import BlobRef, BlobRefField
+
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00" + struct.pack('>ii', 0, 0)
+POSTGRES_EPOCH = datetime(2000, 1, 1)
+
+
+def _encode_int(value):
+    return struct.pack('>i', value)
+
+
+def _encode_bigint(value):
+    return struct.pack('>q', value)
+
+
+def _encode_bool(value):
+    return b"\x01" if value else b"\x00"
+
+
+def _encode_float(value):
+    return struct.pack('>d', value)
+
+
+def _encode_datetime(value):
+    delta = value - POSTGRES_EPOCH
+    return struct.pack('>q', (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+
+def _encode_text(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else bytes(value)
+
+
+# peewee db_field => binary COPY encoder
+ENCODERS = {
+    'primary_key': _encode_int,
+    'int': _encode_int,
+    'bigint': _encode_bigint,
+    'bool': _encode_bool,
+    'float': _encode_float,
+    'double': _encode_float,
+    'datetime': _encode_datetime,
+    'string': _encode_text,
+    'fixed_char': _encode_text,
+    'text': _encode_text,
+    'blob': to_bytes,
+}
+
+
+def _encode_row(encoders, values):
+    parts = [struct.pack('>h', len(values))]
+    for encoder, value in zip(encoders, values):
+        if value is None:
+            parts.append(struct.pack('>i', -1))
+        else:
+            data = encoder(value)
+            parts.append(struct.pack('>i', len(data)))
+            parts.append(data)
+    return b"".join(parts)
+
+
+class _CopyStream(io.RawIOBase):
+    """File object over a COPY binary stream, encoded as it is read"""
+
+    def __init__(self, chunks):
+        super(_CopyStream, self).__init__()
+        self.chunks = itertools.chain([COPY_SIGNATURE], chunks, [struct.pack('>h', -1)])
+        self.pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while len(self.pending) < len(buf):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.pending += chunk
+        length = min(len(buf), len(self.pending))
+        buf[:length] = self.pending[:length]
+        self.pending = self.pending[length:]
+        return length
+
+
+def copy(database, table, fields, rows):
+    """
+    COPY rows into table, in binary format.
+
+    :param fields: peewee fields of the columns, in order.
+    :param rows: iterable of tuples of database values, one per field.
+    """
+    encoders = []
+    for field in fields:
+        db_field = field.get_db_field()
+        if db_field not in ENCODERS:
+            raise TypeError("Cannot COPY {} columns".format(db_field))
+        encoders.append(ENCODERS[db_field])
+    stream = _CopyStream(_encode_row(encoders, row) for row in rows)
+    sql = "COPY {} ({}) FROM STDIN WITH (FORMAT binary)".format(
+        table, ", ".join('"{}"'.format(field.db_column) for field in fields))
+    database.get_cursor().copy_expert(sql, io.BufferedReader(stream))
+
+
+def _copy_blobs(database, blobs):
+    """Store blobs in the blobs table through a staging table, skipping duplicates"""
+    from .models.blob import Blob
+    database.execute_sql("DROP TABLE IF EXISTS pg_temp.blobs_ingest")
+    database.execute_sql("CREATE TEMPORARY TABLE blobs_ingest "
+                         "(LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP".format(Blob._meta.db_table))
+    fields = [Blob.sha256, Blob.size, Blob.codec, Blob.data, Blob.created_at, Blob.updated_at]
+    now = datetime.now()
+
+    def rows():
+        for sha256, data in blobs.items():
+            codec, compressed = Blob.data.compress(data)
+            yield sha256, len(data), codec, compressed, now, now
+    copy(database, 'blobs_ingest', fields, rows())
+    database.execute_sql("INSERT INTO {0} SELECT * FROM blobs_ingest "
+                         "ON CONFLICT (sha256) DO NOTHING".format(Blob._meta.db_table))
+
+
+def copy_insert(model, rows, batch_size=1000):
+    """
+    Insert rows with COPY, in batches.
+
+    Blobs of BlobRefFields are stored first, through COPY too for the
+    Postgres blob store. Ids are allocated from the model sequence
+    beforehand, as COPY cannot return them.
+
+    :param model: model of the rows, e.g. RawRoundTraffic.
+    :param rows: iterable of dicts field name => value, like for insert_many().
+    :param batch_size: number of rows held in memory and sent per COPY.
+    :return: list of ids of the created rows, in order.
+    """
+    database = model._meta.database
+    fields = model._meta.sorted_fields
+    blob_fields = [field for field in fields if isinstance(field, BlobRefField)]
+    table = model._meta.db_table
+    store = get_store()
+
+    ids = []
+    rows = iter(rows)
+    with database.atomic():
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return ids
+
+            blobs = {}
+            for row in batch:
+                for field in blob_fields:
+                    value = row.get(field.name)
+                    if value is not None and not isinstance(value, BlobRef):
+                        data = to_bytes(value)
+                        sha256 = sha256sum(data)
+                        blobs[sha256] = data
+                        row[field.name] = BlobRef(sha256)
+            if blobs:
+                if isinstance(store, PostgresBlobStore):
+                    _copy_blobs(database, blobs)
+                else:
+                    store.put_many(list(blobs.values()), list(blobs.keys()))
+
+            cursor = database.execute_sql(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                (table, len(batch)))
+            batch_ids = [row[0] for row in cursor.fetchall()]
+
+            def values(batch=batch, batch_ids=batch_ids):
+                for id_, row in zip(batch_ids, batch):
+                    row = dict(row, id=id_)
+                    for field in fields:
+                        if field.name not in row and field.default is not None:
+                            row[field.name] = field.default() if callable(field.default) \
+                                              else field.default
+                    yield tuple(field.db_value(row.get(field.name)) for field in fields)
+            copy(database, table, fields, values())
+            ids.extend(batch_ids)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Job queue metrics.
+
+Counts are kept in job_queue_counters: a trigger appends the changes of each
+job transition to job_queue_counter_deltas, added to the counters by fold()
+(or refresh()). Reading them never scans jobs. Wait and run time percentiles
+live in the job_queue_timings materialized view, recomputed by refresh().
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+from .config import master_db, slave_db
+
+TIMINGS_WINDOW = '1 hour'   # only jobs started within this window are timed
+
+
+def create_objects():
+    """Create the counters tables, their triggers and the timings view"""
+    master_db.execute_sql("""
+        CREATE TABLE IF NOT EXISTS job_queue_counters (
+            worker VARCHAR(255) NOT NULL,
+            priority INTEGER NOT NULL,
+            pending BIGINT NOT NULL DEFAULT 0,
+            running BIGINT NOT NULL DEFAULT 0,
+            completed BIGINT NOT NULL DEFAULT 0,
+            claimed BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (worker, priority))""")
+    # Append-only, so that concurrent transitions never wait on a counter row
+    master_db.execute_sql("""
+        CREATE TABLE IF NOT EXISTS job_queue_counter_deltas (
+            worker VARCHAR(255) NOT NULL,
+            priority INTEGER NOT NULL,
+            pending BIGINT NOT NULL,
+            running BIGINT NOT NULL,
+            completed BIGINT NOT NULL,
+            claimed BIGINT NOT NULL)""")
+    master_db.execute_sql("TRUNCATE job_queue_counters, job_queue_counter_deltas")
+    master_db.execute_sql("""
+        INSERT INTO job_queue_counters (worker, priority, pending, running, completed, claimed)
+        SELECT worker, priority,
+               count(*) FILTER (WHERE started_at IS NULL AND completed_at IS NULL),
+               count(*) FILTER (WHERE started_at IS NOT NULL AND completed_at IS NULL),
+               count(*) FILTER (WHERE completed_at IS NOT NULL),
+               count(*) FILTER (WHERE started_at IS NOT NULL)
+        FROM jobs GROUP BY worker, priority""")
+
+    master_db.execute_sql("""
+        CREATE OR REPLACE FUNCTION count_job_transition() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                INSERT INTO job_queue_counter_deltas
+                    (worker, priority, pending, running, completed, claimed)
+                VALUES (OLD.worker, OLD.priority,
+                        -(OLD.started_at IS NULL AND OLD.completed_at IS NULL)::int,
+                        -(OLD.started_at IS NOT NULL AND OLD.completed_at IS NULL)::int,
+                        -(OLD.completed_at IS NOT NULL)::int,
+                        0);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO job_queue_counter_deltas
+                    (worker, priority, pending, running, completed, claimed)
+                VALUES (NEW.worker, NEW.priority,
+                        (NEW.started_at IS NULL AND NEW.completed_at IS NULL)::int,
+                        (NEW.started_at IS NOT NULL AND NEW.completed_at IS NULL)::int,
+                        (NEW.completed_at IS NOT NULL)::int,
+                        CASE WHEN TG_OP = 'INSERT' THEN (NEW.started_at IS NOT NULL)::int
+                             ELSE (OLD.started_at IS NULL AND NEW.started_at IS NOT NULL)::int
+                        END);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql""")
+    master_db.execute_sql("DROP TRIGGER IF EXISTS jobs_count_transition ON jobs")
+    master_db.execute_sql("""
+        CREATE TRIGGER jobs_count_transition
+        AFTER INSERT OR DELETE ON jobs
+        FOR EACH ROW EXECUTE PROCEDURE count_job_transition()""")
+    # save() sets every column, only count actual changes
+    master_db.execute_sql("DROP TRIGGER IF EXISTS jobs_count_update ON jobs")
+    master_db.execute_sql("""
+        CREATE TRIGGER jobs_count_update
+        AFTER UPDATE OF worker, priority, started_at, completed_at ON jobs
+        FOR EACH ROW
+        WHEN (OLD.worker IS DISTINCT FROM NEW.worker
+              OR OLD.priority IS DISTINCT FROM NEW.priority
+              OR OLD.started_at IS DISTINCT FROM NEW.started_at
+              OR OLD.completed_at IS DISTINCT FROM NEW.completed_at)
+        EXECUTE PROCEDURE count_job_transition()""")
+
+    master_db.execute_sql("CREATE INDEX IF NOT EXISTS jobs_started_at ON jobs (started_at)")
+    master_db.execute_sql("""
+        CREATE MATERIALIZED VIEW IF NOT EXISTS job_queue_timings AS
+        SELECT worker, priority,
+               percentile_cont(0.5) WITHIN GROUP (ORDER BY wait) AS wait_p50,
+               percentile_cont(0.95) WITHIN GROUP (ORDER BY wait) AS wait_p95,
+               percentile_cont(0.5) WITHIN GROUP (ORDER BY run) AS run_p50,
+               percentile_cont(0.95) WITHIN GROUP (ORDER BY run) AS run_p95
+        FROM (SELECT worker, priority,
+                     extract(epoch FROM started_at - created_at) AS wait,
+                     extract(epoch FROM completed_at - started_at) AS run
+              FROM jobs
+              WHERE started_at > now() - interval '{}') AS started_jobs
+        GROUP BY worker, priority""".format(TIMINGS_WINDOW))
+    master_db.execute_sql("CREATE UNIQUE INDEX IF NOT EXISTS job_queue_timings_worker_priority "
+                          "ON job_queue_timings (worker, priority)")
+
+
+def drop_objects():
+    """Drop the objects not removed along with the jobs table"""
+    master_db.execute_sql("DROP TABLE IF EXISTS job_queue_counters, job_queue_counter_deltas")
+
+
+def fold():
+    """
+    Add the pending deltas to the counters, and remove them. Only concurrent
+    calls of fold() wait on each other, job transitions never do.
+    """
+    master_db.execute_sql("""
+        WITH deltas AS (DELETE FROM job_queue_counter_deltas RETURNING *)
+        INSERT INTO job_queue_counters AS c
+            (worker, priority, pending, running, completed, claimed)
+        SELECT worker, priority, sum(pending), sum(running), sum(completed), sum(claimed)
+        FROM deltas GROUP BY worker, priority
+        ON CONFLICT (worker, priority) DO UPDATE SET
+            pending = c.pending + EXCLUDED.pending,
+            running = c.running + EXCLUDED.running,
+            completed = c.completed + EXCLUDED.completed,
+            claimed = c.claimed + EXCLUDED.claimed""")
+
+
+def refresh():
+    """Fold the counters and recompute the timings view, without blocking readers"""
+    fold()
+    master_db.execute_sql("REFRESH MATERIALIZED VIEW CONCURRENTLY job_queue_timings")
+
+
+def _read(sql, worker=None, group_by=""):
+    database = slave_db if slave_db is not None else master_db
+    params = []
+    if worker is not None:
+        sql += " WHERE worker = %s"
+        params.append(worker)
+    cursor = database.execute_sql(sql + " {} ORDER BY worker, priority DESC".format(group_by),
+                                  params, require_commit=False)
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def counts(worker=None):
+    """
+    Return the number of pending, running and completed jobs, and the total
+    number of jobs ever claimed, per worker type and priority.
+    Sample claimed over time to get the claim rate.
+
+    :param worker: only return counts for this worker type.
+    :return: list of dicts, one per worker type and priority.
+    """
+    return _read("SELECT worker, priority, sum(pending)::BIGINT AS pending, "
+                 "sum(running)::BIGINT AS running, sum(completed)::BIGINT AS completed, "
+                 "sum(claimed)::BIGINT AS claimed "
+                 "FROM (SELECT * FROM job_queue_counters "
+                 "UNION ALL SELECT * FROM job_queue_counter_deltas) AS c", worker,
+                 "GROUP BY worker, priority")
+
+
+def timings(worker=None):
+    """
+    Return p50/p95 wait (started_at - created_at) and run (completed_at -
+    started_at) times in seconds, per worker type and priority, as of the
+    last refresh().
+
+    :param worker: only return timings for this worker type.
+    :return: list of dicts, one per worker type and priority.
+    """
+    return _read("SELECT worker, priority, wait_p50, wait_p95, run_p50, run_p95 "
+                 "FROM job_queue_timings", worker)
@@ -9,6 +9,7 @@ import farnsworth.log
 """Farnsworth models"""
 
 from .bitmap import Bitmap
+from .blob import Blob
 from .cb_poll_performance import CBPollPerformance
 from .challenge_binary_node import ChallengeBinaryNode
 from .challenge_set import ChallengeSet
@@ -4,12 +4,15 @@
 from __future__ import absolute_import, unicode_literals
 
 from datetime import datetime
+import io
 
 from peewee import Model, DateTimeField
 from playhouse.read_slave import ReadSlaveModel
 
 from ..config import master_db, slave_db
-from ..utils import table_name
+from ..blobstore import get_store, sha256sum, to_bytes
+from ..peewee_extensions import BlobRef, BlobRefField, BlobSelectQuery
+from ..utils import invalidate_cached_properties, table_name
 
 """Base model class"""
 
@@ -31,7 +34,10 @@ class BaseModel(BaseClass):
         validate_backrefs = False # bugfix https://github.com/coleifer/peewee/issues/465
 
     @classmethod
-    def create_table(cls, *args, **kwargs):
+    def create_table(cls, fail_silently=False):
+        if fail_silently and cls.table_exists():
+            return
+
         for _, field in cls._meta.fields.items():
             if hasattr(field, 'pre_field_create'):
                 field.pre_field_create(cls)
@@ -42,6 +48,43 @@ class BaseModel(BaseClass):
             if hasattr(field, 'post_field_create'):
                 field.post_field_create(cls)
 
+    @classmethod
+    def select(cls, *selection):
+        """Select query, with blobs fetched on first access unless with_blobs()"""
+        query = super(BaseModel, cls).select(*selection)
+        blob_query = BlobSelectQuery(cls)
+        blob_query.database = query.database
+        return query._clone_attributes(blob_query)
+
+    @classmethod
+    def _store_blobs(cls, values):
+        """
+        Put the raw blobs of a dict field (or field name) => value in the
+        store, replacing them with their reference.
+        """
+        values = dict(values)
+        for key, value in values.items():
+            field = cls._meta.fields.get(key, key)
+            if isinstance(field, BlobRefField) and value is not None \
+               and not isinstance(value, BlobRef):
+                values[key] = BlobRef(get_store().put(to_bytes(value)))
+        return values
+
+    @classmethod
+    def update(cls, __data=None, **update):
+        return super(BaseModel, cls).update(cls._store_blobs(__data or {}),
+                                            **cls._store_blobs(update))
+
+    @classmethod
+    def insert(cls, __data=None, **insert):
+        return super(BaseModel, cls).insert(cls._store_blobs(__data or {}),
+                                            **cls._store_blobs(insert))
+
+    @classmethod
+    def insert_many(cls, rows, *args, **kwargs):
+        return super(BaseModel, cls).insert_many([cls._store_blobs(row) for row in rows],
+                                                 *args, **kwargs)
+
     @classmethod
     def find(cls, id_):
         """Get record by id"""
@@ -55,6 +98,44 @@ class BaseModel(BaseClass):
         """Return all record sorted by id"""
         return cls.select().order_by(cls.id.asc())
 
+    def blob_sha256(self, name='blob'):
+        """
+        Return the sha256 of a blob, without fetching it from the blob store.
+
+        :param name: name of the BlobRefField.
+        """
+        value = self._data.get(name)
+        if value is None or isinstance(value, BlobRef):
+            return value
+        sha256s = self.__dict__.setdefault('_blob_sha256s', {})
+        if name not in sha256s:     # hashed once, until the blob changes
+            sha256s[name] = sha256sum(value)
+        return sha256s[name]
+
+    def open_blob(self, name='blob'):
+        """
+        Return a read-only file object over a blob, streamed from the blob
+        store in chunks instead of loaded at once.
+
+        :param name: name of the BlobRefField.
+        """
+        value = self._data.get(name)
+        if isinstance(value, BlobRef) and value not in self.__dict__.get('_blob_cache', {}):
+            return get_store().open(value)
+        return io.BytesIO(to_bytes(getattr(self, name)))
+
+    def _put_blobs(self):
+        """Put new blobs in the store, with the sha256 already computed"""
+        for name, field in self._meta.fields.items():
+            value = self._data.get(name)
+            if isinstance(field, BlobRefField) and value is not None \
+               and not isinstance(value, BlobRef):
+                sha256 = BlobRef(get_store().put(to_bytes(value), self.blob_sha256(name)))
+                self.__dict__.setdefault('_blob_cache', {})[sha256] = value
+                self._data[name] = sha256
+
     def save(self, **kwargs):
         self.updated_at = datetime.now()
+        self._put_blobs()
+        invalidate_cached_properties(self)
         return super(BaseModel, self).save(**kwargs)
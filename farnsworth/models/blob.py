@@ -0,0 +1,19 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+from peewee import BigIntegerField, CharField, FixedCharField
+
+from ..peewee_extensions import CompressedBlobField
+from .base import BaseModel
+
+"""Blob model"""
+
+
+class Blob(BaseModel):
+    """Blob model, content of the default blob store"""
+    sha256 = FixedCharField(max_length=64, primary_key=True)
+    size = BigIntegerField()    # uncompressed
+    codec = CharField(max_length=8, default='raw')
+    data = CompressedBlobField(codec_field='codec')
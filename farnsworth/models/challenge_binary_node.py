@@ -3,10 +3,14 @@
 
 from __future__ import absolute_import, unicode_literals
 
-import os
 import hashlib
-from peewee import CharField, BlobField, ForeignKeyField, FixedCharField, BooleanField, IntegerField
+import mmap
+import os
+from peewee import CharField, ForeignKeyField, FixedCharField, BooleanField, IntegerField
 
+from ..binary_cache import get_cache
+from .. import elf, scoring
+from ..peewee_extensions import BlobRefField
 from .base import BaseModel
 from .challenge_set import ChallengeSet
 from .ids_rule import IDSRule
@@ -22,22 +26,18 @@ def _sha256sum(*strings):
     return hashlib.sha256(b"".join(array)).hexdigest()
 
 
-def _avg(xs):
-    count, sum_ = 0, 0
-    for x in xs:
-        sum_ += x
-        count += 1
-
-    if count > 0:
-        return sum_ / count
-    else:
-        raise ValueError("_avg() arg is an empty sequence")
+def _view(data, offset, length):
+    """Zero-copy view over data[offset:offset + length]"""
+    try:
+        return memoryview(data)[offset:offset + length]
+    except TypeError:   # mmap has no new-style buffer interface in Python 2
+        return buffer(data, offset, length)
 
 
 class ChallengeBinaryNode(BaseModel):
     """ChallengeBinaryNode model"""
     root = ForeignKeyField('self', null=True, related_name='descendants')
-    blob = BlobField()
+    blob = BlobRefField()
     name = CharField()
     size = IntegerField()
     cs = ForeignKeyField(ChallengeSet, related_name='cbns')
@@ -47,11 +47,12 @@ class ChallengeBinaryNode(BaseModel):
     ids_rule = ForeignKeyField(IDSRule, related_name='cbn', null=True)
     # needed for patch submission decision making.
     is_blacklisted = BooleanField(default=False)
+    # original CB of its CS, see ChallengeSet.cbns_original
+    is_original = BooleanField(default=False)
 
     def delete_binary(self):
-        """Remove binary file"""
-        if os.path.isfile(self._path):
-            os.remove(self._path)
+        """Remove binary file, the binary itself stays in the shared cache"""
+        get_cache().remove_name(self._filename)
 
     @classmethod
     def create(cls, *args, **kwargs):
@@ -61,35 +62,90 @@ class ChallengeBinaryNode(BaseModel):
         obj = super(cls, cls).create(*args, **kwargs)
         return obj
 
+    @property
+    def _filename(self):
+        """Return file name"""
+        return "{}-{}-{}".format(self.id, self.cs_id, self.name)
+
     @property
     def _path(self):
         """Return path name"""
-        filename = "{}-{}-{}".format(self.id, self.cs_id, self.name)
-        return os.path.join(os.path.expanduser("~"), filename)  # FIXME: afl doesn't like /tmp
+        return get_cache().named_path(self._filename)
 
     @property
     def path(self):
-        """Save binary blob to file and return path"""
-        if not os.path.isfile(self._path):
-            with open(self._path, 'wb') as fp:
-                fp.write(self.blob)
-            os.chmod(self._path, 0o777)
-        return self._path
-
-    def prefix_path(self, prefix_str=None):
+        """Save binary blob to the shared cache and return path"""
+        return self._cache_as(self._filename)
+
+    def _cache_as(self, filename):
+        return get_cache().path(self.blob_sha256(), self.open_blob, name=filename, mode=0o555)
+
+    def prefix_path(self, prefix_str=None, shared=False):
         """
-        Returns path of a binary with filename prefixed with a given string.
+        Returns path of a fresh writable copy of a binary, with filename
+        prefixed with a given string.
         :param prefix_str: string to be prefixed for filename
+        :param shared: return the read-only file shared through the cache
+                       instead of a copy
         :return: new path to the binary
         """
+        filename = (prefix_str or "") + self._filename
+        if not shared:
+            return get_cache().copy(self.blob_sha256(), self.open_blob, filename, mode=0o777)
         if prefix_str is None:
             return self.path
-        new_fname = prefix_str + os.path.basename(self._path)
-        prefixed_path = os.path.join(os.path.dirname(self._path), new_fname)
-        with open(prefixed_path, 'wb') as fp:
-            fp.write(self.blob)
-        os.chmod(prefixed_path, 0o777)
-        return prefixed_path
+        return self._cache_as(filename)
+
+    def mmap(self):
+        """
+        Return a read-only memory map over the binary, materialised in the
+        shared cache. Pages are shared by all processes mapping the binary.
+        Empty binaries cannot be mapped, an empty string is returned instead.
+        """
+        sha256 = self.blob_sha256()
+        if getattr(self, '_mmap', (None, None))[0] != sha256:   # mapped another blob
+            with open(self.path, 'rb') as fp:
+                if os.fstat(fp.fileno()).st_size == 0:
+                    self._mmap = sha256, b""
+                else:
+                    self._mmap = sha256, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap[1]
+
+    def view(self, offset=0, length=None):
+        """
+        Return a zero-copy view over a range of the binary.
+
+        :param offset: offset of the range in the file.
+        :param length: length of the range, up to the end of the file by default.
+        :return: read-only view over the memory map of the binary.
+        """
+        data = self.mmap()
+        if length is None:
+            length = len(data) - offset
+        return _view(data, offset, length)
+
+    @property
+    def sections(self):
+        """Sections of the binary, see farnsworth.elf.sections()"""
+        data = self.mmap()
+        if getattr(self, '_sections', (None, None))[0] is not data:
+            self._sections = data, elf.sections(data)
+        return self._sections[1]
+
+    def section(self, name):
+        """
+        Return a zero-copy view over the contents of a section of the binary.
+
+        :param name: name of the section, e.g. '.text'.
+        :return: read-only view over the memory map of the binary, empty for
+                 sections without contents in the file like .bss.
+        """
+        for section in self.sections:
+            if section.name == name:
+                if section.type == elf.SHT_NOBITS:
+                    return self.view(section.offset, 0)
+                return self.view(section.offset, section.size)
+        raise KeyError(name)
 
     @property
     def unsubmitted_patches(self):
@@ -128,33 +184,72 @@ class ChallengeBinaryNode(BaseModel):
 
     @property
     def poll_feedbacks(self):
-        """All the received polls for this CB."""
-        # There is probably a DB way to do this better
+        """All the received polls for this CB, ready to be scored without further queries."""
         from .challenge_set_fielding import ChallengeSetFielding as CSF
         from .poll_feedback import PollFeedback as PF
+        through = CSF.cbns.get_through_model()
         total = (PF.success + PF.timeout + PF.connect + PF.function)
-        query = self.fieldings.select(CSF.poll_feedback) \
-                              .join(PF, on=(CSF.poll_feedback == PF.id)) \
-                              .where((CSF.team == Team.get_our())
-                                     & (CSF.poll_feedback.is_null(False))
-                                     & (total > 0))
-        return [csf.poll_feedback for csf in query]
+        query = PF.select() \
+                  .join(CSF, on=(CSF.poll_feedback == PF.id)) \
+                  .join(through, on=(through.challengesetfielding == CSF.id)) \
+                  .switch(CSF).join(Team, on=(Team.id == CSF.team)) \
+                  .where((through.challengebinarynode == self.id)
+                         & (Team.name == Team.OUR_NAME)
+                         & (total > 0))
+        return PF.prefetch_fieldings(query)
 
     @property
     def min_cb_score(self):
-        try:
-            return min(f.cb_score for f in self.poll_feedbacks)
-        except ValueError:
-            # No feedbacks available, arg to min is None
-            return None
+        return self.cb_scores(cbns=[self]).get(self.id, (None, None))[0]
 
     @property
     def avg_cb_score(self):
-        try:
-            return _avg(f.cb_score for f in self.poll_feedbacks)
-        except ValueError:
-            # No feedbacks available, arg to _avg is None
-            return None
+        return self.cb_scores(cbns=[self]).get(self.id, (None, None))[1]
+
+    @classmethod
+    def cb_scores(cls, cs=None, round=None, cbns=None):
+        """
+        Compute min and avg cb_score from the poll feedbacks of CBNs, in a
+        single statement, with the SQL version of CBScoreMixin (see
+        farnsworth.scoring).
+
+        :param cs: only score CBNs of this challenge set.
+        :param round: only use feedbacks received in this round.
+        :param cbns: only score these CBNs.
+        :return: dict CBN id => (min cb_score, avg cb_score), CBNs without
+                 feedback are missing.
+        """
+        from .challenge_set_fielding import ChallengeSetFielding as CSF
+
+        through = CSF.cbns.get_through_model()._meta.db_table
+        where, params = ["t.name = %s", "pf.success + pf.timeout + pf.connect + pf.function > 0"], \
+                        [Team.OUR_NAME]
+        if cs is not None:
+            where.append("csf.cs_id = %s")
+            params.append(getattr(cs, 'id', cs))
+        if round is not None:
+            where.append("pf.round_id = %s")
+            params.append(getattr(round, 'id', round))
+        cbns_where, cbns_params = "", []
+        if cbns is not None:
+            cbn_ids = [getattr(cbn, 'id', cbn) for cbn in cbns]
+            where.append("csf.id IN (SELECT challengesetfielding_id FROM {} "
+                         "WHERE challengebinarynode_id = ANY(%s))".format(through))
+            params.append(cbn_ids)
+            cbns_where, cbns_params = "WHERE tm.challengebinarynode_id = ANY(%s)", [cbn_ids]
+
+        sql, inputs_params = scoring.inputs_sql(" AND ".join(where))
+        sql += """
+            SELECT tm.challengebinarynode_id, min(s.cb_score), avg(s.cb_score)
+            FROM (SELECT id, cqe_cb_score(size_overhead, memory_overhead, time_overhead,
+                                          success, security) AS cb_score
+                  FROM inputs) AS s
+            JOIN {through} AS tm ON tm.challengesetfielding_id = s.id
+            {cbns_where}
+            GROUP BY tm.challengebinarynode_id
+        """.format(through=through, cbns_where=cbns_where)
+        cursor = cls._meta.database.execute_sql(sql, params + inputs_params + cbns_params)
+        return {cbn_id: (min_score, avg_score) for cbn_id, min_score, avg_score in cursor.fetchall()}
 
     @classmethod
     def roots(cls):
@@ -6,10 +6,13 @@
 from __future__ import absolute_import, unicode_literals
 
 import cPickle as pickle
+import json
 
 from peewee import CharField
 from playhouse.fields import ManyToManyField
 
+from ..config import master_db, slave_db
+from ..utils import cached_property
 from .base import BaseModel
 from .round import Round
 
@@ -61,13 +64,28 @@ class ChallengeSet(BaseModel):
             return self.exploits.where(Exploit.id.not_in(exp_fielding_ids))
 
     def _feedback(self, name):
+        """
+        Yield the entries about this CS of a Feedback JSON column, oldest first.
+        Feedbacks are found with a GIN index on the column (@> containment),
+        only their entries about this CS are sent back.
+        """
         from .feedback import Feedback
-        for fb in Feedback.all():
-            for cs in getattr(fb, name):
-                if cs['csid'] == self.name:
-                    cs['round'] = fb.round.num
-                    cs['updated_at'] = str(fb.updated_at)
-                    yield cs
+        database = slave_db if slave_db is not None else master_db
+        cursor = database.execute_sql("""
+            SELECT entry, r.num, f.updated_at
+            FROM {feedbacks} AS f
+            JOIN {rounds} AS r ON r.id = f.round_id,
+            jsonb_array_elements(f.{column}) AS entry
+            WHERE f.{column} @> %s::jsonb AND entry->>'csid' = %s
+            ORDER BY f.id
+        """.format(feedbacks=Feedback._meta.db_table, rounds=Round._meta.db_table,
+                   column=getattr(Feedback, name).db_column),
+                                      (json.dumps([{'csid': self.name}]), self.name),
+                                      require_commit=False)
+        for cs, round_num, updated_at in cursor.fetchall():
+            cs['round'] = round_num
+            cs['updated_at'] = str(updated_at)
+            yield cs
 
     def feedback_polls(self):
         return list(self._feedback('polls'))
@@ -88,23 +106,83 @@ class ChallengeSet(BaseModel):
             groups.setdefault(cbn.patch_type, []).append(cbn)
         return groups
 
-    @property
+    @cached_property
     def cbns_original(self):
         """
         Return all original CBNs in this challenge set.
         """
-        from .challenge_binary_node import ChallengeBinaryNode
         from .challenge_set_fielding import ChallengeSetFielding
+        originals = self.originals([self.id])
+        if self.id not in originals:
+            raise ChallengeSetFielding.DoesNotExist("No fielding by our team for CS {}"
+                                                    .format(self.id))
+        return originals[self.id]
+
+    @classmethod
+    def originals(cls, cs_ids):
+        """
+        Return the original CBNs of challenge sets, the CBNs by our team
+        available in the first round of each CS.
+
+        They are read back from ChallengeBinaryNode.is_original, set by
+        flag_originals() when fieldings change. Challenge sets without any
+        flagged CBN, e.g. fielded before the flag existed, are looked up
+        from their fieldings instead.
+
+        :param cs_ids: ids of the challenge sets.
+        :return: dict CS id => list of original CBNs, challenge sets not
+                 fielded by our team yet are missing.
+        """
+        from .challenge_binary_node import ChallengeBinaryNode as CBN
+
+        cs_ids = set(cs_ids)
+        originals = {}
+        for cbn in CBN.select().where((CBN.cs << list(cs_ids)) & (CBN.is_original == True)) \
+                              .order_by(CBN.id):
+            originals.setdefault(cbn.cs_id, []).append(cbn)
+
+        missing = cs_ids - set(originals)
+        if missing:
+            for cbn in CBN.select().where(CBN.id << cls._original_ids(missing)).order_by(CBN.id):
+                cbn.is_original = True
+                originals.setdefault(cbn.cs_id, []).append(cbn)
+        return originals
+
+    @classmethod
+    def flag_originals(cls, cs_ids=None):
+        """
+        Set ChallengeBinaryNode.is_original on the original CBNs of
+        challenge sets, and clear it on the others.
+
+        :param cs_ids: ids of the challenge sets, all of them by default.
+        :return: number of CBNs changed.
+        """
+        from .challenge_binary_node import ChallengeBinaryNode as CBN
+
+        original = CBN.id << cls._original_ids(cs_ids)
+        query = CBN.update(is_original=original).where(CBN.is_original != original)
+        if cs_ids is not None:
+            query = query.where(CBN.cs << list(cs_ids))
+        return query.execute()
+
+    @classmethod
+    def _original_ids(cls, cs_ids=None):
+        """Subquery of the ids of the CBNs of the first fielding by our team"""
+        from .challenge_set_fielding import ChallengeSetFielding as CSF
         from .team import Team
-        # original CBs are CBs by our team available in the first round of this CS
+
         # FIXME: multiple games?
-        CSF = ChallengeSetFielding
-        first_fielding = self.fieldings\
-                             .where(CSF.team == Team.get_our())\
-                             .join(Round,
-                                   on=(Round.id == ChallengeSetFielding.available_round))\
-                             .order_by(Round.created_at).get()
-        return first_fielding.cbns
+        through = CSF.cbns.get_through_model()
+        first_fieldings = CSF.select(CSF.id) \
+                             .join(Team, on=(Team.id == CSF.team)) \
+                             .switch(CSF).join(Round, on=(Round.id == CSF.available_round)) \
+                             .where(Team.name == Team.OUR_NAME) \
+                             .order_by(CSF.cs, Round.created_at) \
+                             .distinct([CSF.cs])
+        if cs_ids is not None:
+            first_fieldings = first_fieldings.where(CSF.cs << list(cs_ids))
+        return through.select(through.challengebinarynode) \
+                      .where(through.challengesetfielding << first_fieldings)
 
     @property
     def is_multi_cbn(self):
@@ -165,7 +243,7 @@ class ChallengeSet(BaseModel):
     @property
     def func_infos(self):
         finfos = dict()
-        for function in self.function_identities:
+        for function in self.function_identities.with_blobs():
             finfos[function.address] = pickle.loads(function.func_info)
 
         return finfos
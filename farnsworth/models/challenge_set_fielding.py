@@ -46,6 +46,7 @@ class ChallengeSetFielding(BaseModel):
 
         obj = super(cls, cls).create(*args, **kwargs)
         obj.cbns = cbns
+        ChallengeSet.flag_originals([obj.cs_id])
         return obj
 
     @classmethod
@@ -75,6 +76,7 @@ class ChallengeSetFielding(BaseModel):
         self.sha256 = _sha256sum(*[c.sha256 for c in self.cbns])
         if self.is_dirty():
             self.save()
+        ChallengeSet.flag_originals([self.cs_id])
 
     def add_cbns_if_missing(self, *cbns):
         """Wrap manytomany.add() to recalculate sha256 sum"""
@@ -84,6 +86,7 @@ class ChallengeSetFielding(BaseModel):
                 self.sha256 = _sha256sum(*[c.sha256 for c in self.cbns])
         if self.is_dirty():
             self.save()
+            ChallengeSet.flag_originals([self.cs_id])
 
     @classmethod
     def latest(cls, cs, team, round=None):
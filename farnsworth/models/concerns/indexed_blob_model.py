@@ -5,19 +5,27 @@
 
 from __future__ import absolute_import, unicode_literals
 
-import hashlib
+from collections import OrderedDict
 
 import peewee
 
+from ...blobstore import get_store, sha256sum, to_bytes
+from ...peewee_extensions import BlobRef
+
 
 class IndexedBlobModel(object):
-    """Class for models which need to index blob (bytea) column"""
+    """
+    Class for models which need to index blob (bytea) column
+
+    sha256 is the sha256 of the blob, computed once per blob by
+    blob_sha256() and shared with the blob store reference.
+    """
 
     def save(self, *args, **kwargs):
-        if self.blob is None:
+        if self._data.get('blob') is None: # do not fetch the blob from the store
             raise RuntimeError("Blob is None!!!")
         if self.sha256 is None:
-            self.sha256 = hashlib.sha1(self.blob).hexdigest()
+            self.sha256 = self.blob_sha256()
         return super(IndexedBlobModel, self).save(*args, **kwargs)
 
     @classmethod
@@ -26,13 +34,156 @@ class IndexedBlobModel(object):
 
     @classmethod
     def create_or_get(cls, **kwargs):
-        blob = kwargs.pop('blob')
-        sha256 = kwargs.pop('sha256', hashlib.sha256(blob).hexdigest())
+        instance = cls(**kwargs)
+        if instance.sha256 is None:
+            instance.sha256 = instance.blob_sha256()
         try:
             with cls._meta.database.atomic():
-                return cls.create(blob=blob, sha256=sha256, **kwargs), True
+                instance.save(force_insert=True)
+                return instance, True
         except peewee.IntegrityError:
+            kwargs.pop('blob')
+            kwargs['sha256'] = instance.sha256
             try:
-                return cls.get(sha256=sha256, **kwargs), False
+                return cls.get(**kwargs), False
             except cls.DoesNotExist: # this could happen with master-slave sync delay
                 return None, False
+
+    @classmethod
+    def bulk_create_or_get(cls, cs, job, blobs, batch_size=1000, **kwargs):
+        """
+        Create many rows at once, getting the existing ones instead of
+        duplicates (same challenge set and blob).
+
+        Blobs are hashed client-side, stored with one query per batch, and
+        rows are created with a multi-row INSERT ... ON CONFLICT DO NOTHING.
+        The rows already there are then fetched with a single SELECT.
+
+        :param cs: challenge set of the rows.
+        :param job: job which found the blobs.
+        :param blobs: list of blobs, one row each.
+        :param batch_size: maximum number of rows per INSERT.
+        :param kwargs: other field values shared by all rows.
+        :return: list of (instance, created), one per blob.
+        """
+        blobs = [to_bytes(blob) for blob in blobs]
+        sha256s = [sha256sum(blob) for blob in blobs]
+        database = cls._meta.database
+        instances = {}
+        with database.atomic():
+            for start in range(0, len(blobs), batch_size):
+                batch_sha256s = get_store().put_many(blobs[start:start + batch_size],
+                                                     sha256s[start:start + batch_size])
+                rows = [dict(kwargs, cs=cs, job=job, blob=BlobRef(sha256), sha256=sha256)
+                        for sha256 in OrderedDict.fromkeys(batch_sha256s)
+                        if sha256 not in instances]
+                if not rows:
+                    continue
+                sql, params = cls.insert_many(rows).sql()
+                sql += " ON CONFLICT (cs_id, sha256) DO NOTHING RETURNING *"
+                for instance in cls.raw(sql, *params):
+                    instances[instance.sha256] = (instance, True)
+
+            existing = [sha256 for sha256 in set(sha256s) if sha256 not in instances]
+            if existing:
+                query = cls.select().where((cls.cs == cs) & (cls.sha256 << existing))
+                query.database = database  # rows may not be on the slave yet
+                for instance in query:
+                    instances[instance.sha256] = (instance, False)
+
+        # only the first occurrence of a blob creates its row
+        results, seen = [], set()
+        for sha256 in sha256s:
+            instance, created = instances.get(sha256, (None, False))
+            results.append((instance, created and sha256 not in seen))
+            seen.add(sha256)
+        return results
+
+    @classmethod
+    def repair_sha256(cls):
+        """
+        Set sha256 back to the sha256 of the blob on rows where it differs,
+        e.g. rows hashed with sha1 by older versions.
+
+        Rows of a challenge set with the same blob are merged into the oldest
+        one: foreign keys and job payloads pointing to the others (see
+        Job.references()) are moved to it before they are deleted. Nothing is
+        changed if moving a foreign key would break a unique index of the
+        referencing table.
+
+        :raise ValueError: a foreign key cannot be moved.
+        :return: (number of rows fixed, number of rows merged).
+        """
+        import farnsworth.models
+        from farnsworth.models.job import JOB_TYPES
+
+        table = cls._meta.db_table
+        database = cls._meta.database
+        with database.atomic():
+            database.execute_sql("DROP TABLE IF EXISTS pg_temp.{}_duplicates".format(table))
+            database.execute_sql(
+                "CREATE TEMPORARY TABLE {0}_duplicates ON COMMIT DROP AS "
+                "SELECT id, keep_id FROM (SELECT id, min(id) OVER "
+                "(PARTITION BY cs_id, blob_sha256) AS keep_id "
+                "FROM {0} WHERE blob_sha256 IS NOT NULL) AS grouped "
+                "WHERE id <> keep_id".format(table))
+
+            fields = cls._meta.reverse_rel.values()
+            for field in fields:
+                cls._check_merge(field)
+            for field in fields:
+                database.execute_sql(
+                    "UPDATE {0} SET {1} = d.keep_id FROM {2}_duplicates AS d "
+                    "WHERE {0}.{1} = d.id".format(field.model_class._meta.db_table,
+                                                  field.db_column, table))
+            for job_type in JOB_TYPES:
+                for model_name, key, condition in job_type.references():
+                    if getattr(farnsworth.models, model_name) is not cls:
+                        continue
+                    database.execute_sql(
+                        "UPDATE jobs "
+                        "SET payload = jsonb_set(payload, %s::text[], to_jsonb(d.keep_id)) "
+                        "FROM {}_duplicates AS d "
+                        "WHERE worker = %s AND (payload->>%s)::integer = d.id{}".format(
+                            table, " AND ({})".format(condition) if condition else ""),
+                        ('{{{}}}'.format(key), job_type.worker.default, key))
+
+            merged = database.execute_sql(
+                "DELETE FROM {0} USING {0}_duplicates AS d WHERE {0}.id = d.id".format(table)
+            ).rowcount
+            # unique (cs, sha256) is checked row by row: move the wrong hashes
+            # out of the way first, a row may hold the sha256 of another one
+            where = "WHERE blob_sha256 IS NOT NULL AND sha256 IS DISTINCT FROM blob_sha256"
+            database.execute_sql(
+                "UPDATE {} SET sha256 = lpad(id::text, 64, '-') {}".format(table, where))
+            fixed = database.execute_sql(
+                "UPDATE {} SET sha256 = blob_sha256 {}".format(table, where)).rowcount
+        return fixed, merged
+
+    @classmethod
+    def _check_merge(cls, field):
+        """
+        Raise ValueError if pointing field (a foreign key to this model) to
+        the rows kept by repair_sha256() breaks a unique index.
+        """
+        database = cls._meta.database
+        referencing = field.model_class._meta.db_table
+        indexes = database.execute_sql(
+            "SELECT array_agg(a.attname::text) FROM pg_index AS i "
+            "JOIN pg_attribute AS a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) "
+            "WHERE i.indrelid = %s::regclass AND i.indisunique "
+            "GROUP BY i.indexrelid HAVING %s = ANY(array_agg(a.attname::text))",
+            (referencing, field.db_column)).fetchall()
+        for columns, in indexes:
+            others = ["r.{}".format(column) for column in columns if column != field.db_column]
+            conflict = database.execute_sql(
+                "SELECT 1 FROM {0} AS r LEFT JOIN {1}_duplicates AS d ON r.{2} = d.id "
+                "WHERE r.{2} IS NOT NULL{3} "
+                "GROUP BY {4} HAVING count(*) > 1 AND count(d.id) > 0 LIMIT 1".format(
+                    referencing, cls._meta.db_table, field.db_column,
+                    "".join(" AND {} IS NOT NULL".format(other) for other in others),
+                    ", ".join(["coalesce(d.keep_id, r.{})".format(field.db_column)] + others)
+                )).fetchone()
+            if conflict is not None:
+                raise ValueError("Cannot merge {} rows: unique ({}) of {} would break".format(
+                    cls.__name__, ", ".join(columns), referencing))
@@ -3,8 +3,8 @@
 
 from __future__ import absolute_import, unicode_literals
 
-from peewee import BigIntegerField, BlobField, BooleanField, FixedCharField, ForeignKeyField
-from ..peewee_extensions import EnumField
+from peewee import BigIntegerField, BooleanField, FixedCharField, ForeignKeyField
+from ..peewee_extensions import BlobRefField, EnumField
 
 from .base import BaseModel
 from .challenge_set import ChallengeSet
@@ -14,7 +14,7 @@ from .job import Job
 """Crash model module."""
 
 class Crash(IndexedBlobModel, BaseModel): # Inherited classes order matters!
-    blob = BlobField(null=True)
+    blob = BlobRefField(null=True)
     cs = ForeignKeyField(ChallengeSet, related_name='crashes')
     exploited = BooleanField(default=False)
     explored = BooleanField(default=False)
@@ -3,13 +3,13 @@
 
 from __future__ import absolute_import, unicode_literals
 
-from peewee import FloatField, BlobField, ForeignKeyField
+from peewee import FloatField, ForeignKeyField
 
 from .base import BaseModel
 from .challenge_set import ChallengeSet
 from .crash import Crash
 from .job import Job
-from ..peewee_extensions import EnumField
+from ..peewee_extensions import BlobRefField, EnumField
 
 """Exploit model"""
 
@@ -18,7 +18,7 @@ class Exploit(BaseModel):
     """Exploit model"""
     cs = ForeignKeyField(ChallengeSet, related_name='exploits')
     job = ForeignKeyField(Job, related_name='exploits')
-    blob = BlobField()
+    blob = BlobRefField()
     pov_type = EnumField(choices=['type1', 'type2'], enum_name='enum_pov_type')
     method = EnumField(choices=['unclassified',
                                 'exploration',
@@ -29,7 +29,7 @@ class Exploit(BaseModel):
                                 'backdoor'],
                        default='unclassified', enum_name='enum_exploitation_method', null=False)
     reliability = FloatField(default=0.0)
-    c_code = BlobField(null=True)
+    c_code = BlobRefField(null=True)
     crash = ForeignKeyField(Crash, related_name="exploits", null=True)
 
     def submit_to(self, team, throws, round=None):
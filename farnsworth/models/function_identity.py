@@ -3,8 +3,9 @@
 
 from __future__ import absolute_import, unicode_literals
 
-from peewee import CharField, BigIntegerField, ForeignKeyField, BlobField
+from peewee import CharField, BigIntegerField, ForeignKeyField
 
+from ..peewee_extensions import BlobRefField
 from .base import BaseModel
 from .challenge_set import ChallengeSet
 
@@ -16,7 +17,7 @@ class FunctionIdentity(BaseModel):
     cs = ForeignKeyField(ChallengeSet, related_name='function_identities')
     address = BigIntegerField(null=False)
     symbol = CharField(null=True)
-    func_info = BlobField(null=True)
+    func_info = BlobRefField(null=True)
 
     class Meta:  # pylint: disable=no-init,too-few-public-methods,old-style-class
         db_table = 'function_identities'
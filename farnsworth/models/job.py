@@ -4,8 +4,11 @@
 from __future__ import absolute_import, unicode_literals
 
 import datetime
+import hashlib
+import json
 
-from peewee import ForeignKeyField, DateTimeField, IntegerField, BooleanField, CharField
+from peewee import (ForeignKeyField, DateTimeField, IntegerField, BooleanField, CharField,
+                    FixedCharField, NaiveQueryResultWrapper, SelectQuery, SQL, fn)
 from playhouse.postgres_ext import BinaryJSONField
 
 from .base import BaseModel
@@ -16,6 +19,10 @@ from .ids_rule_fielding import IDSRuleFielding
 
 """Job models"""
 
+# Seconds a job waits in queue to gain one priority point, prevents starvation.
+# Baked in the jobs_unstarted_worker_aged_priority index, recreate it on change.
+PRIORITY_AGING = 600
+
 
 def to_job_type(job):
     """
@@ -24,21 +31,92 @@ def to_job_type(job):
     Note: This function *modifies* the input job, but it also returns the
     modified one for convience.
     """
-    job_types = [# Worker jobs, directly on Kubernetes
-                 AFLJob, BackdoorSubmitterJob, CacheJob, CBRoundTesterJob, ColorGuardJob,
-                 DrillerJob, FunctionIdentifierJob, IDSJob, NetworkPollCreatorJob,
-                 PatchPerformanceJob, PatcherexJob, PovFuzzer1Job, PovFuzzer2Job, RexJob,
-                 RopCacheJob,
-                 # Tester jobs
-                 TesterJob, CBTesterJob, NetworkPollSanitizerJob, PollCreatorJob,
-                 PovTesterJob, ShowmapSyncJob]
+    try:
+        job.__class__ = JOB_TYPES_BY_WORKER[job.worker]
+    except KeyError:
+        raise TypeError("Invalid Job object passed")
+    return job
+
+
+class _TypedJobResultWrapper(NaiveQueryResultWrapper):
+    """Instantiate each row directly as the Job subclass of its worker."""
+
+    def initialize(self, description):
+        super(_TypedJobResultWrapper, self).initialize(description)
+        self._worker_index = None
+        for i, column, _ in self.conv:
+            if column == 'worker':
+                self._worker_index = i
+
+    def process_row(self, row):
+        job_type = self.model
+        if self._worker_index is not None:
+            job_type = JOB_TYPES_BY_WORKER.get(row[self._worker_index], job_type)
+        instance = job_type()
+        for i, column, func in self.conv:
+            setattr(instance, column, func(row[i]))
+        instance._prepare_instance()    # pylint:disable=protected-access
+        return instance
+
+
+class _TypedJobSelectQuery(SelectQuery):
+    """SelectQuery returning jobs cast to their subclass, see Job.select_typed()."""
+
+    def _get_result_wrapper(self):
+        if self._tuples or self._dicts:
+            return super(_TypedJobSelectQuery, self)._get_result_wrapper()
+        return _TypedJobResultWrapper
+
+
+def prefetch_inputs(jobs):
+    """
+    Load the inputs referenced by the payloads of many jobs at once.
+
+    Issues one query per input model and field, instead of one per job on
+    first property access, and fills the cached attributes of the jobs.
+    Jobs should already be cast to their subclass, see to_job_type().
 
-    for job_type in job_types:
-        if job.worker == job_type.worker.default:
-            job.__class__ = job_type
-            return job
+    :return: the list of jobs, for convenience.
+    """
+    import farnsworth.models
+
+    jobs = list(jobs)
+    wanted = {}
+    for job in jobs:
+        for attribute, model_name, key, field_name in job.PREFETCH:
+            if job.payload is not None and job.payload.get(key) is not None:
+                value = job.payload[key]
+                if field_name == 'id':  # ids may be stored as strings, e.g. "12"
+                    try:
+                        value = int(value)
+                    except (TypeError, ValueError):
+                        continue
+                wanted.setdefault((model_name, field_name), []).append(
+                    (job, attribute, value))
+
+    for (model_name, field_name), references in wanted.items():
+        model = getattr(farnsworth.models, model_name)
+        field = getattr(model, field_name)
+        values = set(value for _, _, value in references)
+        rows = {getattr(row, field_name): row
+                for row in model.select().where(field << list(values))}
+        for job, attribute, value in references:
+            if value in rows:
+                setattr(job, attribute, rows[value])
+
+    return jobs
+
+
+def payload_hash(payload, keys=None):
+    """
+    Return the canonical sha256 of a job payload.
 
-    raise TypeError("Invalid Job object passed")
+    :param keys: hash only these payload keys, all of them if None.
+    """
+    if keys is not None:
+        payload = {key: payload.get(key) for key in keys}
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical).hexdigest()
 
 
 class Job(BaseModel):
@@ -52,23 +130,71 @@ class Job(BaseModel):
     limit_memory = IntegerField(null=True, default=4096)    # MiB
     limit_time = IntegerField(null=True)                    # Seconds
     payload = BinaryJSONField(null=True)
+    payload_hash = FixedCharField(max_length=64, null=True)  # set by bulk_enqueue()
     priority = IntegerField(null=False, default=0)
     produced_output = BooleanField(null=True)
     started_at = DateTimeField(null=True)
+    lease_expires_at = DateTimeField(null=True)
     worker = CharField()
     kvm_access = False
     data_access = False
     restart = True
+    lease_time = 300    # Seconds
+    # Inputs loaded by prefetch_inputs(): (cache attribute, model, payload key, model field)
+    PREFETCH = []
+    # Other ids held by payloads: (model, payload key, SQL condition on payload or None)
+    REFERENCES = []
 
     class Meta:     # pylint:disable=no-init,missing-docstring,old-style-class
         def db_table_func(self):   # pylint:disable=no-self-argument,no-self-use
             return 'jobs'
 
-    def started(self):
-        """Mark job as started"""
+    @classmethod
+    def references(cls):
+        """
+        Return the ids of other rows held by payloads of this job type.
+
+        :return: list of (model name, payload key, SQL condition on the
+                 payload restricting the jobs, or None).
+        """
+        return [(model_name, key, None) for _, model_name, key, field_name in cls.PREFETCH
+                if field_name == 'id'] + cls.REFERENCES
+
+    def started(self, lease=False):
+        """
+        Mark job as started.
+
+        :param lease: if True, the job is reaped unless heartbeat() is called
+                      within lease_time seconds.
+        """
         self.started_at = datetime.datetime.now()
+        if lease:
+            self.lease_expires_at = self.started_at + datetime.timedelta(seconds=self.lease_time)
         self.save()
 
+    @property
+    def effective_priority(self):
+        """Priority increased by the time spent in queue, see PRIORITY_AGING"""
+        waited = (datetime.datetime.now() - self.created_at).total_seconds()
+        return self.priority + waited / PRIORITY_AGING
+
+    @classmethod
+    def aged_priority(cls):
+        """
+        Expression ordering jobs like effective_priority.
+
+        The current time is the same for every row, so ordering by priority
+        minus created_at / PRIORITY_AGING is equivalent, and can be indexed.
+        """
+        return cls.priority - fn.date_part(SQL("'epoch'"), cls.created_at) / PRIORITY_AGING
+
+    @classmethod
+    def unstarted_by_effective_priority(cls):
+        """Return all unstarted jobs, the highest effective priority first"""
+        return cls.select() \
+                  .where(cls.started_at.is_null(True) & (cls.worker == cls.worker.default)) \
+                  .order_by(cls.aged_priority().desc(), cls.id.asc())
+
     def is_started(self):
         """Check if job is started"""
         return self.started_at is not None
@@ -93,15 +219,202 @@ class Job(BaseModel):
         self.completed_at = datetime.datetime.now()
         self.save()
 
+    @classmethod
+    def select_typed(cls, *selection):
+        """
+        Like select(), but every job is an instance of the subclass matching
+        its worker, as with to_job_type(). Unknown workers keep the query class.
+        """
+        query = _TypedJobSelectQuery(cls, *selection)
+        if hasattr(cls, '_get_read_database'):
+            query.database = cls._get_read_database()
+        return query
+
     @classmethod
     def unstarted(cls):
         """Return all unstarted jobs"""
         return cls.select().where(cls.started_at.is_null(True) & (cls.worker == cls.worker.default))
 
+    def heartbeat(self, lease=None):
+        """
+        Extend the lease of a running job.
+
+        :param lease: seconds until the lease expires, defaults to lease_time.
+        :return: False if the job is not running anymore, e.g. it was reaped.
+        """
+        now = datetime.datetime.now()
+        self.lease_expires_at = now + datetime.timedelta(seconds=lease or self.lease_time)
+        cls = self.__class__
+        query = cls.update(lease_expires_at=self.lease_expires_at, updated_at=now) \
+                   .where((cls.id == self.id)
+                          & cls.started_at.is_null(False)
+                          & cls.completed_at.is_null(True))
+        return query.execute() == 1
+
+    @classmethod
+    def reap_expired(cls):
+        """
+        Reset started jobs whose lease expired, e.g. because their pod died.
+
+        Restartable jobs are put back in the queue, the others are marked as
+        completed without output.
+
+        :return: tuple of (requeued job ids, failed job ids).
+        """
+        now = datetime.datetime.now()
+        no_restart = [job_type.worker.default for job_type in JOB_TYPES if not job_type.restart]
+        query = ("UPDATE {table} SET "
+                 "started_at = CASE WHEN worker = ANY(%(no_restart)s) "
+                 "THEN started_at ELSE NULL END, "
+                 "completed_at = CASE WHEN worker = ANY(%(no_restart)s) "
+                 "THEN %(now)s ELSE NULL END, "
+                 "produced_output = CASE WHEN worker = ANY(%(no_restart)s) "
+                 "THEN FALSE ELSE produced_output END, "
+                 "lease_expires_at = NULL, updated_at = %(now)s "
+                 "WHERE completed_at IS NULL AND lease_expires_at < %(now)s "
+                 "RETURNING id, started_at IS NULL").format(table=cls._meta.db_table)
+        cursor = cls._meta.database.execute_sql(query, {'now': now, 'no_restart': no_restart})
+
+        requeued, failed = [], []
+        for id_, is_requeued in cursor.fetchall():
+            (requeued if is_requeued else failed).append(id_)
+        return requeued, failed
+
+    @classmethod
+    def claim_next(cls, worker=None, batch=1, lease=None):
+        """
+        Atomically mark the highest effective priority unstarted jobs as started.
+
+        Rows locked by a concurrent claim are skipped instead of waited on,
+        so many workers can poll the same queue without grabbing the same job.
+        Claimed jobs hold a lease, see heartbeat() and reap_expired().
+
+        :param worker: worker type to claim jobs for, defaults to the class worker.
+        :param batch: maximum number of jobs to claim.
+        :param lease: seconds until the lease expires, defaults to lease_time.
+        :return: list of claimed jobs, possibly empty.
+        """
+        if worker is None:
+            worker = cls.worker.default
+        if worker is None:
+            raise ValueError("A worker type is required to claim jobs")
+
+        now = datetime.datetime.now()
+        lease_expires_at = now + datetime.timedelta(seconds=lease or cls.lease_time)
+        query = ("UPDATE {table} SET started_at = %s, lease_expires_at = %s, updated_at = %s "
+                 "WHERE id IN (SELECT id FROM {table} "
+                 "WHERE started_at IS NULL AND worker = %s "
+                 "ORDER BY priority - date_part('epoch', created_at) / {aging} DESC, "
+                 "id ASC LIMIT %s FOR UPDATE SKIP LOCKED) "
+                 "RETURNING *").format(table=cls._meta.db_table, aging=PRIORITY_AGING)
+        jobs = list(cls.raw(query, now, lease_expires_at, now, worker, batch))
+        if cls is Job:
+            jobs = [to_job_type(job) for job in jobs]
+        return sorted(jobs, key=lambda job: (-job.effective_priority, job.id))
+
+    @classmethod
+    def schedule_for(cls, cpu, memory, kvm_access=False, data_access=False, window=1000,
+                     claim=False):
+        """
+        Pick the unstarted jobs that best fill a node with the given capacity.
+
+        Jobs are packed greedily by decreasing effective priority. Among jobs of
+        the same (rounded down) effective priority the largest requests go first,
+        so small jobs fill the gaps.
+
+        :param cpu: free CPUs on the node.
+        :param memory: free memory on the node, in MiB.
+        :param kvm_access: whether the node can run jobs requiring KVM.
+        :param data_access: whether the node can run jobs requiring data access.
+        :param window: number of highest effective priority jobs considered for packing.
+        :param claim: if True, atomically claim the picked jobs, see claim_next().
+        :return: list of jobs, when claiming only those not claimed concurrently.
+        """
+        excluded = [job_type.worker.default for job_type in JOB_TYPES
+                    if (job_type.kvm_access and not kvm_access)
+                    or (job_type.data_access and not data_access)]
+        condition = cls.started_at.is_null(True)
+        if cls.worker.default is not None:
+            condition &= (cls.worker == cls.worker.default)
+        if excluded:
+            condition &= cls.worker.not_in(excluded)
+        candidates = cls.select(cls.id, cls.priority, cls.created_at,
+                                cls.request_cpu, cls.request_memory) \
+                        .where(condition) \
+                        .order_by(cls.aged_priority().desc(), cls.id.asc()) \
+                        .limit(window) \
+                        .tuples()
+
+        now = datetime.datetime.now()
+
+        def sort_key(candidate):
+            id_, priority, created_at, request_cpu, request_memory = candidate
+            waited = (now - created_at).total_seconds()
+            size = (float(request_cpu or 0) / max(cpu, 1)
+                    + float(request_memory or 0) / max(memory, 1))
+            return (-(priority + int(waited // PRIORITY_AGING)), -size, id_)
+
+        picked = []
+        free_cpu, free_memory = cpu, memory
+        for candidate in sorted(candidates, key=sort_key):
+            id_, _, _, request_cpu, request_memory = candidate
+            if (request_cpu or 0) <= free_cpu and (request_memory or 0) <= free_memory:
+                picked.append(id_)
+                free_cpu -= request_cpu or 0
+                free_memory -= request_memory or 0
+
+        if not picked:
+            return []
+        if claim:
+            now = datetime.datetime.now()
+            query = ("UPDATE {table} SET started_at = %s, lease_expires_at = %s, "
+                     "updated_at = %s WHERE id = ANY(%s) AND started_at IS NULL "
+                     "RETURNING *").format(table=cls._meta.db_table)
+            lease_expires_at = now + datetime.timedelta(seconds=cls.lease_time)
+            jobs = list(cls.raw(query, now, lease_expires_at, now, picked))
+        else:
+            jobs = list(cls.select().where(cls.id << picked))
+        if cls is Job:
+            jobs = [to_job_type(job) for job in jobs]
+        order = {id_: i for i, id_ in enumerate(picked)}
+        return sorted(jobs, key=lambda job: order[job.id])
+
     @classmethod
     def get_or_create(cls, **kwargs):
         return super(Job, cls).get_or_create(worker=cls.worker.default, **kwargs)
 
+    @classmethod
+    def bulk_enqueue(cls, job_class, payloads, priority=0, dedupe_on=None, batch_size=1000,
+                     **kwargs):
+        """
+        Create many jobs with multi-row INSERTs, skipping duplicates.
+
+        A job is a duplicate if a job of the same worker type with the same
+        payload hash was already enqueued through this method.
+
+        :param job_class: Job subclass to create, e.g. DrillerJob.
+        :param payloads: iterable of payload dicts, one job each.
+        :param priority: priority of the created jobs.
+        :param dedupe_on: payload keys identifying a job, all keys if None.
+        :param batch_size: maximum number of rows per INSERT.
+        :param kwargs: other field values shared by all jobs, e.g. cs.
+        :return: list of ids of the jobs actually created.
+        """
+        rows = []
+        for payload in payloads:
+            row = dict(kwargs, payload=payload, priority=priority,
+                       payload_hash=payload_hash(payload, dedupe_on))
+            rows.append(row)
+
+        ids = []
+        database = job_class._meta.database
+        with database.atomic():
+            for start in range(0, len(rows), batch_size):
+                sql, params = job_class.insert_many(rows[start:start + batch_size]).sql()
+                sql += " ON CONFLICT (worker, payload_hash) DO NOTHING RETURNING id"
+                ids.extend(row[0] for row in database.execute_sql(sql, params).fetchall())
+        return ids
+
 
 class DrillerJob(Job):
     """
@@ -111,6 +424,7 @@ class DrillerJob(Job):
     """
 
     worker = CharField(default='driller')
+    PREFETCH = [('_input_test', 'Test', 'test_id', 'id')]
     restart = False
 
     @property
@@ -134,6 +448,8 @@ class ColorGuardJob(Job):
     """
 
     worker = CharField(default='colorguard')
+    REFERENCES = [('Crash', 'id', "(payload->>'crash')::boolean IS TRUE"),
+                  ('Test', 'id', "(payload->>'crash')::boolean IS NOT TRUE")]
     restart = False
 
     @property
@@ -157,6 +473,7 @@ class ColorGuardJob(Job):
 class AFLJob(Job):
     """This represents a job for AFL. It requires no extra input."""
     worker = CharField(default='afl')
+    PREFETCH = [('_challenge_set', 'ChallengeSet', 'cs_id', 'id')]
 
     @property
     def challenge_set(self):
@@ -177,6 +494,7 @@ class RexJob(Job):
     `payload` field.
     """
     worker = CharField(default='rex')
+    PREFETCH = [('_input_crash', 'Crash', 'crash_id', 'id')]
     restart = False
 
     @property
@@ -252,6 +570,7 @@ class TesterJob(Job):
         if self.is_started():
             self.started_at = None
             self.completed_at = None
+            self.lease_expires_at = None
             self.save()
             return True
         return False
@@ -275,6 +594,7 @@ class PollCreatorJob(TesterJob):
     """
 
     worker = CharField(default='poll_creator')
+    PREFETCH = [('_target_test', 'Test', 'test_id', 'id')]
 
     @property
     def target_test(self):
@@ -300,6 +620,7 @@ class NetworkPollSanitizerJob(TesterJob):
     `payload` field.
     """
     worker = CharField(default='network_poll_sanitizer')
+    PREFETCH = [('_round_poll', 'RawRoundPoll', 'rrp_id', 'id')]
 
     @property
     def raw_poll(self):
@@ -325,6 +646,8 @@ class CBTesterJob(TesterJob):
     """
 
     worker = CharField(default='cb_tester')
+    PREFETCH = [('_poll', 'ValidPoll', 'poll_id', 'id'),
+                ('_target_cs', 'ChallengeSet', 'cs_id', 'id')]
 
     @property
     def poll(self):
@@ -375,6 +698,7 @@ class PatchPerformanceJob(Job):
         measurements for all patched binaries for a specific round.
     """
     worker = CharField(default='patch_performance')
+    PREFETCH = [('_target_round', 'Round', 'round_id', 'id')]
 
     @property
     def target_round(self):
@@ -403,6 +727,7 @@ class CBRoundTesterJob(Job):
     against all network polls created from that round.
     """
     worker = CharField(default='cb_round_tester')
+    PREFETCH = [('_target_round', 'Round', 'round_id', 'id')]
 
     @property
     def target_round(self):
@@ -424,6 +749,7 @@ class CBRoundTesterJob(Job):
 class NetworkPollCreatorJob(Job):
     """Create polls from captured network traffic."""
     worker = CharField(default='network_poll_creator')
+    PREFETCH = [('_target_round_traffic', 'RawRoundTraffic', 'rrt_id', 'id')]
 
     @property
     def target_round_traffic(self):
@@ -445,6 +771,9 @@ class PovTesterJob(TesterJob):
     Exploit ID, CS Fielding ID, IDS Fielding ID as an input.
     """
     worker = CharField(default='pov_tester')
+    PREFETCH = [('_target_exploit', 'Exploit', 'exploit_id', 'id'),
+                ('_target_cs_fielding', 'ChallengeSetFielding', 'cs_fld_hash', 'sha256'),
+                ('_target_ids_fielding', 'IDSRuleFielding', 'ids_fld_hash', 'sha256')]
 
     @property
     def target_exploit(self):
@@ -496,6 +825,7 @@ class PovTesterJob(TesterJob):
 class IDSJob(Job):
     """A IDSJob."""
     worker = CharField(default='ids')
+    PREFETCH = [('_cs', 'ChallengeSet', 'cs_id', 'id')]
 
     @property
     def cs(self):
@@ -546,6 +876,7 @@ class ShowmapSyncJob(Job):
     """A ShowMapSync."""
 
     worker = CharField(default='showmap_sync')
+    PREFETCH = [('_input_rrt', 'RawRoundTraffic', 'rrt_id', 'id')]
     restart = False
 
     @property
@@ -567,3 +898,15 @@ class BackdoorSubmitterJob(Job):
 
     worker = CharField(default='backdoor_submitter')
     restart = False
+
+
+JOB_TYPES = [# Worker jobs, directly on Kubernetes
+             AFLJob, BackdoorSubmitterJob, CacheJob, CBRoundTesterJob, ColorGuardJob,
+             DrillerJob, FunctionIdentifierJob, IDSJob, NetworkPollCreatorJob,
+             PatchPerformanceJob, PatcherexJob, PovFuzzer1Job, PovFuzzer2Job, RexJob,
+             RopCacheJob,
+             # Tester jobs
+             TesterJob, CBTesterJob, NetworkPollSanitizerJob, PollCreatorJob,
+             PovTesterJob, ShowmapSyncJob]
+
+JOB_TYPES_BY_WORKER = {job_type.worker.default: job_type for job_type in JOB_TYPES}
@@ -5,13 +5,14 @@
 
 from __future__ import absolute_import, unicode_literals
 
-from peewee import ForeignKeyField, FloatField
+from peewee import JOIN, FloatField, ForeignKeyField, fn
 
 from .base import BaseModel
 from .round import Round
 from .challenge_set import ChallengeSet
 from .concerns.round_related_model import RoundRelatedModel
 from ..mixins.cb_score_mixin import CBScoreMixin
+from ..utils import cached_property, set_cached_property
 
 
 class PollFeedback(BaseModel, RoundRelatedModel, CBScoreMixin):
@@ -29,13 +30,44 @@ class PollFeedback(BaseModel, RoundRelatedModel, CBScoreMixin):
     time_overhead = FloatField()
     memory_overhead = FloatField()
 
+    @cached_property
+    def _fielding_info(self):
+        """(fielding, CBNs with their patch type, original size), see _fieldings()"""
+        return self._fieldings([self.id]).get(self.id, (None, [], None))
+
+    @cached_property
+    def fielding(self):
+        """Fielding this feedback is about"""
+        return self._fielding_info[0] or self.cs_fielding.get()
+
     @property
     def cbns(self):
-        return self.cs_fielding.get().cbns
+        return self.fielding.cbns
+
+    @property
+    def fielded_cbns(self):
+        """List of the CBNs of the fielding, with their patch type"""
+        return self._fielding_info[1]
+
+    @cached_property
+    def original_size(self):
+        """Size of the original CBNs of the challenge set, see ChallengeSet.cbns_original"""
+        if self._fielding_info[2] is not None:
+            return self._fielding_info[2]
+        sizes = self._original_sizes([self.cs_id])
+        if self.cs_id not in sizes:
+            from .challenge_set_fielding import ChallengeSetFielding
+            raise ChallengeSetFielding.DoesNotExist("No original fielding for CS {}"
+                                                    .format(self.cs_id))
+        return sizes[self.cs_id]
 
     @property
     def patch_type(self):
-        return self.cbns.get().patch_type
+        if not self.fielded_cbns:
+            from .challenge_binary_node import ChallengeBinaryNode
+            raise ChallengeBinaryNode.DoesNotExist("No CBN fielded for feedback {}"
+                                                   .format(self.id))
+        return self.fielded_cbns[0].patch_type
 
     # security
     @property
@@ -49,6 +81,65 @@ class PollFeedback(BaseModel, RoundRelatedModel, CBScoreMixin):
 
     @property
     def size_overhead(self):
-        current_size = sum(cbn.size for cbn in self.cbns)
-        orig_size = sum(cbn.size for cbn in self.cs.cbns_original)
+        current_size = sum(cbn.size for cbn in self.fielded_cbns)
+        orig_size = self.original_size
         return max(float(current_size) / float(orig_size) - 1.0, 0.0)
+
+    @classmethod
+    def prefetch_fieldings(cls, feedbacks):
+        """
+        Load the fieldings, CBNs, patch types and original sizes of feedbacks
+        in bulk, so that scoring them does not query the database again.
+
+        :param feedbacks: iterable of feedbacks, e.g. a query.
+        :return: list of the feedbacks.
+        """
+        feedbacks = list(feedbacks)
+        if not feedbacks:
+            return feedbacks
+        infos = cls._fieldings([f.id for f in feedbacks])
+        unflagged = {f.cs_id for f in feedbacks if infos.get(f.id, (None, [], None))[2] is None}
+        sizes = cls._original_sizes(unflagged) if unflagged else {}
+        for feedback in feedbacks:
+            info = infos.get(feedback.id, (None, [], None))
+            set_cached_property(feedback, '_fielding_info', info)
+            size = info[2] if info[2] is not None else sizes.get(feedback.cs_id)
+            if size is not None:
+                set_cached_property(feedback, 'original_size', size)
+        return feedbacks
+
+    @staticmethod
+    def _fieldings(ids):
+        """
+        Return dict feedback id => (fielding, list of the CBNs of the
+        fielding with their patch type, size of the original CBNs of the CS),
+        in one query. The size is None when the originals are not flagged,
+        see ChallengeSet.flag_originals().
+        """
+        from .challenge_binary_node import ChallengeBinaryNode as CBN
+        from .challenge_set_fielding import ChallengeSetFielding as CSF
+        from .patch_type import PatchType
+
+        through = CSF.cbns.get_through_model()
+        Original = CBN.alias()
+        original_size = Original.select(fn.SUM(Original.size)) \
+                                .where((Original.cs == CSF.cs) & (Original.is_original == True))
+        rows = through.select(through, CSF, CBN, PatchType, original_size.alias('original_size')) \
+                      .join(CSF).switch(through).join(CBN) \
+                      .join(PatchType, JOIN.LEFT_OUTER) \
+                      .where(CSF.poll_feedback << list(ids)) \
+                      .order_by(CSF.id, CBN.id)
+        infos = {}
+        for row in rows:
+            fielding = row.challengesetfielding
+            # one fielding per feedback, the first one like cs_fielding.get()
+            info = infos.setdefault(fielding.poll_feedback_id, (fielding, [], row.original_size))
+            if info[0].id == fielding.id:
+                info[1].append(row.challengebinarynode)
+        return infos
+
+    @staticmethod
+    def _original_sizes(cs_ids):
+        """Return dict CS id => size of its original CBNs"""
+        return {cs_id: sum(cbn.size for cbn in cbns)
+                for cs_id, cbns in ChallengeSet.originals(cs_ids).items()}
@@ -5,10 +5,10 @@
 
 from __future__ import absolute_import, unicode_literals
 
-from peewee import BooleanField, BlobField, ForeignKeyField
-from playhouse.postgres_ext import BlobField
+from peewee import BooleanField, ForeignKeyField
 
 from ..actions import cfe_poll_from_xml, Write
+from ..peewee_extensions import BlobRefField
 from .base import BaseModel
 from .challenge_set import ChallengeSet
 from .raw_round_traffic import RawRoundTraffic
@@ -23,7 +23,7 @@ class RawRoundPoll(BaseModel):
     is_crash = BooleanField(null=False, default=False)
     is_failed = BooleanField(null=False, default=False)
     cs = ForeignKeyField(ChallengeSet, related_name='raw_round_polls')
-    blob = BlobField(null=False)
+    blob = BlobRefField(null=False)
     raw_round_traffic = ForeignKeyField(RawRoundTraffic, null=True, related_name='raw_round_polls')
     sanitized = BooleanField(null=False, default=False)
 
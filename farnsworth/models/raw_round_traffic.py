@@ -3,10 +3,11 @@
 
 from __future__ import absolute_import, unicode_literals
 
-from peewee import BooleanField, BlobField, ForeignKeyField
-from playhouse.postgres_ext import BlobField
+from peewee import BooleanField, ForeignKeyField
 
+from ..blobstore import CHUNK_SIZE
 from .round import Round
+from ..peewee_extensions import BlobRefField
 from .base import BaseModel
 
 """RawRoundTraffic model"""
@@ -18,4 +19,14 @@ class RawRoundTraffic(BaseModel):
     """
     round = ForeignKeyField(Round, related_name='raw_round_traffics')
     processed = BooleanField(null=False, default=False)
-    pickled_data = BlobField()
+    pickled_data = BlobRefField()
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        """
+        Iterate over pickled_data in chunks, streamed from the blob store.
+
+        :param chunk_size: size of the chunks, in bytes.
+        """
+        with self.open_blob('pickled_data') as fp:
+            for chunk in iter(lambda: fp.read(chunk_size), b""):
+                yield chunk
@@ -5,8 +5,9 @@
 
 from __future__ import absolute_import, unicode_literals
 
-from peewee import BlobField, ForeignKeyField
+from peewee import ForeignKeyField
 
+from ..peewee_extensions import BlobRefField
 from .base import BaseModel
 from .challenge_set import ChallengeSet
 
@@ -14,4 +15,4 @@ from .challenge_set import ChallengeSet
 class RopCache(BaseModel):
     """RopCache model"""
     cs = ForeignKeyField(ChallengeSet, related_name='rop_cache')
-    blob = BlobField(null=False)
+    blob = BlobRefField(null=False)
@@ -3,9 +3,10 @@
 
 from __future__ import absolute_import, unicode_literals
 
-from peewee import BooleanField, BlobField, FixedCharField, ForeignKeyField
+from peewee import BooleanField, FixedCharField, ForeignKeyField
 
 from ..actions import CQE_POV, Data, Write
+from ..peewee_extensions import BlobRefField
 from .base import BaseModel
 from .challenge_set import ChallengeSet
 from .concerns.indexed_blob_model import IndexedBlobModel
@@ -16,7 +17,7 @@ from .job import Job
 
 class Test(IndexedBlobModel, BaseModel): # Inherited classes order matters!
     """Test model"""
-    blob = BlobField()
+    blob = BlobRefField()
     cs = ForeignKeyField(ChallengeSet, related_name='tests')
     job = ForeignKeyField(Job, related_name='tests')
     drilled = BooleanField(null=False, default=False)
@@ -26,9 +27,88 @@ class Test(IndexedBlobModel, BaseModel): # Inherited classes order matters!
 
     @classmethod
     def unsynced_testcases(cls, prev_sync_time):
-        """Return test cases not synced"""
+        """Return test cases not synced, prefer since() which does not rely on clocks"""
         return cls.select().where(cls.created_at > prev_sync_time)
 
+    @classmethod
+    def create_commit_seq(cls):
+        """
+        Create the commit_seq column read by since(), the trigger setting it
+        and its indexes, and fill it for the rows created before.
+
+        commit_seq is not a model field, so that save() never writes it.
+        """
+        table = cls._meta.db_table
+        database = cls._meta.database
+        database.execute_sql("CREATE SEQUENCE IF NOT EXISTS {}_commit_seq_seq".format(table))
+        database.execute_sql("ALTER TABLE {} ADD COLUMN IF NOT EXISTS commit_seq BIGINT"
+                             .format(table))
+        database.execute_sql("ALTER SEQUENCE {0}_commit_seq_seq OWNED BY {0}.commit_seq"
+                             .format(table))
+        # Set when the inserting transaction commits, under a lock held until
+        # it is visible: commit_seq grows in commit order.
+        database.execute_sql("""
+            CREATE OR REPLACE FUNCTION set_{0}_commit_seq() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_advisory_xact_lock('{0}'::regclass::oid::bigint);
+                UPDATE {0} SET commit_seq = nextval('{0}_commit_seq_seq') WHERE id = NEW.id;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql""".format(table))
+        database.execute_sql("DROP TRIGGER IF EXISTS {0}_commit_seq ON {0}".format(table))
+        database.execute_sql("""
+            CREATE CONSTRAINT TRIGGER {0}_commit_seq
+            AFTER INSERT ON {0} DEFERRABLE INITIALLY DEFERRED
+            FOR EACH ROW EXECUTE PROCEDURE set_{0}_commit_seq()""".format(table))
+        database.execute_sql("CREATE INDEX IF NOT EXISTS {0}_cs_id_commit_seq "
+                             "ON {0} (cs_id, commit_seq)".format(table))
+        database.execute_sql("CREATE INDEX IF NOT EXISTS {0}_commit_seq "
+                             "ON {0} (commit_seq)".format(table))
+
+        # one statement, so that the lock is held even in autocommit mode
+        database.execute_sql("""
+            DO $$
+            BEGIN
+                PERFORM pg_advisory_xact_lock('{0}'::regclass::oid::bigint);
+                UPDATE {0} SET commit_seq = ordered.commit_seq
+                FROM (SELECT id, nextval('{0}_commit_seq_seq') AS commit_seq
+                      FROM (SELECT id FROM {0} WHERE commit_seq IS NULL ORDER BY id) AS t
+                     ) AS ordered
+                WHERE {0}.id = ordered.id;
+            END;
+            $$""".format(table))
+
+    @classmethod
+    def since(cls, cursor=0, cs=None, limit=None):
+        """
+        Return test cases committed after cursor, in commit order.
+
+        Test cases are ordered by commit_seq, set when the transaction which
+        created them commits (see create_commit_seq()), not by their own id: a
+        transaction still in flight can commit a lower id later. So no row
+        ever shows up behind the cursor, updating a row does not send it
+        again, and the clocks of the hosts creating tests do not matter.
+        Rows only hold a reference to their blob, fetched on access (or use
+        with_blobs() on a query for a batch fetch).
+
+        :param cursor: cursor returned by the previous call, 0 the first time.
+        :param cs: only return test cases of this challenge set.
+        :param limit: maximum number of test cases returned.
+        :return: (next cursor, list of test cases).
+        """
+        sql = "SELECT * FROM {} WHERE commit_seq > %s{} ORDER BY commit_seq{}"
+        params = [cursor]
+        cs_where = ""
+        if cs is not None:
+            cs_where = " AND cs_id = %s"
+            params.append(getattr(cs, 'id', cs))
+        limit_sql = ""
+        if limit is not None:
+            limit_sql = " LIMIT %s"
+            params.append(limit)
+        tests = list(cls.raw(sql.format(cls._meta.db_table, cs_where, limit_sql), *params))
+        return (tests[-1].commit_seq if tests else cursor), tests
+
     def to_cqe_pov_xml(self):
         """
             Method to convert job into to cqe xml format
@@ -3,8 +3,9 @@
 
 from __future__ import absolute_import, unicode_literals
 
-from peewee import BlobField, BooleanField, ForeignKeyField
+from peewee import BooleanField, ForeignKeyField
 
+from ..peewee_extensions import BlobRefField
 from .base import BaseModel
 from .challenge_set import ChallengeSet
 
@@ -14,6 +15,6 @@ from .challenge_set import ChallengeSet
 class TracerCache(BaseModel):
     """TracerCache model"""
     cs = ForeignKeyField(ChallengeSet, related_name='tracer_cache')
-    blob = BlobField(null=False)
+    blob = BlobRefField(null=False)
     concrete_flag = BooleanField(null=False)
     atoi_flag = BooleanField(null=False)
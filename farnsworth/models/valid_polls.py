@@ -3,13 +3,13 @@
 
 from __future__ import absolute_import, unicode_literals
 
-import os
-
-from peewee import BooleanField, BlobField, ForeignKeyField
+from peewee import BooleanField, ForeignKeyField
 
 from .test import Test
 from .challenge_set import ChallengeSet
 from .round import Round
+from ..binary_cache import get_cache
+from ..peewee_extensions import BlobRefField
 from .base import BaseModel
 
 
@@ -20,18 +20,14 @@ class ValidPoll(BaseModel):
     round = ForeignKeyField(Round, related_name='valid_polls', null=True)
     is_perf_ready = BooleanField(null=False, default=True)
     has_scores_computed = BooleanField(null=False, default=False)
-    blob = BlobField()
+    blob = BlobRefField()
 
     @property
-    def _path(self):
-        """Return path name"""
-        filename = "{}-{}".format(self.id, self.cbn.id)
-        return os.path.join(os.path.expanduser("~"), filename + '.xml')
+    def _filename(self):
+        """Return file name"""
+        return "{}-{}.xml".format(self.id, self.cs_id)
 
     @property
     def path(self):
-        """Save poll blob to file and return path"""
-        if not os.path.isfile(self._path):
-            with open(self._path, 'wb') as fp:
-                fp.write(self.blob)
-        return self._path
+        """Save poll blob to the shared cache and return path"""
+        return get_cache().path(self.blob_sha256(), self.open_blob, name=self._filename)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""Push notifications for new jobs, based on Postgres LISTEN/NOTIFY."""
+
+from __future__ import absolute_import, unicode_literals
+
+import os
+import select
+
+import psycopg2
+import psycopg2.extensions
+
+import farnsworth.log
+from .config import master_db
+
+LOG = farnsworth.log.LOG.getChild('notify')
+
+CHANNEL_PREFIX = 'jobs_'
+
+
+def channel(worker):
+    """Return the notification channel of a worker type"""
+    return CHANNEL_PREFIX + worker
+
+
+def create_trigger():
+    """
+    Install the trigger notifying every job that becomes available, that is
+    inserted or requeued with started_at set back to NULL.
+    The payload is the job id, sent on the channel of the job worker.
+    """
+    master_db.execute_sql("""
+        CREATE OR REPLACE FUNCTION notify_available_job() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('{prefix}' || NEW.worker, NEW.id::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql""".format(prefix=CHANNEL_PREFIX))
+    master_db.execute_sql("DROP TRIGGER IF EXISTS jobs_notify_available ON jobs")
+    master_db.execute_sql("""
+        CREATE TRIGGER jobs_notify_available
+        AFTER INSERT ON jobs
+        FOR EACH ROW WHEN (NEW.started_at IS NULL)
+        EXECUTE PROCEDURE notify_available_job()""")
+    # save() writes every column, only notify actual requeues
+    master_db.execute_sql("DROP TRIGGER IF EXISTS jobs_notify_requeued ON jobs")
+    master_db.execute_sql("""
+        CREATE TRIGGER jobs_notify_requeued
+        AFTER UPDATE OF started_at ON jobs
+        FOR EACH ROW WHEN (OLD.started_at IS NOT NULL AND NEW.started_at IS NULL)
+        EXECUTE PROCEDURE notify_available_job()""")
+
+
+class JobListener(object):
+    """
+    Listen for new jobs over a dedicated connection.
+
+    The connection is kept outside of the pool, because the LISTEN state lives
+    as long as the connection does. Notifications are only received after
+    listen() was called: claim pending jobs once after subscribing.
+    """
+
+    def __init__(self, *workers):
+        self._conn = psycopg2.connect(database=master_db.database, **master_db.connect_kwargs)
+        self._conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        self._workers = set()
+        for worker in workers:
+            self.listen(worker)
+
+    def listen(self, worker):
+        """Subscribe to the jobs of a worker type"""
+        if worker not in self._workers:
+            with self._conn.cursor() as cursor:
+                cursor.execute('LISTEN "{}"'.format(channel(worker)))
+            self._workers.add(worker)
+
+    def wait(self, timeout=None):
+        """
+        Block until new jobs are notified.
+
+        :param timeout: seconds to wait for, None to wait forever.
+        :return: list of (worker, job id) tuples, empty on timeout.
+        """
+        if not self._conn.notifies:
+            if select.select([self._conn], [], [], timeout) == ([], [], []):
+                return []
+        self._conn.poll()
+
+        jobs = []
+        while self._conn.notifies:
+            notify = self._conn.notifies.pop(0)
+            jobs.append((notify.channel[len(CHANNEL_PREFIX):], int(notify.payload)))
+        return jobs
+
+    def close(self):
+        """Close the dedicated connection"""
+        if not self._conn.closed:
+            self._conn.close()
+
+
+_LISTENERS = {}
+
+
+def wait_for_jobs(worker, timeout=None):
+    """
+    Block until jobs for worker are available.
+
+    Keeps one listener per worker and process, the first call starts listening.
+
+    :param worker: worker type, e.g. AFLJob.worker.default
+    :param timeout: seconds to wait for, None to wait forever.
+    :return: list of notified job ids, empty on timeout.
+    """
+    key = (os.getpid(), worker)
+    if key not in _LISTENERS:
+        LOG.debug("Listening for %s jobs", worker)
+        _LISTENERS[key] = JobListener(worker)
+    return [job_id for _, job_id in _LISTENERS[key].wait(timeout)]
@@ -3,9 +3,12 @@
 
 from __future__ import absolute_import, unicode_literals
 
-from peewee import Field, SQL
+from peewee import BlobField, Field, FieldDescriptor, FixedCharField, SelectQuery, SQL, returns_clone
 
 import itertools
+import zlib
+
+from .blobstore import get_store, sha256sum, to_bytes
 
 """Extend Peewee basic types."""
 
@@ -36,3 +39,236 @@ class EnumField(Field):
 
     def __ddl_column__(self, ctype):
         return SQL(self.enum_name)
+
+
+class Codec(object):
+    """Compression codec of a CompressedBlobField"""
+
+    def __init__(self, name, compress, decompress, decompressobj):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+        self.decompressobj = decompressobj
+
+
+class _RawDecompressor(object):
+    def decompress(self, data):     # pylint:disable=no-self-use
+        return data
+
+
+CODECS = {
+    'raw': Codec('raw', bytes, bytes, _RawDecompressor),
+    'zlib': Codec('zlib', zlib.compress, zlib.decompress, zlib.decompressobj),
+}
+
+try:
+    import lz4.frame
+    CODECS['lz4'] = Codec('lz4', lz4.frame.compress, lz4.frame.decompress,
+                          lz4.frame.LZ4FrameDecompressor)
+except ImportError:
+    pass
+
+try:
+    import zstandard
+    CODECS['zstd'] = Codec('zstd',
+                           lambda data: zstandard.ZstdCompressor().compress(data),
+                           lambda data: zstandard.ZstdDecompressor().decompress(data),
+                           lambda: zstandard.ZstdDecompressor().decompressobj())
+except ImportError:
+    pass
+
+
+class CompressedBlob(bytes):
+    """Compressed content of a CompressedBlobField, as stored in the database"""
+
+
+class CompressedBlobDescriptor(FieldDescriptor):
+    """Compress on assignment, decompress on first access"""
+
+    def __get__(self, instance, instance_type=None):
+        if instance is None:
+            return self.field
+        value = instance._data.get(self.att_name)
+        if value is None:
+            return None
+        cache = instance.__dict__.setdefault('_decompressed', {})
+        if self.att_name not in cache:
+            cache[self.att_name] = self.field.decompress(
+                instance._data.get(self.field.codec_field), value)
+        return cache[self.att_name]
+
+    def __set__(self, instance, value):
+        instance.__dict__.get('_decompressed', {}).pop(self.att_name, None)
+        if value is not None and not isinstance(value, CompressedBlob):
+            codec, value = self.field.compress(value)
+            setattr(instance, self.field.codec_field, codec)
+            value = CompressedBlob(value)
+        super(CompressedBlobDescriptor, self).__set__(instance, value)
+
+
+class CompressedBlobField(BlobField):
+    """
+    Define a CompressedBlobField type
+
+    Content is compressed with codec, unless that does not make it smaller,
+    and the codec used for each row is kept in the codec_field column.
+    Available codecs are in CODECS: raw and zlib, plus lz4 and zstd when
+    their modules are installed.
+    """
+
+    def __init__(self, codec_field='codec', codec='zlib', *args, **kwargs):
+        self.codec_field = codec_field
+        self.codec = codec
+        super(CompressedBlobField, self).__init__(*args, **kwargs)
+
+    def add_to_class(self, model_class, name):
+        super(CompressedBlobField, self).add_to_class(model_class, name)
+        setattr(model_class, name, CompressedBlobDescriptor(self))
+
+    def python_value(self, value):
+        if value is None:
+            return None
+        return CompressedBlob(value)
+
+    def compress(self, value, codec=None):
+        """
+        Compress value with codec, the field codec by default.
+
+        :return: (name of the codec used, compressed value).
+        """
+        value = to_bytes(value)
+        codec = codec or self.codec
+        compressed = CODECS[codec].compress(value)
+        if len(compressed) >= len(value):
+            return 'raw', value
+        return codec, compressed
+
+    def decompress(self, codec, value):     # pylint:disable=no-self-use
+        """Return value decompressed with codec"""
+        return CODECS[codec or 'raw'].decompress(bytes(value))
+
+
+class BlobRef(unicode):
+    """sha256 of a blob in the blob store, as read from the database"""
+
+
+class BlobRefDescriptor(FieldDescriptor):
+    """Fetch the referenced blob from the blob store on first access"""
+
+    def __get__(self, instance, instance_type=None):
+        if instance is None:
+            return self.field
+        value = instance._data.get(self.att_name)
+        if not isinstance(value, BlobRef):
+            return value
+        cache = instance.__dict__.setdefault('_blob_cache', {})
+        if value not in cache:
+            cache[value] = get_store().get(value)
+        return cache[value]
+
+    def __set__(self, instance, value):
+        instance.__dict__.get('_blob_sha256s', {}).pop(self.att_name, None)
+        if hasattr(value, 'read'):
+            # stream file objects to the store right away
+            value = BlobRef(get_store().put_file(value))
+        super(BlobRefDescriptor, self).__set__(instance, value)
+
+
+class BlobRefField(FixedCharField):
+    """
+    Define a BlobRefField type
+
+    The column only holds the sha256 of the content, stored once in the blob
+    store (see farnsworth.blobstore). The content is put in the store when the
+    row is saved (or inserted or updated through the model, see
+    models.base.BaseModel) and fetched back when the attribute is first read.
+    Assigning a file object streams its content to the store instead.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('max_length', 64)
+        super(BlobRefField, self).__init__(*args, **kwargs)
+
+    def add_to_class(self, model_class, name):
+        self.db_column = self.db_column or "{}_sha256".format(name)
+        super(BlobRefField, self).add_to_class(model_class, name)
+        setattr(model_class, name, BlobRefDescriptor(self))
+
+    def db_value(self, value):
+        # only hash: values compared in queries must not end up in the store,
+        # models store new blobs on save(), update() and insert()
+        if value is None or isinstance(value, BlobRef):
+            return value
+        return sha256sum(to_bytes(value))
+
+    def python_value(self, value):
+        if value is None:
+            return None
+        return BlobRef(value.strip())
+
+
+def load_blobs(instances, *names):
+    """
+    Fetch the blobs referenced by instances at once, instead of one by one on
+    first access.
+
+    :param instances: model instances, of the same model.
+    :param names: BlobRefFields to load, all of them by default.
+    """
+    instances = list(instances)
+    if not instances:
+        return
+    fields = instances[0]._meta.fields
+    names = names or [name for name, field in fields.items() if isinstance(field, BlobRefField)]
+    refs = set()
+    for instance in instances:
+        cache = instance.__dict__.setdefault('_blob_cache', {})
+        for name in names:
+            value = instance._data.get(name)
+            if isinstance(value, BlobRef) and value not in cache:
+                refs.add(value)
+    blobs = get_store().get_many(refs)
+    for instance in instances:
+        for name in names:
+            value = instance._data.get(name)
+            if value in blobs:
+                instance._blob_cache[value] = blobs[value]
+
+
+class BlobSelectQuery(SelectQuery):
+    """SelectQuery which can load the blobs of the selected rows along with them"""
+
+    def __init__(self, *args, **kwargs):
+        super(BlobSelectQuery, self).__init__(*args, **kwargs)
+        self._with_blobs = None
+
+    def _clone_attributes(self, query):
+        query = super(BlobSelectQuery, self)._clone_attributes(query)
+        query._with_blobs = self._with_blobs
+        return query
+
+    @returns_clone
+    def with_blobs(self, *names):
+        """
+        Load the blobs in one go when the query is executed, see load_blobs().
+
+        :param names: BlobRefFields to load, all of them by default.
+        """
+        self._with_blobs = names
+
+    def _load_blobs(self):
+        return self._with_blobs is not None and \
+            not (self._tuples or self._dicts or self._namedtuples)
+
+    def __iter__(self):
+        result_wrapper = self.execute()
+        if self._load_blobs() and not result_wrapper._populated:
+            result_wrapper.fill_cache()
+            load_blobs(result_wrapper, *self._with_blobs)
+        return iter(result_wrapper)
+
+    def get(self):
+        instance = super(BlobSelectQuery, self).get()
+        if self._load_blobs():
+            load_blobs([instance], *self._with_blobs)
+        return instance
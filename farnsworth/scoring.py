@@ -0,0 +1,283 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+CQE scoring formulas, see https://cgc.darpa.mil/CQE_Scoring.pdf
+
+The formulas of mixins.cb_score_mixin.CBScoreMixin are also defined:
+
+- as Postgres functions, so that the scores of many CBs are computed in a
+  single statement, e.g. by ChallengeBinaryNode.cb_scores():
+
+      SELECT cqe_cb_score(size_overhead, memory_overhead, time_overhead, success, security)
+
+- over NumPy arrays, to score whole tables of PatchScore and PollFeedback
+  rows at once for offline analysis, e.g.:
+
+      from farnsworth import scoring
+      columns = scoring.patch_scores(cs=cs)
+      best = columns['id'][columns['cb_score'].argmax()]
+
+  NumPy is only needed for these.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+from .config import master_db, slave_db
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BIG_OVERHEAD = 9999     # ratio used by PatchScore when the reference value is 0
+
+
+def create_objects():
+    """Create the scoring functions"""
+    master_db.execute_sql("""
+        CREATE OR REPLACE FUNCTION cqe_performance_score(perf_factor DOUBLE PRECISION)
+        RETURNS DOUBLE PRECISION AS $$
+            SELECT CASE
+                WHEN perf_factor >= 0 AND perf_factor < 1.10 THEN 1
+                WHEN perf_factor >= 1.10 AND perf_factor < 1.62 THEN power(perf_factor - 0.1, -4)
+                WHEN perf_factor >= 1.62 AND perf_factor < 2 THEN -0.493 * perf_factor + 0.986
+                ELSE 0
+            END::DOUBLE PRECISION
+        $$ LANGUAGE SQL IMMUTABLE""")
+    master_db.execute_sql("""
+        CREATE OR REPLACE FUNCTION cqe_functionality_score(success DOUBLE PRECISION)
+        RETURNS DOUBLE PRECISION AS $$
+            SELECT CASE
+                WHEN success = 1 THEN 1
+                WHEN success >= 0.40 AND success < 1 THEN power(2 - success, -4)
+                WHEN success > 0 AND success < 0.40 THEN 0.381 * success
+                ELSE 0
+            END::DOUBLE PRECISION
+        $$ LANGUAGE SQL IMMUTABLE""")
+    master_db.execute_sql("""
+        CREATE OR REPLACE FUNCTION cqe_cb_score(size_overhead DOUBLE PRECISION,
+                                                memory_overhead DOUBLE PRECISION,
+                                                time_overhead DOUBLE PRECISION,
+                                                success DOUBLE PRECISION,
+                                                security DOUBLE PRECISION)
+        RETURNS DOUBLE PRECISION AS $$
+            SELECT least(cqe_performance_score(1 + greatest(0.25 * size_overhead,
+                                                            memory_overhead,
+                                                            time_overhead)),
+                         cqe_functionality_score(success)) * security
+        $$ LANGUAGE SQL IMMUTABLE""")
+
+
+def drop_objects():
+    """Drop the scoring functions"""
+    master_db.execute_sql("DROP FUNCTION IF EXISTS cqe_cb_score(DOUBLE PRECISION, DOUBLE PRECISION, "
+                          "DOUBLE PRECISION, DOUBLE PRECISION, DOUBLE PRECISION)")
+    master_db.execute_sql("DROP FUNCTION IF EXISTS cqe_performance_score(DOUBLE PRECISION)")
+    master_db.execute_sql("DROP FUNCTION IF EXISTS cqe_functionality_score(DOUBLE PRECISION)")
+
+
+def inputs_sql(where):
+    """
+    Return the CTEs computing the inputs of the formulas for fieldings with
+    poll feedback, as PollFeedback does: size against the CBNs of our first
+    fielding of the CS, security from the patch type of the first CBN.
+    REAL columns go through their text form, as when read by psycopg2, so
+    that 0.2 stays 0.2 as in Python rather than becoming 0.2000000029802322.
+
+    :param where: condition on the fieldings, over the aliases csf
+                  (challenge set fieldings), pf (poll feedbacks) and t (teams).
+    :return: (SQL of the CTEs, ending with inputs(id, feedback_id, success,
+             time_overhead, memory_overhead, size_overhead, security), params
+             to pass after those of where).
+    """
+    from .models import (ChallengeBinaryNode, ChallengeSetFielding, PatchType, PollFeedback,
+                         Round, Team)
+    sql = """
+        WITH fieldings AS (
+            SELECT csf.id, csf.cs_id, pf.id AS feedback_id,
+                   pf.success::TEXT::DOUBLE PRECISION AS success,
+                   pf.time_overhead::TEXT::DOUBLE PRECISION AS time_overhead,
+                   pf.memory_overhead::TEXT::DOUBLE PRECISION AS memory_overhead,
+                   (SELECT sum(c.size) FROM {through} AS tm
+                    JOIN {cbns} AS c ON c.id = tm.challengebinarynode_id
+                    WHERE tm.challengesetfielding_id = csf.id) AS size,
+                   (SELECT 2 - pt.exploitability::TEXT::DOUBLE PRECISION FROM {through} AS tm
+                    JOIN {cbns} AS c ON c.id = tm.challengebinarynode_id
+                    LEFT JOIN {patch_types} AS pt ON pt.id = c.patch_type_id
+                    WHERE tm.challengesetfielding_id = csf.id
+                    ORDER BY c.id LIMIT 1) AS security
+            FROM {fieldings} AS csf
+            JOIN {poll_feedbacks} AS pf ON pf.id = csf.poll_feedback_id
+            JOIN {teams} AS t ON t.id = csf.team_id
+            WHERE {where}
+        ), originals AS (
+            SELECT DISTINCT ON (csf.cs_id) csf.cs_id,
+                   (SELECT sum(c.size) FROM {through} AS tm
+                    JOIN {cbns} AS c ON c.id = tm.challengebinarynode_id
+                    WHERE tm.challengesetfielding_id = csf.id) AS size
+            FROM {fieldings} AS csf
+            JOIN {teams} AS t ON t.id = csf.team_id
+            JOIN {rounds} AS r ON r.id = csf.available_round_id
+            WHERE t.name = %s AND csf.cs_id IN (SELECT cs_id FROM fieldings)
+            ORDER BY csf.cs_id, r.created_at
+        ), inputs AS (
+            SELECT f.id, f.feedback_id, f.success, f.time_overhead, f.memory_overhead,
+                   greatest(f.size::DOUBLE PRECISION / nullif(o.size, 0) - 1, 0) AS size_overhead,
+                   coalesce(f.security, 1)::DOUBLE PRECISION AS security
+            FROM fieldings AS f JOIN originals AS o ON o.cs_id = f.cs_id
+        )
+    """.format(through=ChallengeSetFielding.cbns.get_through_model()._meta.db_table,
+               cbns=ChallengeBinaryNode._meta.db_table,
+               patch_types=PatchType._meta.db_table,
+               fieldings=ChallengeSetFielding._meta.db_table,
+               poll_feedbacks=PollFeedback._meta.db_table,
+               teams=Team._meta.db_table,
+               rounds=Round._meta.db_table,
+               where=where)
+    return sql, [Team.OUR_NAME]
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError("NumPy is required for vectorised scoring")
+
+
+def performance_score(size_overhead, memory_overhead, time_overhead):
+    """Vectorised CBScoreMixin.cqe_performance_score"""
+    _require_numpy()
+    perf_factor = 1 + numpy.maximum(numpy.maximum(0.25 * size_overhead, memory_overhead),
+                                    time_overhead)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return numpy.select([(0 <= perf_factor) & (perf_factor < 1.10),
+                             (1.10 <= perf_factor) & (perf_factor < 1.62),
+                             (1.62 <= perf_factor) & (perf_factor < 2)],
+                            [1.0,
+                             (perf_factor - 0.1) ** -4,
+                             (-1 * 0.493 * perf_factor) + 0.986],
+                            0.0)
+
+
+def functionality_score(success):
+    """Vectorised CBScoreMixin.cqe_functionality_score"""
+    _require_numpy()
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return numpy.select([success == 1,
+                             (0.40 <= success) & (success < 1),
+                             (0 < success) & (success < 0.40)],
+                            [1.0,
+                             (2 - success) ** (-4),
+                             0.381 * success],
+                            0.0)
+
+
+def score(columns):
+    """
+    Compute the CQE scores of rows.
+
+    :param columns: dict of arrays, with size_overhead, memory_overhead,
+                    time_overhead, success and security.
+    :return: columns, with cqe_performance_score, cqe_functionality_score,
+             availability and cb_score added.
+    """
+    columns['cqe_performance_score'] = performance_score(columns['size_overhead'],
+                                                         columns['memory_overhead'],
+                                                         columns['time_overhead'])
+    columns['cqe_functionality_score'] = functionality_score(columns['success'])
+    columns['availability'] = numpy.minimum(columns['cqe_performance_score'],
+                                            columns['cqe_functionality_score'])
+    columns['cb_score'] = columns['availability'] * columns['security']
+    return columns
+
+
+def _load(sql, params, names):
+    """Run a query and return its columns as float arrays, one per name"""
+    _require_numpy()
+    database = slave_db if slave_db is not None else master_db
+    rows = database.execute_sql(sql, params, require_commit=False).fetchall()
+    array = numpy.array(rows, dtype=float).reshape(len(rows), len(names))
+    columns = {name: array[:, i] for i, name in enumerate(names)}
+    columns['id'] = columns['id'].astype(int)
+    return columns
+
+
+def _where(cs, round, cs_column, round_column):
+    where, params = ["TRUE"], []
+    if cs is not None:
+        where.append("{} = %s".format(cs_column))
+        params.append(getattr(cs, 'id', cs))
+    if round is not None:
+        where.append("{} = %s".format(round_column))
+        params.append(getattr(round, 'id', round))
+    return " AND ".join(where), params
+
+
+def _ratio(rep, ref):
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return numpy.where(ref != 0, (rep * 1.0) / ref, BIG_OVERHEAD)
+
+
+def patch_scores(cs=None, round=None):
+    """
+    Load and score PatchScore rows with one query, as PatchScore does.
+
+    :param cs: only load patch scores of this challenge set.
+    :param round: only load patch scores of this round.
+    :return: dict of arrays: id, the inputs of the formulas and the scores,
+             see score().
+    """
+    from .models import PatchScore, PatchType
+    where, params = _where(cs, round, "ps.cs_id", "ps.round_id")
+    measures = [(side, measure) for measure in ['task_clock', 'rss', 'flt', 'file_size']
+                for side in ['rep', 'ref']]
+    sql = """
+        SELECT ps.id, ps.has_failed_polls::INTEGER, pt.functionality_risk, pt.exploitability,
+               {measures}
+        FROM {patch_scores} AS ps
+        JOIN {patch_types} AS pt ON pt.id = ps.patch_type_id
+        WHERE {where}
+        ORDER BY ps.id
+    """.format(measures=", ".join("(ps.perf_score #>> '{{score,{},{}}}')::DOUBLE PRECISION"
+                                  .format(side, measure) for side, measure in measures),
+               patch_scores=PatchScore._meta.db_table,
+               patch_types=PatchType._meta.db_table,
+               where=where)
+    raw = _load(sql, params, ['id', 'has_failed_polls', 'functionality_risk', 'exploitability'] +
+                ["{}_{}".format(side, measure) for side, measure in measures])
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        size_overhead = ((raw['rep_file_size'] * 1.0) / raw['ref_file_size']) - 1
+    columns = {
+        'id': raw['id'],
+        'success': numpy.where(raw['has_failed_polls'] != 0, 0.0, 1 - raw['functionality_risk']),
+        'security': 2 - raw['exploitability'],
+        'time_overhead': _ratio(raw['rep_task_clock'], raw['ref_task_clock']) - 1,
+        'memory_overhead': 0.5 * (_ratio(raw['rep_rss'], raw['ref_rss'])
+                                  + _ratio(raw['rep_flt'], raw['ref_flt'])) - 1,
+        'size_overhead': size_overhead,
+    }
+    return score(columns)
+
+
+def poll_feedbacks(cs=None, round=None):
+    """
+    Load and score PollFeedback rows with one query, as PollFeedback does.
+    Feedbacks without fielding by our team are left out, those with many
+    fieldings are scored once, against the first one.
+
+    :param cs: only load feedbacks of this challenge set.
+    :param round: only load feedbacks of this round.
+    :return: dict of arrays: id, the inputs of the formulas and the scores,
+             see score().
+    """
+    from .models import Team
+    where, params = _where(cs, round, "pf.cs_id", "pf.round_id")
+    sql, inputs_params = inputs_sql("t.name = %s AND " + where)
+    sql += """
+        SELECT DISTINCT ON (feedback_id)
+               feedback_id, success, time_overhead, memory_overhead, size_overhead, security
+        FROM inputs
+        ORDER BY feedback_id, id
+    """
+    names = ['id', 'success', 'time_overhead', 'memory_overhead', 'size_overhead', 'security']
+    return score(_load(sql, [Team.OUR_NAME] + params + inputs_params, names))
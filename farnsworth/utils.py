@@ -20,3 +20,30 @@ def stupid_pluralize(string):
 def table_name(cls):
     """TableModel => table_models"""
     return stupid_pluralize(camel_case_to_underscore(cls.__name__))
+
+class cached_property(object):  # pylint:disable=invalid-name,too-few-public-methods
+    """
+    Property computed on first access, then cached on the instance until
+    invalidate_cached_properties() (models call it on save).
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        cache = instance.__dict__.setdefault('_cached_properties', {})
+        if self.__name__ not in cache:
+            cache[self.__name__] = self.func(instance)
+        return cache[self.__name__]
+
+def set_cached_property(instance, name, value):
+    """Fill the cache of a cached_property, e.g. from a bulk query"""
+    instance.__dict__.setdefault('_cached_properties', {})[name] = value
+
+def invalidate_cached_properties(instance):
+    """Forget the cached_property values of instance, they are recomputed on next access"""
+    instance.__dict__.pop('_cached_properties', None)
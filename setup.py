@@ -27,6 +27,7 @@ setup(name='farnsworth',
                 "farnsworth.mixins", "farnsworth.models", "farnsworth.models.concerns"],
       entry_points={'console_scripts': ["farnsworth=farnsworth.__main__:main"]},
       install_requires=requires,
+      extras_require={'scoring': ["numpy"]},  # farnsworth.scoring
       dependency_links=dependencies,
       description="Knowledge base of the Shellphish CRS",
       url="https://github.com/mechaphish/farnsworth")
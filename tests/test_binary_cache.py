@@ -0,0 +1,122 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import io
+import os
+import shutil
+import stat
+import tempfile
+
+from nose.tools import *
+
+from . import setup_each, teardown_each
+from farnsworth.binary_cache import BinaryCache, get_cache, set_cache
+from farnsworth.models import ChallengeBinaryNode, ChallengeSet, ValidPoll
+
+
+def _opener(data):
+    opened = []
+
+    def opener():
+        opened.append(data)
+        return io.BytesIO(data)
+    return opener, opened
+
+
+class TestBinaryCache:
+    def setup(self):
+        setup_each()
+        self.root = tempfile.mkdtemp()
+        self.previous = get_cache()
+
+    def teardown(self):
+        set_cache(self.previous)
+        shutil.rmtree(self.root)
+        teardown_each()
+
+    def test_path(self):
+        cache = BinaryCache(self.root)
+        sha256 = hashlib.sha256(b"a blob").hexdigest()
+        opener, opened = _opener(b"a blob")
+
+        path = cache.path(sha256, opener)
+        assert_equals(open(path, 'rb').read(), b"a blob")
+        named_path = cache.path(sha256, opener, name="foo")
+        assert_equals(named_path, cache.named_path("foo"))
+        assert_equals(os.stat(named_path).st_ino, os.stat(path).st_ino)
+        assert_equals(len(opened), 1)
+        assert_false(os.stat(path).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+        cache.remove_name("foo")
+        assert_false(os.path.exists(named_path))
+        assert_true(os.path.exists(path))
+
+    def test_evict(self):
+        cache = BinaryCache(self.root, max_size=10)
+        paths = []
+        for i in range(3):
+            data = b"blob {}".format(i)
+            opener, _ = _opener(data)
+            paths.append(cache.path(hashlib.sha256(data).hexdigest(), opener, name=str(i)))
+            os.utime(cache.blob_path(hashlib.sha256(data).hexdigest()), (i, i))
+
+        # each blob is 6 bytes, only the most recent one fits
+        assert_false(os.path.exists(paths[0]))
+        assert_false(os.path.exists(paths[1]))
+        assert_true(os.path.exists(paths[2]))
+
+    def test_evict_in_use(self):
+        cache = BinaryCache(self.root, max_size=None)
+        sha256s = []
+        for i in range(3):
+            data = b"blob {}".format(i)
+            opener, _ = _opener(data)
+            sha256s.append(hashlib.sha256(data).hexdigest())
+            cache.path(sha256s[-1], opener, name=str(i))
+
+        # blob 0 is being read, blob 1 linked outside of the cache
+        opener, _ = _opener(b"blob 0")
+        with cache._shared(sha256s[0], opener, 0o444):
+            os.link(cache.blob_path(sha256s[1]), os.path.join(self.root, "elsewhere"))
+            cache.evict(0)
+        assert_true(os.path.exists(cache.blob_path(sha256s[0])))
+        assert_true(os.path.exists(cache.named_path("0")))
+        assert_true(os.path.exists(cache.blob_path(sha256s[1])))
+        assert_false(os.path.exists(cache.blob_path(sha256s[2])))
+        assert_false(os.path.exists(cache.named_path("2")))
+
+        # readers of an evicted blob materialise it again
+        cache.evict(0)
+        assert_false(os.path.exists(cache.blob_path(sha256s[0])))
+        assert_equals(open(cache.path(sha256s[0], opener, name="0"), 'rb').read(), b"blob 0")
+
+    def test_models(self):
+        set_cache(BinaryCache(self.root))
+        cs = ChallengeSet.create(name="foo")
+        cbn = ChallengeBinaryNode.create(name="mybin", cs=cs, blob="blob data")
+        path = cbn.path
+        assert_true(path.startswith(self.root))
+        assert_equals(open(path, 'rb').read(), b"blob data")
+        prefixed_path = cbn.prefix_path("patched-", shared=True)
+        assert_equals(os.path.basename(prefixed_path), "patched-" + os.path.basename(path))
+        assert_equals(os.stat(prefixed_path).st_ino, os.stat(path).st_ino)
+        assert_false(os.stat(path).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        assert_true(os.stat(path).st_mode & stat.S_IXUSR)
+
+        writable_path = cbn.prefix_path("patched-")
+        assert_equals(os.path.basename(writable_path), "patched-" + os.path.basename(path))
+        assert_not_equals(os.stat(writable_path).st_ino, os.stat(path).st_ino)
+        assert_true(os.stat(writable_path).st_mode & stat.S_IWUSR)
+        with open(writable_path, 'ab') as fp:
+            fp.write(b" patched")
+        assert_equals(open(writable_path, 'rb').read(), b"blob data patched")
+        assert_equals(open(path, 'rb').read(), b"blob data")
+        assert_equals(open(cbn.prefix_path("patched-"), 'rb').read(), b"blob data")
+        cbn.delete_binary()
+        assert_false(os.path.exists(path))
+
+        poll = ValidPoll.create(cs=cs, blob="<pov></pov>")
+        assert_equals(open(poll.path, 'rb').read(), b"<pov></pov>")
@@ -0,0 +1,255 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+from datetime import datetime, timedelta
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+
+from nose.tools import *
+
+from . import setup_each, teardown_each
+import farnsworth.blobstore
+import farnsworth
+from farnsworth.blobstore import (FilesystemBlobStore, PostgresBlobStore, collect_garbage,
+                                  compress_blobs, get_store, set_store)
+from farnsworth.models import AFLJob, Blob, ChallengeSet, RawRoundTraffic, Round
+import farnsworth.models    # to avoid collisions between Test and nosetests
+
+
+class TestBlobStore:
+    def setup(self):
+        setup_each()
+
+    def teardown(self):
+        teardown_each()
+
+    def test_postgres_put_get(self):
+        store = PostgresBlobStore()
+        sha256 = store.put(b"a blob")
+        assert_equals(sha256, hashlib.sha256(b"a blob").hexdigest())
+        assert_equals(store.put(b"a blob"), sha256)
+        assert_equals(Blob.select().where(Blob.sha256 == sha256).count(), 1)
+        assert_equals(store.get(sha256), b"a blob")
+        assert_true(store.exists(sha256))
+        assert_equals(store.get_many([sha256, "0" * 64]), {sha256: b"a blob"})
+        assert_raises(KeyError, store.get, "0" * 64)
+
+    def test_filesystem_put_get(self):
+        root = tempfile.mkdtemp()
+        try:
+            store = FilesystemBlobStore(root)
+            sha256 = store.put(b"a blob")
+            assert_equals(store.put(b"a blob"), sha256)
+            assert_equals(store.get(sha256), b"a blob")
+            assert_true(store.exists(sha256))
+            assert_false(store.exists("0" * 64))
+            assert_raises(KeyError, store.get, "0" * 64)
+        finally:
+            shutil.rmtree(root)
+
+    def test_blob_ref_field(self):
+        cs = ChallengeSet.create(name="foo")
+        job = AFLJob.create()
+        test1 = farnsworth.models.Test.create(cs=cs, job=job, blob="a blob", sha256="1")
+        test2 = farnsworth.models.Test.create(cs=cs, job=job, blob="a blob", sha256="2")
+        sha256 = hashlib.sha256(b"a blob").hexdigest()
+        assert_equals(Blob.select().where(Blob.sha256 == sha256).count(), 1)
+
+        # rows only hold the reference, the blob is fetched on access
+        test = farnsworth.models.Test.get(farnsworth.models.Test.id == test1.id)
+        assert_equals(test._data['blob'], sha256)
+        assert_equals(test.blob, b"a blob")
+
+        # saving without touching the blob does not store it again
+        test.drilled = True
+        test.save()
+        test.blob = "another blob"
+        test.save()
+        assert_equals(str(farnsworth.models.Test.get(farnsworth.models.Test.id == test1.id).blob),
+                      "another blob")
+        assert_equals(str(farnsworth.models.Test.get(farnsworth.models.Test.id == test2.id).blob),
+                      "a blob")
+
+    def test_blob_ref_field_queries(self):
+        cs = ChallengeSet.create(name="foo")
+        job = AFLJob.create()
+        test = farnsworth.models.Test.create(cs=cs, job=job, blob="a blob")
+        Test = farnsworth.models.Test
+
+        # comparing with a blob only hashes it
+        assert_equals(Test.select().where(Test.blob == "a blob").get().id, test.id)
+        assert_equals(Test.select().where(Test.blob == "not stored").count(), 0)
+        assert_false(get_store().exists(hashlib.sha256(b"not stored").hexdigest()))
+
+        # writing one through the model stores it
+        Test.update(blob="updated").where(Test.id == test.id).execute()
+        assert_equals(str(Test.get(Test.id == test.id).blob), "updated")
+        Test.insert(cs=cs, job=job, blob="inserted", sha256="1").execute()
+        assert_equals(str(Test.get(Test.sha256 == "1").blob), "inserted")
+
+    def test_set_store(self):
+        root = tempfile.mkdtemp()
+        previous = get_store()
+        try:
+            set_store(FilesystemBlobStore(root))
+            cs = ChallengeSet.create(name="foo")
+            job = AFLJob.create()
+            test = farnsworth.models.Test.create(cs=cs, job=job, blob="a blob")
+            assert_equals(Blob.select().count(), 0)
+            assert_true(get_store().exists(hashlib.sha256(b"a blob").hexdigest()))
+            test = farnsworth.models.Test.get(farnsworth.models.Test.id == test.id)
+            assert_equals(test.blob, b"a blob")
+        finally:
+            set_store(previous)
+            shutil.rmtree(root)
+
+    def test_with_blobs(self):
+        class CountingBlobStore(PostgresBlobStore):
+            fetches = 0
+
+            def get_many(self, sha256s):
+                CountingBlobStore.fetches += 1
+                return super(CountingBlobStore, self).get_many(sha256s)
+
+        previous = get_store()
+        try:
+            set_store(CountingBlobStore())
+            cs = ChallengeSet.create(name="foo")
+            job = AFLJob.create()
+            for i in range(3):
+                farnsworth.models.Test.create(cs=cs, job=job, blob="blob {}".format(i))
+
+            tests = list(cs.tests.order_by(farnsworth.models.Test.id))
+            assert_equals(CountingBlobStore.fetches, 0)
+            assert_equals([str(t.blob) for t in tests], ["blob 0", "blob 1", "blob 2"])
+            assert_equals(CountingBlobStore.fetches, 3)
+
+            tests = list(cs.tests.order_by(farnsworth.models.Test.id).with_blobs())
+            assert_equals(CountingBlobStore.fetches, 4)
+            assert_equals([str(t.blob) for t in tests], ["blob 0", "blob 1", "blob 2"])
+            assert_equals(CountingBlobStore.fetches, 4)
+
+            test = cs.tests.with_blobs('blob').get()
+            assert_equals(CountingBlobStore.fetches, 5)
+            assert_in(str(test.blob), ["blob 0", "blob 1", "blob 2"])
+            assert_equals(CountingBlobStore.fetches, 5)
+        finally:
+            set_store(previous)
+
+    def test_postgres_open(self):
+        store = PostgresBlobStore()
+        data = os.urandom(10000)    # incompressible, stored raw, so seekable
+        sha256 = store.put(data)
+        chunk_size = farnsworth.blobstore.CHUNK_SIZE
+        try:
+            farnsworth.blobstore.CHUNK_SIZE = 4096
+            fp = store.open(sha256)
+            assert_equals(fp.read(10), data[:10])
+            fp.seek(5000)
+            assert_equals(fp.read(), data[5000:])
+            assert_equals(fp.read(), b"")
+        finally:
+            farnsworth.blobstore.CHUNK_SIZE = chunk_size
+        assert_raises(KeyError, store.open, "0" * 64)
+
+    def test_filesystem_put_file(self):
+        root = tempfile.mkdtemp()
+        try:
+            store = FilesystemBlobStore(root)
+            sha256 = store.put_file(io.BytesIO(b"a blob"))
+            assert_equals(sha256, hashlib.sha256(b"a blob").hexdigest())
+            assert_equals(store.open(sha256).read(), b"a blob")
+            assert_raises(KeyError, store.open, "0" * 64)
+        finally:
+            shutil.rmtree(root)
+
+    def test_stream_model_blob(self):
+        round_ = Round.create(num=0)
+        traffic = RawRoundTraffic.create(round=round_, pickled_data=io.BytesIO(b"0123456789"))
+        traffic = RawRoundTraffic.get(RawRoundTraffic.id == traffic.id)
+        assert_equals(traffic.open_blob('pickled_data').read(), b"0123456789")
+        assert_equals(list(traffic.iter_chunks(4)), [b"0123", b"4567", b"89"])
+        assert_equals(str(traffic.pickled_data), b"0123456789")
+
+        # unsaved blobs are served from memory
+        traffic = RawRoundTraffic(round=round_, pickled_data="abc")
+        assert_equals(list(traffic.iter_chunks(2)), [b"ab", b"c"])
+
+    def test_compression(self):
+        store = PostgresBlobStore()
+        compressible = b"a" * 10000
+        random = os.urandom(1000)
+        sha256 = store.put(compressible)
+        random_sha256 = store.put(random)
+        blob = Blob.get(Blob.sha256 == sha256)
+        assert_equals(blob.codec, 'zlib')
+        assert_less(len(blob._data['data']), 100)
+        assert_equals(blob.size, 10000)
+        assert_equals(blob.data, compressible)
+        assert_equals(Blob.get(Blob.sha256 == random_sha256).codec, 'raw')
+
+        assert_equals(store.get_many([sha256, random_sha256]),
+                      {sha256: compressible, random_sha256: random})
+        chunk_size = farnsworth.blobstore.CHUNK_SIZE
+        try:
+            farnsworth.blobstore.CHUNK_SIZE = 16
+            assert_equals(store.open(sha256).read(), compressible)
+            assert_equals(store.open(random_sha256).read(), random)
+        finally:
+            farnsworth.blobstore.CHUNK_SIZE = chunk_size
+
+    def test_compress_blobs(self):
+        # compress_blobs() commits every batch, keep it in a transaction
+        with Blob._meta.database.atomic() as transaction:
+            store = PostgresBlobStore()
+            sha256 = store.put(b"a" * 10000)
+            Blob.update(codec='raw', data=b"a" * 10000).where(Blob.sha256 == sha256).execute()
+            assert_equals(store.get(sha256), b"a" * 10000)
+
+            assert_equals(compress_blobs(batch_size=1), 1)
+            assert_equals(Blob.get(Blob.sha256 == sha256).codec, 'zlib')
+            assert_equals(store.get(sha256), b"a" * 10000)
+            assert_equals(compress_blobs(), 0)
+            transaction.rollback()
+
+    def test_postgres_collect_garbage(self):
+        store = PostgresBlobStore()
+        cs = ChallengeSet.create(name="foo")
+        test = farnsworth.models.Test.create(cs=cs, job=AFLJob.create(), blob="referenced")
+        old, recent, put_again = store.put(b"old"), store.put(b"recent"), store.put(b"put again")
+        Blob.update(updated_at=datetime.now() - timedelta(days=2)) \
+            .where(Blob.sha256 << [test.blob_sha256(), old, put_again]).execute()
+        store.put(b"put again")
+
+        assert_equals(collect_garbage(farnsworth.tables()), 1)
+        assert_false(store.exists(old))
+        for sha256 in [test.blob_sha256(), recent, put_again]:
+            assert_true(store.exists(sha256))
+
+    def test_filesystem_collect_garbage(self):
+        root = tempfile.mkdtemp()
+        previous = get_store()
+        try:
+            store = FilesystemBlobStore(root)
+            set_store(store)
+            cs = ChallengeSet.create(name="foo")
+            test = farnsworth.models.Test.create(cs=cs, job=AFLJob.create(), blob="referenced")
+            old, recent, put_again = store.put(b"old"), store.put(b"recent"), store.put(b"put again")
+            two_days_ago = time.time() - 2 * 24 * 3600
+            for sha256 in [test.blob_sha256(), old, put_again]:
+                os.utime(store.path(sha256), (two_days_ago, two_days_ago))
+            store.put(b"put again", put_again)
+
+            assert_equals(collect_garbage(farnsworth.tables()), 1)
+            assert_false(store.exists(old))
+            for sha256 in [test.blob_sha256(), recent, put_again]:
+                assert_true(store.exists(sha256))
+        finally:
+            set_store(previous)
+            shutil.rmtree(root)
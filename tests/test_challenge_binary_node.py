@@ -5,6 +5,7 @@ from __future__ import absolute_import, unicode_literals
 
 from datetime import datetime
 import os
+import struct
 import time
 
 from nose.tools import *
@@ -23,6 +24,24 @@ BLOB4 = "blob data4"
 BLOB5 = "blob data5"
 
 
+def _elf(text):
+    """Build a CGC binary with .text, .bss and .shstrtab sections"""
+    shstrtab = b"\x00.text\x00.bss\x00.shstrtab\x00"
+    text_offset = 0x34
+    shstrtab_offset = text_offset + len(text)
+    shoff = shstrtab_offset + len(shstrtab)
+    header = b"\x7fCGC\x01\x01\x01" + b"\x00" * 9 + struct.pack(
+        '<HHIIIIIHHHHHH', 2, 3, 1, 0x8048000, 0, shoff, 0, 0x34, 0, 0, 40, 4, 3)
+    sections = [(0, 0, 0, 0, 0, 0),
+                (1, 1, 0x8048000 + text_offset, text_offset, len(text), 16),     # .text
+                (7, 8, 0x8049000, shoff, 0x100, 4),                               # .bss
+                (12, 3, 0, shstrtab_offset, len(shstrtab), 1)]                    # .shstrtab
+    headers = b"".join(struct.pack('<IIIIIIIIII', name, type_, 0, addr, offset, size, 0, 0,
+                                   align, 0)
+                       for name, type_, addr, offset, size, align in sections)
+    return header + text + shstrtab + headers
+
+
 class TestChallengeBinaryNode:
     def setup(self):
         setup_each()
@@ -112,3 +131,35 @@ class TestChallengeBinaryNode:
                                                          round=r0)
         assert_equals(len(cbn.submitted_patches), 2)
         assert_equals(len(cbn.unsubmitted_patches), 0)
+
+    def test_mmap(self):
+        cs = ChallengeSet.create(name="foo")
+        data = _elf(b"\x31\xc0\x40\xcd\x80")
+        cbn = ChallengeBinaryNode.create(name="elf", cs=cs, blob=data)
+        cbn = ChallengeBinaryNode.get(ChallengeBinaryNode.id == cbn.id)
+
+        mapped = cbn.mmap()
+        assert_is(cbn.mmap(), mapped)
+        assert_equals(mapped[:], data)
+        assert_equals(bytes(cbn.view(4, 8)), data[4:12])
+        assert_equals(bytes(cbn.view(len(data) - 3)), data[-3:])
+
+        assert_equals([s.name for s in cbn.sections], ["", ".text", ".bss", ".shstrtab"])
+        assert_equals(bytes(cbn.section(".text")), b"\x31\xc0\x40\xcd\x80")
+        assert_equals(len(cbn.section(".bss")), 0)
+        assert_raises(KeyError, cbn.section, ".nope")
+
+        cbn.blob = "not an elf"
+        assert_equals(cbn.mmap()[:], b"not an elf")
+        assert_raises(ValueError, lambda: cbn.sections)
+
+        cbn.blob = ""
+        assert_equals(cbn.mmap(), b"")
+        assert_equals(len(cbn.view()), 0)
+        assert_raises(ValueError, lambda: cbn.sections)
+
+        # ELF64 headers are longer than ELF32 ones
+        cbn.blob = b"\x7fELF\x02\x01\x01" + b"\x00" * 0x30
+        assert_raises(ValueError, lambda: cbn.sections)
+        cbn.blob = data[:-1]
+        assert_raises(ValueError, lambda: cbn.sections)
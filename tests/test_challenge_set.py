@@ -3,7 +3,7 @@
 
 from __future__ import absolute_import, unicode_literals
 
-from datetime import datetime
+from datetime import datetime, timedelta
 import time
 import os
 
@@ -17,6 +17,7 @@ from farnsworth.models import (AFLJob,
                                ChallengeSetFielding,
                                CSSubmissionCable,
                                Exploit,
+                               Feedback,
                                FunctionIdentity,
                                IDSRule,
                                IDSRuleFielding,
@@ -156,6 +157,30 @@ class TestChallengeSet:
         assert_not_in(cbn_patched, cs.cbns_original)
         assert_not_in(cbn_other_team, cs.cbns_original)
 
+        # flagged when fielded, then read back from the flag
+        assert_true(ChallengeBinaryNode.get(ChallengeBinaryNode.id == cbn.id).is_original)
+        assert_false(ChallengeBinaryNode.get(ChallengeBinaryNode.id == cbn_patched.id).is_original)
+        cs = ChallengeSet.get(ChallengeSet.id == cs.id)
+        assert_equals(cs.cbns_original, [cbn])
+        assert_equals(ChallengeSet.originals([cs.id, cs.id + 1]), {cs.id: [cbn]})
+
+        # unflagged challenge sets are looked up, reading does not write
+        ChallengeBinaryNode.update(is_original=False).where(ChallengeBinaryNode.cs == cs).execute()
+        assert_equals(ChallengeSet.originals([cs.id]), {cs.id: [cbn]})
+        assert_false(ChallengeBinaryNode.get(ChallengeBinaryNode.id == cbn.id).is_original)
+        assert_equals(ChallengeSet.flag_originals([cs.id]), 1)
+        assert_true(ChallengeBinaryNode.get(ChallengeBinaryNode.id == cbn.id).is_original)
+
+        # flags follow the fieldings
+        cbn_earlier = ChallengeBinaryNode.create(name="foo", cs=cs, blob="aaa4")
+        r_earlier = Round.create(num=2, created_at=r0.created_at - timedelta(minutes=1))
+        fielding = ChallengeSetFielding.create(cs=cs, cbns=[cbn_other_team], team=our_team,
+                                               available_round=r_earlier)
+        assert_equals(ChallengeSet.originals([cs.id]), {cs.id: [cbn_other_team]})
+        assert_false(ChallengeBinaryNode.get(ChallengeBinaryNode.id == cbn.id).is_original)
+        fielding.replace_cbns([cbn_earlier])
+        assert_equals(ChallengeSet.originals([cs.id]), {cs.id: [cbn_earlier]})
+
     def test_is_multi_cbn(self):
         r0 = Round.create(num=0)
         our_team = Team.create(name=Team.OUR_NAME)
@@ -175,6 +200,29 @@ class TestChallengeSet:
         assert_false(cs.is_multi_cbn)
         assert_true(cs_multi.is_multi_cbn)
 
+    def test_feedback(self):
+        r0 = Round.create(num=0)
+        r1 = Round.create(num=1)
+        cs = ChallengeSet.create(name="foo")
+        fb0 = Feedback.create(round=r0,
+                              polls=[{'csid': "foo", 'functionality': {'success': 100}},
+                                     {'csid': "bar", 'functionality': {'success': 90}}],
+                              cbs=[{'csid': "bar", 'timestamp': 1}],
+                              povs=[])
+        fb1 = Feedback.create(round=r1,
+                              polls=[{'csid': "foo", 'functionality': {'success': 95}}],
+                              cbs=[{'csid': "foo", 'timestamp': 2}],
+                              povs=[{'csid': "foobar", 'team': 1}])
+
+        assert_equals(cs.feedback_polls(),
+                      [{'csid': "foo", 'functionality': {'success': 100}, 'round': 0,
+                        'updated_at': str(fb0.updated_at)},
+                       {'csid': "foo", 'functionality': {'success': 95}, 'round': 1,
+                        'updated_at': str(fb1.updated_at)}])
+        assert_equals(cs.feedback_cbs(), [{'csid': "foo", 'timestamp': 2, 'round': 1,
+                                           'updated_at': str(fb1.updated_at)}])
+        assert_equals(cs.feedback_povs(), [])
+
     def test_all_tests_for_this_cs(self):
         cs = ChallengeSet.create(name="foo")
         job = AFLJob.create(cs=cs)
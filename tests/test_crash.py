@@ -4,6 +4,7 @@
 from __future__ import absolute_import, unicode_literals
 
 from datetime import datetime
+import hashlib
 
 from nose.tools import *
 
@@ -25,7 +26,7 @@ class TestCrash:
         assert_is_none(crash.sha256)
 
         crash.save()
-        assert_equals(crash.sha256, "bbffdf5ecaf101e014fa03c8d0b1996554bac10f")
+        assert_equals(crash.sha256, "5570a3cf02207f1d352d2cfea385be4bc0b2b9414f606baa6f55db60b232f221")
 
         crash = Crash(cs=cs, job=job, blob="a blob", sha256="sum")
         crash.save()
@@ -55,3 +56,22 @@ class TestCrash:
             crash.delete_instance()
             job.delete_instance()
             cs.delete_instance()
+
+    def test_bulk_create_or_get(self):
+        # bulk_create_or_get() commits, keep it in a transaction
+        with Crash._meta.database.atomic() as transaction:
+            cs = ChallengeSet.create(name="foo")
+            job = AFLJob.create()
+            crash = Crash.create(cs=cs, job=job, blob="a blob")
+
+            results = Crash.bulk_create_or_get(cs, job, ["a blob", "another blob", "another blob",
+                                                         "a third blob"],
+                                               batch_size=2, kind='unknown')
+            assert_equals([created for _, created in results], [False, True, False, True])
+            assert_equals(results[0][0].id, crash.id)
+            assert_equals(results[1][0].id, results[2][0].id)
+            assert_equals(str(results[1][0].blob), "another blob")
+            assert_equals(results[1][0].kind, 'unknown')
+            assert_equals(results[3][0].sha256, hashlib.sha256(b"a third blob").hexdigest())
+            assert_equals(Crash.select().where(Crash.cs == cs).count(), 3)
+            transaction.rollback()
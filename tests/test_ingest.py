@@ -0,0 +1,52 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+from datetime import datetime
+import hashlib
+
+from nose.tools import *
+
+from . import setup_each, teardown_each
+from farnsworth.ingest import copy_insert
+from farnsworth.models import Blob, ChallengeSet, RawRoundPoll, RawRoundTraffic, Round, ValidPoll
+
+
+class TestIngest:
+    def setup(self):
+        setup_each()
+
+    def teardown(self):
+        teardown_each()
+
+    def test_copy_insert(self):
+        # copy_insert() commits, keep it in a transaction
+        with Round._meta.database.atomic() as transaction:
+            round_ = Round.create(num=0)
+            cs = ChallengeSet.create(name="foo")
+            datas = [b"\x00\xff traffic {}".format(i % 3) for i in range(5)]
+            ids = copy_insert(RawRoundTraffic,
+                              ({'round': round_, 'pickled_data': data} for data in datas),
+                              batch_size=2)
+            assert_equals(len(ids), 5)
+            traffics = list(RawRoundTraffic.select().where(RawRoundTraffic.id << ids)
+                            .order_by(RawRoundTraffic.id).with_blobs())
+            assert_equals([t.id for t in traffics], ids)
+            assert_equals([str(t.pickled_data) for t in traffics], datas)
+            assert_false(traffics[0].processed)
+            assert_less(abs((traffics[0].created_at - datetime.now()).total_seconds()), 60)
+            assert_equals(Blob.select().where(Blob.sha256 << [hashlib.sha256(data).hexdigest()
+                                                             for data in datas]).count(), 3)
+
+            poll_ids = copy_insert(RawRoundPoll, [{'round': round_, 'cs': cs, 'blob': "<pov/>",
+                                                   'raw_round_traffic': ids[0]}])
+            poll = RawRoundPoll.get(RawRoundPoll.id == poll_ids[0])
+            assert_equals(str(poll.blob), "<pov/>")
+            assert_equals(poll.raw_round_traffic.id, ids[0])
+
+            valid_poll_ids = copy_insert(ValidPoll, [{'cs': cs, 'round': round_, 'blob': "<pov/>"}])
+            assert_true(ValidPoll.get(ValidPoll.id == valid_poll_ids[0]).is_perf_ready)
+            # the sequence keeps working for regular inserts
+            assert_greater(RawRoundTraffic.create(round=round_, pickled_data="x").id, max(ids))
+            transaction.rollback()
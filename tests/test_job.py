@@ -8,8 +8,9 @@ import datetime
 from nose.tools import *
 
 from . import setup_each, teardown_each
-from farnsworth.models import ChallengeBinaryNode, ChallengeSet
+from farnsworth.models import ChallengeBinaryNode, ChallengeSet, Crash
 from farnsworth.models.job import *
+import farnsworth.models    # to avoid collisions between Test and nosetests
 
 
 class TestJob:
@@ -36,6 +37,27 @@ class TestJob:
             job_types.remove(job_type)
 
 
+    def test_select_typed(self):
+        cs = ChallengeSet.create(name="foo")
+        afl_job = AFLJob.create(cs=cs)
+        driller_job = DrillerJob.create(cs=cs, payload={'test_id': 1})
+        pov_tester_job = PovTesterJob.create(cs=cs)
+        unknown_job = Job.create(cs=cs, worker='unknown')
+
+        jobs = list(Job.select_typed().where(Job.cs == cs).order_by(Job.id))
+        assert_equals([j.__class__ for j in jobs], [AFLJob, DrillerJob, PovTesterJob, Job])
+        assert_equals([j.id for j in jobs],
+                      [afl_job.id, driller_job.id, pov_tester_job.id, unknown_job.id])
+        assert_equals(jobs[1].payload, {'test_id': 1})
+        assert_equals(jobs[1].cs_id, cs.id)
+        assert_false(jobs[1].is_dirty())
+
+        job = Job.select_typed(Job.id, Job.worker).where(Job.id == driller_job.id).get()
+        assert_is_instance(job, DrillerJob)
+        job = Job.select_typed(Job.id).where(Job.id == driller_job.id).get()
+        assert_equals(job.__class__, Job)
+        assert_equals(Job.select_typed(Job.id).where(Job.cs == cs).tuples().count(), 4)
+
     def test_added_completed(self):
         class GenericJob(Job):
             worker = CharField(default='generic_job')
@@ -57,6 +79,182 @@ class TestJob:
                       GenericJob.cbn == cbn,
                       GenericJob.completed_at == None)
 
+    def test_claim_next(self):
+        # the queue is global, keep jobs left over by other tests out of the way
+        Job.update(started_at=datetime.datetime.now()).where(Job.started_at.is_null(True)).execute()
+        cs = ChallengeSet.create(name="foo")
+        low = AFLJob.create(cs=cs, priority=1)
+        high = AFLJob.create(cs=cs, priority=10)
+        started = AFLJob.create(cs=cs, priority=20, started_at=datetime.datetime.now())
+        other = DrillerJob.create(cs=cs, priority=30)
+
+        claimed = AFLJob.claim_next()
+        assert_equals([j.id for j in claimed], [high.id])
+        assert_is_instance(claimed[0], AFLJob)
+        assert_true(claimed[0].is_started())
+        assert_greater(claimed[0].lease_expires_at, claimed[0].started_at)
+        assert_true(AFLJob.get(AFLJob.id == high.id).is_started())
+
+        claimed = Job.claim_next('afl', batch=5)
+        assert_equals([j.id for j in claimed], [low.id])
+        assert_is_instance(claimed[0], AFLJob)
+
+        assert_equals(AFLJob.claim_next(batch=5), [])
+        assert_false(DrillerJob.get(DrillerJob.id == other.id).is_started())
+        assert_raises(ValueError, Job.claim_next)
+
+    def test_schedule_for(self):
+        Job.update(started_at=datetime.datetime.now()).where(Job.started_at.is_null(True)).execute()
+        big = AFLJob.create(priority=5, request_cpu=4, request_memory=4096)
+        medium = DrillerJob.create(priority=5, request_cpu=2, request_memory=2048)
+        small = RexJob.create(priority=1, request_cpu=1, request_memory=1024)
+        huge = AFLJob.create(priority=10, request_cpu=16, request_memory=1024)
+        tester = TesterJob.create(priority=20, request_cpu=1, request_memory=512)
+
+        jobs = Job.schedule_for(cpu=7, memory=8192)
+        assert_equals([j.id for j in jobs], [big.id, medium.id, small.id])
+        assert_equals([j.__class__ for j in jobs], [AFLJob, DrillerJob, RexJob])
+        assert_false(any(j.is_started() for j in jobs))
+
+        jobs = Job.schedule_for(cpu=3, memory=8192, kvm_access=True, data_access=True)
+        assert_equals([j.id for j in jobs], [tester.id, medium.id])
+
+        assert_equals([j.id for j in AFLJob.schedule_for(cpu=64, memory=8192)],
+                      [huge.id, big.id])
+
+        jobs = Job.schedule_for(cpu=1, memory=1024, claim=True)
+        assert_equals([j.id for j in jobs], [small.id])
+        assert_true(jobs[0].is_started())
+        assert_equals(Job.schedule_for(cpu=1, memory=1024), [])
+
+    def test_effective_priority(self):
+        Job.update(started_at=datetime.datetime.now()).where(Job.started_at.is_null(True)).execute()
+        now = datetime.datetime.now()
+        old = RopCacheJob.create(priority=1, created_at=now - datetime.timedelta(hours=2))
+        new = RopCacheJob.create(priority=10)
+        older = RopCacheJob.create(priority=1, created_at=now - datetime.timedelta(hours=3))
+        assert_almost_equals(old.effective_priority, 13, places=1)
+
+        jobs = RopCacheJob.unstarted_by_effective_priority()
+        assert_equals([j.id for j in jobs], [older.id, old.id, new.id])
+        assert_equals([j.id for j in RopCacheJob.claim_next(batch=2)], [older.id, old.id])
+
+        young = RopCacheJob.create(priority=2, request_cpu=1)
+        jobs = RopCacheJob.unstarted_by_effective_priority()
+        assert_equals([j.id for j in jobs], [new.id, young.id])
+        # only one CPU: the higher priority job is picked, young waits
+        jobs = RopCacheJob.schedule_for(cpu=1, memory=4096)
+        assert_equals([j.id for j in jobs], [new.id])
+
+    def test_prefetch_inputs(self):
+        cs = ChallengeSet.create(name="foo")
+        job = AFLJob.create(cs=cs)
+        test1 = farnsworth.models.Test.create(cs=cs, job=job, blob="test1")
+        test2 = farnsworth.models.Test.create(cs=cs, job=job, blob="test2")
+        crash = Crash.create(cs=cs, job=job, blob="crash")
+        driller_jobs = [DrillerJob.create(payload={'test_id': test.id})
+                        for test in (test1, test2, test1)]
+        rex_job = RexJob.create(payload={'crash_id': crash.id})
+        afl_job = AFLJob.create(payload={'cs_id': cs.id})
+        missing_job = DrillerJob.create(payload={'test_id': -1})
+        string_job = DrillerJob.create(payload={'test_id': str(test2.id)})
+
+        ids = [j.id for j in driller_jobs + [rex_job, afl_job, missing_job, string_job]]
+        jobs = [to_job_type(j) for j in Job.select().where(Job.id << ids).order_by(Job.id)]
+        assert_equals(prefetch_inputs(jobs), jobs)
+        assert_equals([j._input_test.id for j in jobs[:3]], [test1.id, test2.id, test1.id])
+        assert_is(jobs[0]._input_test, jobs[2]._input_test)
+        assert_equals(jobs[3]._input_crash, crash)
+        assert_equals(jobs[4]._challenge_set, cs)
+        assert_false(hasattr(jobs[5], '_input_test'))
+        assert_is(jobs[6]._input_test, jobs[1]._input_test)
+        assert_equals(str(jobs[1].input_test.blob), "test2")
+
+    def test_heartbeat(self):
+        job = AFLJob.create()
+        assert_false(job.heartbeat())
+
+        job.started(lease=True)
+        first_lease = job.lease_expires_at
+        assert_is_not_none(first_lease)
+        assert_true(job.heartbeat(lease=3600))
+        assert_greater(job.lease_expires_at, first_lease)
+        assert_equals(AFLJob.get(AFLJob.id == job.id).lease_expires_at, job.lease_expires_at)
+
+        job.completed()
+        assert_false(job.heartbeat())
+
+    def test_reap_expired(self):
+        Job.update(lease_expires_at=None).where(Job.lease_expires_at.is_null(False)).execute()
+        past = datetime.datetime.now() - datetime.timedelta(seconds=1)
+        afl_job = AFLJob.create(started_at=past, lease_expires_at=past)
+        driller_job = DrillerJob.create(started_at=past, lease_expires_at=past)
+        leased_job = AFLJob.create()
+        leased_job.started(lease=True)
+        unleased_job = AFLJob.create()
+        unleased_job.started()
+
+        requeued, failed = Job.reap_expired()
+        assert_equals(requeued, [afl_job.id])
+        assert_equals(failed, [driller_job.id])
+
+        afl_job = AFLJob.get(AFLJob.id == afl_job.id)
+        assert_false(afl_job.is_started())
+        assert_is_none(afl_job.lease_expires_at)
+        driller_job = DrillerJob.get(DrillerJob.id == driller_job.id)
+        assert_true(driller_job.is_completed())
+        assert_false(driller_job.produced_output)
+        assert_true(AFLJob.get(AFLJob.id == leased_job.id).is_started())
+        assert_true(AFLJob.get(AFLJob.id == unleased_job.id).is_started())
+
+        assert_equals(Job.reap_expired(), ([], []))
+
+    def test_bulk_enqueue(self):
+        cs = ChallengeSet.create(name="foo")
+        payloads = [{'test_id': 1}, {'test_id': 2}, {'test_id': 1}]
+        ids = Job.bulk_enqueue(DrillerJob, payloads, priority=5, cs=cs, batch_size=2)
+        assert_equals(len(ids), 2)
+
+        jobs = DrillerJob.select().where(DrillerJob.id << ids).order_by(DrillerJob.id)
+        assert_equals([j.payload for j in jobs], [{'test_id': 1}, {'test_id': 2}])
+        assert_equals(set(j.worker for j in jobs), {'driller'})
+        assert_equals(set(j.priority for j in jobs), {5})
+        assert_equals(set(j.cs_id for j in jobs), {cs.id})
+
+        payloads = [{'test_id': 2, 'other': 'x'}, {'test_id': 3, 'other': 'y'}]
+        ids = Job.bulk_enqueue(DrillerJob, payloads, dedupe_on=('test_id',))
+        assert_equals(len(ids), 1)
+        assert_equals(DrillerJob.get(DrillerJob.id == ids[0]).payload['test_id'], 3)
+
+        # same payload, different worker type
+        assert_equals(len(Job.bulk_enqueue(RexJob, [{'test_id': 1}])), 1)
+        assert_equals(Job.bulk_enqueue(RexJob, []), [])
+
+    def _explain(self, query):
+        sql, params = query.sql()
+        db = Job._meta.database
+        # tables are tiny during tests, make the planner prefer any usable index
+        db.execute_sql("SET LOCAL enable_seqscan = off")
+        return "\n".join(row[0] for row in db.execute_sql("EXPLAIN " + sql, params).fetchall())
+
+    def test_unstarted_uses_partial_index(self):
+        plan = self._explain(AFLJob.unstarted().order_by(AFLJob.priority.desc()))
+        assert_in("jobs_unstarted_worker_priority", plan)
+
+        cs = ChallengeSet.create(name="foo")
+        plan = self._explain(TesterJob.unstarted(cs))
+        assert_in("jobs_unstarted_worker_cs_id", plan)
+
+        query = TesterJob.select().where(TesterJob.completed_at.is_null(True)
+                                         & (TesterJob.worker == TesterJob.worker.default)
+                                         & (TesterJob.cs == cs))
+        plan = self._explain(query)
+        assert_in("jobs_uncompleted_worker_cs_id", plan)
+
+    def test_aged_priority_uses_index(self):
+        plan = self._explain(RopCacheJob.unstarted_by_effective_priority().limit(10))
+        assert_in("jobs_unstarted_worker_aged_priority", plan)
+
     def test_get_or_create(self):
         cs = ChallengeSet.create(name="foo")
         cbn = ChallengeBinaryNode.create(name="foo", cs=cs, blob="aaa")
@@ -0,0 +1,75 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+from datetime import datetime, timedelta
+
+from nose.tools import *
+
+from . import setup_each, teardown_each
+from farnsworth import metrics
+from farnsworth.config import master_db
+from farnsworth.models import Job
+
+
+def _deltas():
+    return master_db.execute_sql("SELECT count(*) FROM job_queue_counter_deltas").fetchone()[0]
+
+
+class TestMetrics:
+    def setup(self):
+        setup_each()
+
+    def teardown(self):
+        teardown_each()
+
+    def test_counts(self):
+        assert_equals(metrics.counts('metrics'), [])
+
+        jobs = [Job.create(worker='metrics', priority=1) for _ in range(3)]
+        Job.create(worker='metrics', priority=2)
+        jobs[0].started()
+        jobs[1].started()
+        jobs[1].completed()
+        jobs[2].delete_instance()
+        assert_equals(metrics.counts('metrics'),
+                      [{'worker': 'metrics', 'priority': 2,
+                        'pending': 1, 'running': 0, 'completed': 0, 'claimed': 0},
+                       {'worker': 'metrics', 'priority': 1,
+                        'pending': 0, 'running': 1, 'completed': 1, 'claimed': 2}])
+
+        jobs[0].priority = 2
+        jobs[0].save()
+        assert_equals([(c['priority'], c['running']) for c in metrics.counts('metrics')],
+                      [(2, 1), (1, 0)])
+
+        # folding the deltas into the counters does not change the counts
+        counts = metrics.counts('metrics')
+        metrics.fold()
+        assert_equals(_deltas(), 0)
+        assert_equals(metrics.counts('metrics'), counts)
+
+        # saving without a transition appends no delta
+        jobs[0].save()
+        assert_equals(_deltas(), 0)
+        jobs[0].completed()
+        assert_equals(_deltas(), 2)
+
+    def test_timings(self):
+        now = datetime.now()
+        for wait, run in [(1, 10), (3, None), (5, 30)]:
+            created_at = now - timedelta(seconds=60)
+            started_at = created_at + timedelta(seconds=wait)
+            completed_at = started_at + timedelta(seconds=run) if run else None
+            Job.create(worker='metrics', created_at=created_at, started_at=started_at,
+                       completed_at=completed_at)
+        Job.create(worker='metrics')
+
+        metrics.refresh()
+        timings = metrics.timings('metrics')
+        assert_equals(len(timings), 1)
+        assert_almost_equals(timings[0]['wait_p50'], 3)
+        assert_almost_equals(timings[0]['wait_p95'], 4.8)
+        assert_almost_equals(timings[0]['run_p50'], 20)
+        assert_almost_equals(timings[0]['run_p95'], 29)
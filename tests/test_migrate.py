@@ -0,0 +1,107 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+from nose.tools import *
+
+from . import setup_each, teardown_each
+import farnsworth
+from farnsworth.blobstore import get_store
+from farnsworth.config import master_db
+from farnsworth.models import (AFLJob, Blob, ChallengeBinaryNode, ChallengeSet,
+                               ChallengeSetFielding, PatcherexJob, PatchType, Round, Team)
+import farnsworth.models    # to avoid collisions between Test and nosetests
+
+
+def _columns(table):
+    cursor = master_db.execute_sql("SELECT column_name FROM information_schema.columns "
+                                   "WHERE table_name = %s", (table,))
+    return {row[0] for row in cursor.fetchall()}
+
+
+def _indexes(table):
+    cursor = master_db.execute_sql("SELECT indexname FROM pg_indexes WHERE tablename = %s",
+                                   (table,))
+    return {row[0] for row in cursor.fetchall()}
+
+
+class TestMigrate:
+    def setup(self):
+        setup_each()
+
+    def teardown(self):
+        teardown_each()
+
+    def test_create_tables_twice(self):
+        farnsworth.create_tables()
+        assert_equals(PatchType.select().count(), len(PatcherexJob.PATCH_TYPES))
+
+    def test_payload_hash(self):
+        # jobs table from before Job.bulk_enqueue()
+        master_db.execute_sql("ALTER TABLE jobs DROP COLUMN payload_hash")
+        farnsworth.migrate()
+        assert_in('payload_hash', _columns('jobs'))
+        assert_in('jobs_worker_payload_hash', _indexes('jobs'))
+        farnsworth.migrate()
+
+    def test_lease_expires_at(self):
+        # jobs table from before job leases
+        master_db.execute_sql("ALTER TABLE jobs DROP COLUMN lease_expires_at")
+        farnsworth.migrate()
+        assert_in('lease_expires_at', _columns('jobs'))
+        assert_in('jobs_uncompleted_lease_expires_at', _indexes('jobs'))
+
+    def test_is_original(self):
+        # challenge_binary_nodes table from before the original flags
+        round_ = Round.create(num=0)
+        cs = ChallengeSet.create(name="foo")
+        cbn = ChallengeBinaryNode.create(name="foo", cs=cs, blob="original")
+        other = ChallengeBinaryNode.create(name="foo", cs=cs, blob="other")
+        ChallengeSetFielding.create(cs=cs, cbns=[cbn], team=Team.create(name=Team.OUR_NAME),
+                                    available_round=round_)
+        master_db.execute_sql("ALTER TABLE challenge_binary_nodes DROP COLUMN is_original")
+        farnsworth.migrate()
+        assert_in('is_original', _columns('challenge_binary_nodes'))
+        assert_in('challenge_binary_nodes_original_cs_id', _indexes('challenge_binary_nodes'))
+        assert_true(ChallengeBinaryNode.get(ChallengeBinaryNode.id == cbn.id).is_original)
+        assert_false(ChallengeBinaryNode.get(ChallengeBinaryNode.id == other.id).is_original)
+
+    def test_commit_seq(self):
+        # tests table from before commit_seq
+        cs = ChallengeSet.create(name="foo")
+        test = farnsworth.models.Test.create(cs=cs, job=AFLJob.create(), blob="old")
+        master_db.execute_sql("SET CONSTRAINTS tests_commit_seq IMMEDIATE")
+        master_db.execute_sql("ALTER TABLE tests DROP COLUMN commit_seq")
+        farnsworth.migrate()
+        assert_in('tests_cs_id_commit_seq', _indexes('tests'))
+        cursor, tests = farnsworth.models.Test.since(cs=cs)
+        assert_equals(tests, [test])
+
+    def test_blobs_codec(self):
+        # blobs table from before compression
+        master_db.execute_sql("ALTER TABLE blobs DROP COLUMN codec")
+        master_db.execute_sql("INSERT INTO blobs (created_at, updated_at, sha256, size, data) "
+                              "VALUES (now(), now(), %s, 3, 'old')", ("0" * 64,))
+        farnsworth.migrate()
+        assert_in('codec', _columns('blobs'))
+        assert_equals(Blob.get(Blob.sha256 == "0" * 64).codec, 'raw')
+        assert_equals(get_store().get("0" * 64), b"old")
+
+    def test_blob_columns(self):
+        # migrate_blob_columns() commits every batch, keep it in a transaction
+        with master_db.atomic() as transaction:
+            # tests table from before the blob store, blobs in a bytea column
+            cs = ChallengeSet.create(name="foo")
+            test = farnsworth.models.Test.create(cs=cs, job=AFLJob.create(), blob="new")
+            master_db.execute_sql("SET CONSTRAINTS tests_commit_seq IMMEDIATE")
+            master_db.execute_sql("ALTER TABLE tests ADD COLUMN blob BYTEA")
+            master_db.execute_sql("UPDATE tests SET blob = convert_to('old ' || id, 'UTF8')")
+            master_db.execute_sql("ALTER TABLE tests DROP COLUMN blob_sha256")
+            farnsworth.migrate()
+            assert_in('blob_sha256', _columns('tests'))
+            assert_not_in('blob', _columns('tests'))
+            test = farnsworth.models.Test.get(farnsworth.models.Test.id == test.id)
+            assert_equals(test.blob, "old {}".format(test.id).encode())
+            farnsworth.migrate()
+            transaction.rollback()
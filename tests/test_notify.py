@@ -0,0 +1,57 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+from nose.tools import *
+
+from . import setup_each, teardown_each
+from farnsworth.models import AFLJob, DrillerJob, Job
+from farnsworth.notify import JobListener, wait_for_jobs
+
+
+class TestNotify:
+    def setup(self):
+        setup_each()
+
+    def teardown(self):
+        teardown_each()
+
+    def test_job_listener(self):
+        listener = JobListener('afl')
+        assert_equals(listener.wait(0), [])
+
+        afl_job = AFLJob.create()
+        driller_job = DrillerJob.create()
+        # notifications are delivered on commit only
+        assert_equals(listener.wait(0), [])
+        Job._meta.database.commit()
+        assert_equals(listener.wait(1), [('afl', afl_job.id)])
+
+        listener.listen('driller')
+        # saving an unstarted job is not a requeue
+        afl_job.priority = 5
+        afl_job.save()
+        driller_job.started()
+        Job._meta.database.commit()
+        assert_equals(listener.wait(0.1), [])
+
+        afl_job.started()
+        afl_job.started_at = None
+        afl_job.save()
+        Job._meta.database.commit()
+        assert_equals(listener.wait(1), [('afl', afl_job.id)])
+        listener.close()
+
+        with Job._meta.database.atomic():
+            afl_job.delete_instance()
+            driller_job.delete_instance()
+
+    def test_wait_for_jobs(self):
+        assert_equals(wait_for_jobs('driller', 0), [])
+        job = DrillerJob.create()
+        Job._meta.database.commit()
+        assert_equals(wait_for_jobs('driller', 1), [job.id])
+
+        with Job._meta.database.atomic():
+            job.delete_instance()
@@ -3,9 +3,11 @@
 
 from __future__ import absolute_import, unicode_literals
 
+from nose.plugins.skip import SkipTest
 from nose.tools import *
 
 from . import setup_each, teardown_each
+from farnsworth import scoring
 from farnsworth.models.challenge_binary_node import ChallengeBinaryNode
 from farnsworth.models.challenge_set_fielding import ChallengeSetFielding
 from farnsworth.models.challenge_set import ChallengeSet
@@ -17,6 +19,24 @@ from farnsworth.models.team import Team
 
 BLOB = "cb scores"
 
+
+class _CountQueries(object):
+    """Count the queries run on the master database"""
+
+    def __enter__(self):
+        self.count = 0
+        self.database = PollFeedback._meta.database
+        self.execute_sql = self.database.execute_sql
+
+        def execute_sql(*args, **kwargs):
+            self.count += 1
+            return self.execute_sql(*args, **kwargs)
+        self.database.execute_sql = execute_sql
+        return self
+
+    def __exit__(self, *exc_info):
+        del self.database.execute_sql
+
 # pylint:disable=no-self-use
 
 class TestScores(object):
@@ -78,6 +98,53 @@ class TestScores(object):
         assert_almost_equal(cbn1.avg_cb_score, ((0.9609803444828162 + 0.6830134553650711)/2))
         assert_almost_equal(cbn1.min_cb_score, 0.6830134553650711)
 
+        # the SQL formulas match CBScoreMixin
+        assert_equal(ChallengeBinaryNode.cb_scores(cs=cs, round=r3), {})
+        min_score, avg_score = ChallengeBinaryNode.cb_scores(cs=cs, round=r5)[cbn1.id]
+        assert_almost_equal(min_score, pf.cb_score)
+        assert_almost_equal(avg_score, pf.cb_score)
+
+        # the feedbacks, then their fieldings and original sizes, whatever their number
+        for num in range(6, 9):
+            round_ = Round.create(num=num)
+            pf = PollFeedback.create(cs=cs, round=round_, success=0.99, timeout=0, connect=0,
+                                     function=0, time_overhead=0.0, memory_overhead=0.0)
+            ChallengeSetFielding.create(cs=cs, cbns=[cbn1], team=team, available_round=round_,
+                                        poll_feedback=pf)
+        with _CountQueries() as queries:
+            scores = [f.cb_score for f in cbn1.poll_feedbacks]
+        assert_equal(len(scores), 5)
+        assert_less_equal(queries.count, 3)
+
+    def test_cb_scores(self):
+        r0 = Round.create(num=0)
+        r1 = Round.create(num=1)
+        r2 = Round.create(num=2)
+        cs = ChallengeSet.create(name="foo")
+        team = Team.get_our()
+        pt = PatchType.create(name="patch1", functionality_risk=0.0, exploitability=0.2)
+        cbn1 = ChallengeBinaryNode.create(name="foo", cs=cs, sha256="sum1", blob="asdf")
+        cbn2 = ChallengeBinaryNode.create(name="foo", cs=cs, sha256="sum2", blob="asdfasdf",
+                                          patch_type=pt)
+        cbn3 = ChallengeBinaryNode.create(name="foo", cs=cs, sha256="sum3", blob="asdfa")
+
+        feedbacks = []
+        for round_, cbn, success, overhead in [(r0, cbn1, 0.99, 0.05), (r1, cbn2, 1.0, 0.3),
+                                               (r2, cbn3, 0.5, 0.0)]:
+            pf = PollFeedback.create(cs=cs, round=round_, success=success, timeout=0, connect=0,
+                                     function=0, time_overhead=overhead, memory_overhead=0.0)
+            ChallengeSetFielding.create(cs=cs, cbns=[cbn], team=team, available_round=round_,
+                                        poll_feedback=pf)
+            feedbacks.append(pf)
+
+        scores = ChallengeBinaryNode.cb_scores(cs=cs)
+        assert_equal(set(scores), {cbn1.id, cbn2.id, cbn3.id})
+        for cbn, pf in zip([cbn1, cbn2, cbn3], feedbacks):
+            assert_almost_equal(scores[cbn.id][0], pf.cb_score)
+            assert_almost_equal(scores[cbn.id][1], pf.cb_score)
+        assert_equal(set(ChallengeBinaryNode.cb_scores(round=r1)), {cbn2.id})
+        assert_equal(set(ChallengeBinaryNode.cb_scores(cbns=[cbn2])), {cbn2.id})
+
     def test_poll_feedback(self):
         r0 = Round.create(num=0)
         cs = ChallengeSet.create(name="foo")
@@ -189,3 +256,111 @@ class TestScores(object):
         csf_orig = ChallengeSetFielding.create(cs=cs, cbns=[cbn2], team=team, available_round=r6,
                                                submission_round=r6, poll_feedback=pf)
         assert_almost_equals(cbn2.estimated_cb_score, 1.8)
+
+    def test_vectorised_scores(self):
+        if scoring.numpy is None:
+            raise SkipTest("NumPy is not installed")
+        r0 = Round.create(num=0)
+        r1 = Round.create(num=1)
+        cs = ChallengeSet.create(name="foo")
+        team = Team.get_our()
+        pt = PatchType.create(name="patch1", functionality_risk=0.1, exploitability=0.2)
+        cbn1 = ChallengeBinaryNode.create(name="foo", cs=cs, sha256="sum1", blob="asdf")
+        cbn2 = ChallengeBinaryNode.create(name="foo", cs=cs, sha256="sum2", blob="asdfasdf",
+                                          patch_type=pt)
+        for round_, cbn, success, overhead in [(r0, cbn1, 0.99, 0.05), (r1, cbn2, 0.3, 0.3)]:
+            pf = PollFeedback.create(cs=cs, round=round_, success=success, timeout=0, connect=0,
+                                     function=0, time_overhead=overhead, memory_overhead=0.0)
+            ChallengeSetFielding.create(cs=cs, cbns=[cbn], team=team, available_round=round_,
+                                        poll_feedback=pf)
+        for has_failed_polls, task_clock, rss in [(False, 4, 3), (True, 6, 0), (False, 9, 5)]:
+            perf_score = {'score': {'rep': {'task_clock': task_clock, 'rss': rss, 'flt': 1,
+                                            'file_size': 5},
+                                    'ref': {'task_clock': 4, 'rss': 3, 'flt': 2,
+                                            'file_size': 6}}}
+            PatchScore.create(cs=cs, round=r0, num_polls=1, perf_score=perf_score, patch_type=pt,
+                              has_failed_polls=has_failed_polls)
+
+        names = ['size_overhead', 'memory_overhead', 'time_overhead', 'success', 'security',
+                 'cqe_performance_score', 'cqe_functionality_score', 'availability', 'cb_score']
+        for model, columns in [(PatchScore, scoring.patch_scores(cs=cs)),
+                               (PollFeedback, scoring.poll_feedbacks(cs=cs))]:
+            objects = list(model.select().where(model.cs == cs).order_by(model.id))
+            assert_equal(list(columns['id']), [o.id for o in objects])
+            for name in names:
+                assert_equal(list(columns[name]), [getattr(o, name) for o in objects])
+
+        assert_equal(len(scoring.poll_feedbacks(cs=cs, round=r1)['id']), 1)
+
+    def test_vectorised_poll_feedbacks_fieldings(self):
+        if scoring.numpy is None:
+            raise SkipTest("NumPy is not installed")
+        r0 = Round.create(num=0)
+        r1 = Round.create(num=1)
+        r2 = Round.create(num=2)
+        cs = ChallengeSet.create(name="foo")
+        team = Team.get_our()
+        other_team = Team.create(name="opponent")
+        pt = PatchType.create(name="patch1", functionality_risk=0.1, exploitability=0.2)
+        cbn1 = ChallengeBinaryNode.create(name="foo", cs=cs, sha256="sum1", blob="asdf")
+        cbn2 = ChallengeBinaryNode.create(name="foo", cs=cs, sha256="sum2", blob="asdfasdf",
+                                          patch_type=pt)
+        ChallengeSetFielding.create(cs=cs, cbns=[cbn1], team=team, available_round=r0)
+        # two fieldings of our team, scored against the first one
+        pf = PollFeedback.create(cs=cs, round=r1, success=0.9, timeout=0, connect=0,
+                                 function=0, time_overhead=0.1, memory_overhead=0.0)
+        ChallengeSetFielding.create(cs=cs, cbns=[cbn2], team=team, available_round=r1,
+                                    poll_feedback=pf)
+        ChallengeSetFielding.create(cs=cs, cbns=[cbn1], team=team, available_round=r2,
+                                    poll_feedback=pf)
+        # fielded by another team only
+        other_pf = PollFeedback.create(cs=cs, round=r1, success=0.5, timeout=0, connect=0,
+                                       function=0, time_overhead=0.1, memory_overhead=0.0)
+        ChallengeSetFielding.create(cs=cs, cbns=[cbn2], team=other_team, available_round=r1,
+                                    poll_feedback=other_pf)
+
+        columns = scoring.poll_feedbacks(cs=cs)
+        assert_equal(list(columns['id']), [pf.id])
+        assert_equal(list(columns['cb_score']),
+                     [PollFeedback.get(PollFeedback.id == pf.id).cb_score])
+        assert_equal(list(columns['security']), [1.8])
+
+    def test_poll_feedback_queries(self):
+        r0 = Round.create(num=0)
+        r1 = Round.create(num=1)
+        cs = ChallengeSet.create(name="foo")
+        team = Team.get_our()
+        pt = PatchType.create(name="patch1", functionality_risk=0.0, exploitability=0.2)
+        cbn1 = ChallengeBinaryNode.create(name="foo", cs=cs, sha256="sum1", blob="asdf")
+        cbn2 = ChallengeBinaryNode.create(name="foo", cs=cs, sha256="sum2", blob="asdfasdf",
+                                          patch_type=pt)
+        for round_, cbn in [(r0, cbn1), (r1, cbn2)]:
+            pf = PollFeedback.create(cs=cs, round=round_, success=0.99, timeout=0, connect=0,
+                                     function=0, time_overhead=0.1, memory_overhead=0.0)
+            ChallengeSetFielding.create(cs=cs, cbns=[cbn], team=team, available_round=round_,
+                                        poll_feedback=pf)
+
+        pf = PollFeedback.get(PollFeedback.id == pf.id)
+        with _CountQueries() as queries:
+            cb_score = pf.cb_score
+        assert_less_equal(queries.count, 1)
+        assert_equal(pf.patch_type, pt)
+        assert_equal(pf.size_overhead, 1.0)
+        with _CountQueries() as queries:
+            assert_equal(pf.cb_score, cb_score)
+        assert_equal(queries.count, 0)
+
+        # saving forgets the cached values
+        pf.save()
+        with _CountQueries() as queries:
+            assert_equal(pf.cb_score, cb_score)
+        assert_greater(queries.count, 0)
+
+        query = PollFeedback.select().where(PollFeedback.cs == cs).order_by(PollFeedback.id)
+        feedbacks = PollFeedback.prefetch_fieldings(query)
+        with _CountQueries() as queries:
+            scores = [f.cb_score for f in feedbacks]
+        assert_equal(queries.count, 0)
+        assert_equal(scores[1], cb_score)
+        assert_is_none(feedbacks[0].patch_type)
+        assert_equal(feedbacks[0].fielding.available_round_id, r0.id)
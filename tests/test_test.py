@@ -6,14 +6,29 @@ from __future__ import absolute_import, unicode_literals
 from datetime import datetime
 
 from nose.tools import *
+import psycopg2
 
 from . import setup_each, teardown_each
-from farnsworth.models import AFLJob, DrillerJob, ChallengeBinaryNode, ChallengeSet, Job
+from farnsworth.models import (AFLJob, ColorGuardJob, DrillerJob, ChallengeBinaryNode,
+                               ChallengeSet, Job)
+from farnsworth.blobstore import get_store
+from farnsworth.peewee_extensions import BlobRef
 import farnsworth.models    # to avoid collisions between Test and nosetests
 
 NOW = datetime.now()
 
 
+def _delete_committed(*challenge_sets):
+    """Delete the rows of challenge sets committed by a test"""
+    Test = farnsworth.models.Test
+    database = Test._meta.database
+    database.rollback()
+    Test.delete().where(Test.cs << challenge_sets).execute()
+    Job.delete().where(Job.cs << challenge_sets).execute()
+    ChallengeSet.delete().where(ChallengeSet.id << [cs.id for cs in challenge_sets]).execute()
+    database.commit()
+
+
 class TestTest:
     def setup(self):
         setup_each()
@@ -28,7 +43,7 @@ class TestTest:
         assert_is_none(test.sha256)
 
         test.save()
-        assert_equals(test.sha256, "bbffdf5ecaf101e014fa03c8d0b1996554bac10f")
+        assert_equals(test.sha256, "5570a3cf02207f1d352d2cfea385be4bc0b2b9414f606baa6f55db60b232f221")
 
         test = farnsworth.models.Test(cs=cs, job=job, blob="a blob", sha256="sum")
         test.save()
@@ -114,3 +129,142 @@ class TestTest:
                                                    .join(Job).where((Job.cs == cs2) \
                                                                     & (job2.id != Job.id))
         assert_equal(len(unsynced_cs2_job2), 1)
+
+    def test_since(self):
+        Test = farnsworth.models.Test
+        database = Test._meta.database
+        cs1 = ChallengeSet.create(name="foo")
+        cs2 = ChallengeSet.create(name="bar")
+        job = AFLJob.create(cs=cs1)
+        try:
+            # rows of transactions in flight, like this one, are not returned
+            test1 = Test.create(cs=cs1, job=job, blob="XXX1")
+            assert_equal(Test.since(cs=cs1), (0, []))
+            test2 = Test.create(cs=cs2, job=job, blob="XXX2")
+            test3 = Test.create(cs=cs1, job=job, blob="XXX3")
+            database.commit()
+
+            cursor, tests = Test.since(cs=cs1, limit=1)
+            assert_equal(tests, [test1])
+            cursor, tests = Test.since(cursor, cs=cs1)
+            assert_equal(tests, [test3])
+            assert_equal(Test.since(cursor, cs=cs1), (cursor, []))
+
+            cursor, tests = Test.since(cs=cs1)
+            assert_equal(tests, [test1, test3])
+            assert_equal(Test.since(cursor), (cursor, []))
+
+            # updating a synced row does not send it again
+            test1.drilled = True
+            test1.save()
+            database.commit()
+            assert_equal(Test.since(cursor), (cursor, []))
+        finally:
+            _delete_committed(cs1, cs2)
+
+    def test_since_in_flight(self):
+        Test = farnsworth.models.Test
+        database = Test._meta.database
+        cs = ChallengeSet.create(name="foo")
+        job = AFLJob.create(cs=cs)
+        blobs = [BlobRef(get_store().put(blob)) for blob in [b"slow", b"fast"]]
+        database.commit()
+        slow = psycopg2.connect(database=database.database, **database.connect_kwargs)
+        fast = psycopg2.connect(database=database.database, **database.connect_kwargs)
+        try:
+            cursor = Test.since(cs=cs)[0]
+            # a lower id committed after a higher one
+            ids = []
+            for connection, blob in zip([slow, fast], blobs):
+                sql, params = Test.insert(cs=cs, job=job, blob=blob, sha256=blob).sql()
+                with connection.cursor() as sql_cursor:
+                    sql_cursor.execute(sql, params)
+                    ids.append(sql_cursor.fetchone()[0])
+            fast.commit()
+            assert_less(ids[0], ids[1])
+            cursor, tests = Test.since(cursor, cs=cs)
+            assert_equal([test.id for test in tests], ids[1:])
+
+            slow.commit()
+            cursor, tests = Test.since(cursor, cs=cs)
+            assert_equal([test.id for test in tests], ids[:1])
+            assert_equal(Test.since(cursor, cs=cs), (cursor, []))
+        finally:
+            slow.close()
+            fast.close()
+            _delete_committed(cs)
+
+    def test_sha256_is_hashed_once(self):
+        cs = ChallengeSet.create(name="foo")
+        job = AFLJob.create()
+        test = farnsworth.models.Test(cs=cs, job=job, blob="a blob")
+        sha256 = test.blob_sha256()
+        assert_is(test.blob_sha256(), sha256)
+        test.save()
+        assert_equals(test.sha256, sha256)
+        assert_equals(test._data['blob'], sha256)
+
+        test.blob = "another blob"
+        assert_not_equal(test.blob_sha256(), sha256)
+
+    def test_repair_sha256(self):
+        Test = farnsworth.models.Test
+        # repair_sha256() commits, keep it in a transaction
+        with Test._meta.database.atomic() as transaction:
+            cs = ChallengeSet.create(name="foo")
+            job = AFLJob.create()
+            test1 = Test.create(cs=cs, job=job, blob="a blob", sha256="sha1 of a blob")
+            test2 = Test.create(cs=cs, job=job, blob="a blob")
+            test3 = Test.create(cs=cs, job=job, blob="another blob")
+            driller_job = DrillerJob.create(cs=cs, payload={'test_id': test2.id})
+            poll = farnsworth.models.ValidPoll.create(cs=cs, test=test2, blob="poll")
+
+            assert_equals(Test.repair_sha256(), (1, 1))
+            assert_equals(Test.get(Test.id == test1.id).sha256, test2.sha256)
+            assert_false(Test.select().where(Test.id == test2.id).exists())
+            assert_equals(Test.get(Test.id == test3.id).sha256, test3.sha256)
+            assert_equals(Job.get(Job.id == driller_job.id).payload, {'test_id': test1.id})
+            assert_equals(farnsworth.models.ValidPoll.get(
+                farnsworth.models.ValidPoll.id == poll.id).test_id, test1.id)
+            assert_equals(Test.repair_sha256(), (0, 0))
+            transaction.rollback()
+
+    def test_repair_sha256_payloads(self):
+        Test = farnsworth.models.Test
+        with Test._meta.database.atomic() as transaction:
+            cs = ChallengeSet.create(name="foo")
+            job = AFLJob.create()
+            test1 = Test.create(cs=cs, job=job, blob="a blob", sha256="sha1 of a blob")
+            test2 = Test.create(cs=cs, job=job, blob="a blob")
+            test_job = ColorGuardJob.create(cs=cs, payload={'id': test2.id, 'crash': False})
+            crash_job = ColorGuardJob.create(cs=cs, payload={'id': test2.id, 'crash': True})
+
+            assert_equals(Test.repair_sha256(), (1, 1))
+            assert_equals(Job.get(Job.id == test_job.id).payload,
+                          {'id': test1.id, 'crash': False})
+            assert_equals(Job.get(Job.id == crash_job.id).payload,
+                          {'id': test2.id, 'crash': True})
+            transaction.rollback()
+
+    def test_repair_sha256_conflicts(self):
+        Test = farnsworth.models.Test
+        ValidPoll = farnsworth.models.ValidPoll
+        database = Test._meta.database
+        with database.atomic() as transaction:
+            cs = ChallengeSet.create(name="foo")
+            job = AFLJob.create()
+            # fixing test1 needs the sha256 test2 holds until it is fixed too
+            test1 = Test.create(cs=cs, job=job, blob="a blob", sha256="sha1 of a blob")
+            test2 = Test.create(cs=cs, job=job, blob="another blob", sha256=test1.blob_sha256())
+            assert_equals(Test.repair_sha256(), (2, 0))
+            assert_equals(Test.get(Test.id == test1.id).sha256, test1.blob_sha256())
+            assert_equals(Test.get(Test.id == test2.id).sha256, test2.blob_sha256())
+
+            # merged rows cannot be referenced twice by a unique column
+            test3 = Test.create(cs=cs, job=job, blob="a blob", sha256="sha1 of a blob")
+            ValidPoll.create(cs=cs, test=test1, blob="poll 1")
+            ValidPoll.create(cs=cs, test=test3, blob="poll 3")
+            database.execute_sql("CREATE UNIQUE INDEX valid_polls_test_id_unique "
+                                 "ON valid_polls (test_id)")
+            assert_raises(ValueError, Test.repair_sha256)
+            transaction.rollback()